@@ -0,0 +1,510 @@
+import gzip
+import lzma
+import os
+import struct
+import tarfile
+import threading
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, NamedTuple, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from exceptions import CriticalError
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+class Codec:
+    name: str = ""
+    extension: str = ""
+    # Extension of compressed files that are not tarballs (eg: database dumps)
+    suffix: str = ""
+    default_level: int = 0
+    min_level: int = 0
+    max_level: int = 0
+    # Every member of the tar starts a new block, so it's compressed on its own
+    frame_per_member: bool = False
+    needs_dictionary: bool = False
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        raise NotImplementedError()
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    # Every block becomes a complete gzip member. Concatenated members are a valid
+    # gzip stream (RFC 1952), so gunzip/tar read the result like any other .tar.gz
+    name = "gzip"
+    extension = "tar.gz"
+    suffix = "gz"
+    # Same level tarfile's "w:gz" mode used
+    default_level = 9
+    min_level = 1
+    max_level = 9
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return gzip.compress(data, compresslevel=level, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class XzCodec(Codec):
+    # Concatenated .xz streams are valid as well
+    name = "xz"
+    extension = "tar.xz"
+    suffix = "xz"
+    default_level = 6
+    min_level = 0
+    max_level = 9
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+class ZstdCodec(Codec):
+    # Same goes for concatenated zstd frames
+    name = "zstd"
+    extension = "tar.zst"
+    suffix = "zst"
+    default_level = 3
+    min_level = 1
+    max_level = 22
+
+    @property
+    def available(self) -> bool:
+        return zstandard is not None
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return zstandard.ZstdCompressor(level=level, write_content_size=True).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class ZstdDictCodec(ZstdCodec):
+    # zstd with a dictionary trained on replays (see dictionaries.py). Replays are small and
+    # start with similar headers, a dictionary gives each of them what a 1 MB block would
+    # have learnt from the previous ones, so every replay can be its own frame and be
+    # decompressed on its own. Frames carry the id of their dictionary, the member index too.
+    # zstd -d -D {dictionary} decompresses the archive.
+    name = "zstd-dict"
+    frame_per_member = True
+    needs_dictionary = True
+
+    def __init__(self):
+        self.dictionaries: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+        # The one new frames are compressed with
+        self.current = 0
+        # Compressors are not thread safe, and loading a dictionary in one is not free
+        self._local = threading.local()
+
+    def add_dictionary(self, data: bytes, use: bool = False) -> int:
+        # Returns the id of the dictionary. With use, new frames are compressed with it.
+        dictionary = zstandard.ZstdCompressionDict(data)
+        dict_id = dictionary.dict_id()
+        if dict_id == 0:
+            raise CriticalError("Not a zstd dictionary")
+        self.dictionaries.setdefault(dict_id, dictionary)
+        if use:
+            self.current = dict_id
+        return dict_id
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        if not self.current:
+            raise CriticalError("No zstd dictionary loaded")
+        compressors = getattr(self._local, "compressors", None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        compressor = compressors.get((self.current, level))
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(
+                level=level, dict_data=self.dictionaries[self.current], write_content_size=True
+            )
+            compressors[(self.current, level)] = compressor
+        return compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        if not dict_id:
+            return super(ZstdDictCodec, self).decompress(data)
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None:
+            raise CriticalError(f"zstd dictionary {dict_id} is not loaded")
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj().decompress(data)
+
+
+CODECS: Dict[str, Codec] = {x.name: x for x in (GzipCodec(), XzCodec(), ZstdCodec(), ZstdDictCodec())}
+
+
+def get_codec(name: str) -> Codec:
+    codec = CODECS.get(name.lower())
+    if codec is None:
+        raise CriticalError(f"Unknown archive codec '{name}'. Valid codecs: {', '.join(CODECS)}")
+    if not codec.available:
+        raise CriticalError(f"The {codec.name} archive codec is not available (missing python module?)")
+    return codec
+
+
+def _compress_block(codec_name: str, level: int, data: bytes) -> bytes:
+    # Top-level so it can be pickled and sent to worker processes
+    return CODECS[codec_name].compress(data, level)
+
+
+def _use_dictionary(codec_name: str, dictionary: bytes) -> None:
+    # Worker process initializer
+    CODECS[codec_name].add_dictionary(dictionary, use=True)
+
+
+class ParallelCompressor:
+    # Write-only file-like object. Everything written to it is split into fixed size blocks,
+    # each block is compressed independently on a process pool (like pigz does) and the
+    # compressed blocks are written to fileobj in order.
+    def __init__(
+        self,
+        fileobj,
+        codec: str = "gzip",
+        level: int = -1,
+        workers: int = 0,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        dictionary: Optional[bytes] = None
+    ):
+        self.fileobj = fileobj
+        self.codec = get_codec(codec)
+        self.level = self.codec.default_level if level < 0 else level
+        if not self.codec.min_level <= self.level <= self.codec.max_level:
+            raise CriticalError(
+                f"Invalid {self.codec.name} compression level {self.level} "
+                f"({self.codec.min_level}-{self.codec.max_level})"
+            )
+        if block_size <= 0:
+            raise CriticalError(f"Invalid archive block size {block_size}")
+        if self.codec.needs_dictionary and dictionary is None:
+            raise CriticalError(f"The {self.codec.name} archive codec needs a dictionary")
+        self.dictionary_id = self.codec.add_dictionary(dictionary, use=True) if self.codec.needs_dictionary else 0
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.blocks = 0
+        # Where each block starts in the uncompressed and in the compressed stream
+        self.block_offsets = array("Q")
+        self.block_positions = array("Q")
+        self.closed = False
+        self._buffer = bytearray()
+        # Offsets of the uncompressed stream where a block must end (see end_block)
+        self._boundaries: Deque[int] = deque()
+        self._pending: Deque[Future] = deque()
+        self._executor: Optional[Executor] = None
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                initializer=_use_dictionary if self.dictionary_id else None,
+                initargs=(self.codec.name, dictionary) if self.dictionary_id else ()
+            )
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed ParallelCompressor")
+        self._buffer += data
+        self._submit_full_blocks()
+        return len(data)
+
+    def end_block(self, offset: int) -> None:
+        # The block that contains offset (of the uncompressed stream) ends there, even if
+        # it's smaller than block_size. Used to start a new block with every tar member.
+        # The data may not have been written yet (tarfile buffers it).
+        if offset > self.bytes_in and (not self._boundaries or offset > self._boundaries[-1]):
+            self._boundaries.append(offset)
+            self._submit_full_blocks()
+
+    def _submit_full_blocks(self) -> None:
+        while True:
+            while self._boundaries and self._boundaries[0] <= self.bytes_in:
+                self._boundaries.popleft()
+            size = min(self.block_size, self._boundaries[0] - self.bytes_in) if self._boundaries else self.block_size
+            if len(self._buffer) < size:
+                return
+            block = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._submit(block)
+
+    def _submit(self, block: bytes) -> None:
+        # Blocks are written in the same order they are submitted
+        self.block_offsets.append(self.bytes_in)
+        self.bytes_in += len(block)
+        if self._executor is None:
+            self._write_block(self.codec.compress(block, self.level))
+            return
+        self._pending.append(self._executor.submit(_compress_block, self.codec.name, self.level, block))
+        # Keep at most two blocks per worker in flight, so memory usage is bounded
+        # no matter how fast the tar stream is produced
+        while len(self._pending) >= self.workers * 2:
+            self._write_block(self._pending.popleft().result())
+
+    def _write_block(self, compressed: bytes) -> None:
+        self.block_positions.append(self.bytes_out)
+        self.fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+        self.blocks += 1
+
+    def flush(self) -> None:
+        # Partial blocks are kept in the buffer, flushing them would produce tiny members
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_block(self._pending.popleft().result())
+            self.fileobj.flush()
+        finally:
+            self.closed = True
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not write a truncated archive tail on errors, just tear down the pool
+            self.closed = True
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+
+def codec_from_config(config, replays: bool = True) -> str:
+    # The replay dictionary is of no use for anything else (database dumps, assets), they use plain zstd
+    codec = get_codec(config["ARCHIVE_CODEC"])
+    return ZstdCodec.name if codec.needs_dictionary and not replays else codec.name
+
+
+def compressor_from_config(fileobj, config, replays: bool = True) -> ParallelCompressor:
+    # dictionaries imports scanner, which imports this module
+    import dictionaries
+
+    codec = codec_from_config(config, replays)
+    return ParallelCompressor(
+        fileobj,
+        codec=codec,
+        level=config["ARCHIVE_LEVEL"],
+        workers=config["ARCHIVE_WORKERS"],
+        block_size=config["ARCHIVE_BLOCK_SIZE"],
+        dictionary=dictionaries.load(config) if get_codec(codec).needs_dictionary else None
+    )
+
+
+class TarMember(NamedTuple):
+    path: str
+    arcname: str
+    # If size and mtime are known already (eg: from a scandir pass), the file is not stat'd again
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+
+
+class MemberIndex:
+    # Sidecar index of an archive, saved as {archive}.idx. Since every block of the archive
+    # is compressed independently, a single member can be restored by fetching and
+    # decompressing only the blocks that contain its data.
+    #
+    # Format: header, block offsets and positions (u64 arrays), member data offsets and
+    # sizes in the uncompressed tar stream (u64 arrays), member names ("\n" separated utf-8)
+    MAGIC = b"OIMI"
+    VERSION = 2
+    # Version 1 had 8 bytes for the codec name and no dictionary id
+    HEADER_V1 = struct.Struct("<4sB3x8sQQQQQ")
+    HEADER = struct.Struct("<4sB3x16sQQQQQI4x")
+
+    def __init__(self, codec: str = ""):
+        self.codec = codec
+        # Id of the zstd dictionary the blocks are compressed with (see dictionaries.py), 0 if none
+        self.dictionary = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.block_offsets = array("Q")
+        self.block_positions = array("Q")
+        self.offsets = array("Q")
+        self.sizes = array("Q")
+        # Names are kept in a single buffer, python strings would take way more memory
+        self._names = bytearray(b"\n")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def add_member(self, name: str, offset: int, size: int) -> None:
+        self._names += name.encode("utf-8") + b"\n"
+        self.offsets.append(offset)
+        self.sizes.append(size)
+
+    def set_blocks(self, compressor: ParallelCompressor) -> None:
+        self.codec = compressor.codec.name
+        self.dictionary = compressor.dictionary_id
+        self.bytes_in = compressor.bytes_in
+        self.bytes_out = compressor.bytes_out
+        self.block_offsets = compressor.block_offsets
+        self.block_positions = compressor.block_positions
+
+    def find(self, name: str) -> Optional[Tuple[int, int]]:
+        # Returns the (offset, size) of the member's data in the uncompressed stream
+        pos = self._names.find(b"\n" + name.encode("utf-8") + b"\n")
+        if pos < 0:
+            return None
+        i = self._names.count(b"\n", 0, pos)
+        return self.offsets[i], self.sizes[i]
+
+    def compressed_range(self, offset: int, size: int) -> Tuple[int, int, int, int]:
+        # Returns (first block, last block + 1, start, end) of the compressed bytes
+        # that contain [offset, offset + size) of the uncompressed stream
+        first = bisect_right(self.block_offsets, offset) - 1
+        last = bisect_right(self.block_offsets, offset + max(size, 1) - 1)
+        end = self.block_positions[last] if last < len(self.block_positions) else self.bytes_out
+        return first, last, self.block_positions[first], end
+
+    def extract(self, offset: int, size: int, compressed: bytes, first: int, last: int) -> bytes:
+        # Decompresses the blocks [first, last) (compressed contains exactly those) and
+        # returns [offset, offset + size) of the uncompressed stream
+        codec = get_codec(self.codec)
+        base = self.block_positions[first]
+        data = bytearray()
+        for i in range(first, last):
+            start = self.block_positions[i] - base
+            end = (self.block_positions[i + 1] if i + 1 < len(self.block_positions) else self.bytes_out) - base
+            data += codec.decompress(compressed[start:end])
+        skip = offset - self.block_offsets[first]
+        return bytes(data[skip:skip + size])
+
+    def to_bytes(self) -> bytes:
+        return b"".join((
+            self.HEADER.pack(
+                self.MAGIC, self.VERSION, self.codec.encode("ascii"), self.bytes_in, self.bytes_out,
+                len(self.block_offsets), len(self.offsets), len(self._names), self.dictionary
+            ),
+            self.block_offsets.tobytes(),
+            self.block_positions.tobytes(),
+            self.offsets.tobytes(),
+            self.sizes.tobytes(),
+            bytes(self._names),
+        ))
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MemberIndex":
+        magic, version = struct.unpack_from("<4sB", data)
+        if magic != cls.MAGIC or version not in (1, cls.VERSION):
+            raise ValueError("Not an archive member index")
+        header = cls.HEADER if version == cls.VERSION else cls.HEADER_V1
+        magic, version, codec, bytes_in, bytes_out, blocks, members, names_size, *dictionary = header.unpack_from(data)
+        index = cls(codec.rstrip(b"\0").decode("ascii"))
+        index.dictionary = dictionary[0] if dictionary else 0
+        index.bytes_in = bytes_in
+        index.bytes_out = bytes_out
+        pos = header.size
+        for arr, count in (
+            (index.block_offsets, blocks),
+            (index.block_positions, blocks),
+            (index.offsets, members),
+            (index.sizes, members)
+        ):
+            arr.frombytes(data[pos:pos + count * 8])
+            pos += count * 8
+        index._names = bytearray(data[pos:pos + names_size])
+        if len(index._names) != names_size:
+            raise ValueError("Truncated archive member index")
+        return index
+
+    @classmethod
+    def load(cls, path: str) -> "MemberIndex":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+def member_index_name(archive_name: str) -> str:
+    return f"{archive_name}.idx"
+
+
+def write_tar(
+    compressor: ParallelCompressor,
+    members: Iterable[TarMember],
+    member_index: Optional[MemberIndex] = None,
+    skip_missing: bool = False
+) -> int:
+    # The tar is written in stream mode, so it never seeks the underlying file
+    # and can be fed into any writable object. Returns the number of members added.
+    # If member_index is given, the position of every member is recorded in it.
+    # With skip_missing, files that have been deleted in the meantime are left out instead of failing.
+    count = 0
+    with compressor:
+        with tarfile.open(fileobj=compressor, mode="w|") as tar:
+            for member in members:
+                try:
+                    if member.size is None:
+                        info = tar.gettarinfo(member.path, member.arcname)
+                        # Whole seconds, a float mtime would add a pax header to every member
+                        info.mtime = int(info.mtime)
+                        if info.isreg():
+                            with open(member.path, "rb") as f:
+                                tar.addfile(info, f)
+                        else:
+                            tar.addfile(info)
+                        size = info.size
+                    else:
+                        info = tarfile.TarInfo(member.arcname)
+                        info.size = member.size
+                        info.mtime = int(member.mtime or 0)
+                        info.mode = 0o644
+                        with open(member.path, "rb") as f:
+                            tar.addfile(info, f)
+                        size = member.size
+                except FileNotFoundError:
+                    # Nothing has been written yet, both fail before that
+                    if not skip_missing:
+                        raise
+                    continue
+                # TarFile keeps the TarInfo of every member it writes, but we never read
+                # them back. With millions of replays they'd add up to gigabytes.
+                tar.members.clear()
+                if compressor.codec.frame_per_member:
+                    compressor.end_block(tar.offset)
+                if member_index is not None:
+                    # Member data is padded to the tar block size
+                    padded_size = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+                    member_index.add_member(member.arcname, tar.offset - padded_size, size)
+                count += 1
+    if member_index is not None:
+        member_index.set_blocks(compressor)
+    return count
@@ -0,0 +1,418 @@
+import argparse
+import html
+import os
+import stat
+import struct
+import sys
+import tempfile
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Deque, Iterator, List, NamedTuple, Optional, Tuple
+
+import archive
+import dedup
+import oiseau
+import utils
+from config import Config, get_config
+from exceptions import CriticalError
+from utils import printc
+
+# Incremental backups of the assets that are not replays (avatars, screenshots, profile backgrounds).
+#
+# Every asset folder has a journal with the path, size, mtime and hash of each of its files, sorted
+# by path. A run walks the folder in the same order and merges the walk with the journal, so only
+# files whose size or mtime changed are read (and hashed) and memory doesn't grow with the number
+# of files. New files and files whose content changed go in an incremental archive, along with the
+# list of the files that have been deleted since the previous run. Every ASSETS_FULL_INTERVAL days
+# a full archive, with all the files, is made instead.
+#
+# The journal is a 32 bytes header followed by one record per file: path length (u16), size (u64),
+# mtime in ns (i64), digest, and the utf-8 path.
+
+ASSETS = ("avatars", "screenshots", "profile_backgrounds")
+
+# Last member of incremental archives, lists the files deleted since the previous archive (one member name per line)
+DELETED_MEMBER = ".deleted"
+
+MAGIC = b"OIAJ"
+VERSION = 1
+HEADER = struct.Struct("<4sBB2xQQI4x")
+RECORD = struct.Struct(f"<HQq{dedup.DIGEST_SIZE}s")
+
+NEW, CHANGED, UNCHANGED, DELETED = range(4)
+
+
+class JournalEntry(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    digest: bytes
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        # Unix time of the last full archive, 0 if there's none
+        self.last_full = 0
+        # Number of archives made so far
+        self.sequence = 0
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise ValueError(f"{path} is truncated")
+            magic, version, digest_size, self.count, self.last_full, self.sequence = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or digest_size != dedup.DIGEST_SIZE:
+                raise ValueError(f"{path} is not a valid asset journal")
+
+    def entries(self) -> Iterator[JournalEntry]:
+        if not self.count:
+            return
+        with open(self.path, "rb", buffering=1024 * 1024) as f:
+            f.seek(HEADER.size)
+            for _ in range(self.count):
+                record = f.read(RECORD.size)
+                if len(record) != RECORD.size:
+                    raise ValueError(f"{self.path} is truncated")
+                path_length, size, mtime_ns, digest = RECORD.unpack(record)
+                yield JournalEntry(f.read(path_length).decode("utf-8", "surrogateescape"), size, mtime_ns, digest)
+
+
+class JournalWriter:
+    # Writes the new journal next to the old one, which is replaced only by commit()
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.count = 0
+        self._f = open(self.tmp_path, "wb", buffering=1024 * 1024)
+        # Written for real by close(), once we know the count
+        self._f.write(bytes(HEADER.size))
+
+    def write(self, entry: JournalEntry) -> None:
+        path = entry.path.encode("utf-8", "surrogateescape")
+        self._f.write(RECORD.pack(len(path), entry.size, entry.mtime_ns, entry.digest))
+        self._f.write(path)
+        self.count += 1
+
+    def close(self, last_full: int, sequence: int) -> None:
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, VERSION, dedup.DIGEST_SIZE, self.count, last_full, sequence))
+        self._f.close()
+
+    def commit(self) -> None:
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        self._f.close()
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _key(path: str) -> List[str]:
+    # Journal order: by path component, so the content of a directory sorts where its name does
+    return path.split("/")
+
+
+def walk(folder: str, prefix: str = "") -> Iterator[Tuple[str, int, int]]:
+    # Yields (relative path, size, mtime_ns) of the regular files in folder, in journal order.
+    # Each directory's names are sorted in memory, that's the only thing that grows with the
+    # number of files (~60 bytes per file for a flat folder).
+    names = []
+    try:
+        with os.scandir(os.path.join(folder, prefix)) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    names.append(entry.name + "/")
+                elif entry.is_file(follow_symlinks=False):
+                    names.append(entry.name)
+    except FileNotFoundError:
+        # Deleted while we were walking its parent
+        return
+    names.sort(key=lambda x: x[:-1] if x.endswith("/") else x)
+    for name in names:
+        if name.endswith("/"):
+            yield from walk(folder, prefix + name)
+            continue
+        try:
+            st = os.lstat(os.path.join(folder, prefix, name))
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            yield prefix + name, st.st_size, st.st_mtime_ns
+
+
+def diff(
+    files: Iterator[Tuple[str, int, int]],
+    entries: Iterator[JournalEntry]
+) -> Iterator[Tuple[int, Optional[Tuple[str, int, int]], Optional[JournalEntry]]]:
+    # Merges a walk with the journal, both in journal order.
+    # Yields (status, file, journal entry), file is None for DELETED and the entry is None for NEW.
+    old = next(entries, None)
+    old_key = _key(old.path) if old is not None else None
+    for file in files:
+        key = _key(file[0])
+        while old is not None and old_key < key:
+            yield DELETED, None, old
+            old = next(entries, None)
+            old_key = _key(old.path) if old is not None else None
+        if old is not None and old_key == key:
+            yield UNCHANGED if (old.size, old.mtime_ns) == file[1:] else CHANGED, file, old
+            old = next(entries, None)
+            old_key = _key(old.path) if old is not None else None
+        else:
+            yield NEW, file, None
+    while old is not None:
+        yield DELETED, None, old
+        old = next(entries, None)
+
+
+def _digest(path: str) -> Optional[bytes]:
+    try:
+        return dedup.file_digest(path)
+    except FileNotFoundError:
+        return None
+
+
+class AssetBackup:
+    def __init__(
+        self,
+        asset: str,
+        folder: str,
+        journal_path: str,
+        *,
+        full_interval: float,
+        force_full: bool = False,
+        hash_workers: int = 4
+    ):
+        self.asset = asset
+        self.folder = folder
+        self.journal = Journal(journal_path)
+        self.full = (
+            force_full
+            or not self.journal.last_full
+            or time.time() - self.journal.last_full >= full_interval
+        )
+        self.hash_workers = max(1, hash_workers)
+        self.writer: Optional[JournalWriter] = None
+        # Archive path, None if there was nothing to archive
+        self.path: Optional[str] = None
+        self.files = self.new = self.changed = self.deleted = self.archived = 0
+        self.bytes_in = self.bytes_out = 0
+        self.elapsed = 0.0
+        self._deleted_list = None
+
+    @property
+    def kind(self) -> str:
+        return "full" if self.full else "incremental"
+
+    def _resolve(self, status: int, file: Tuple[str, int, int], old: Optional[JournalEntry], future: Optional[Future]):
+        path, size, mtime_ns = file
+        if future is None:
+            digest = old.digest
+        else:
+            digest = future.result()
+            if digest is None:
+                # Deleted in the meantime, it'll be missing from the journal as well
+                return
+        self.writer.write(JournalEntry(path, size, mtime_ns, digest))
+        if status == NEW:
+            self.new += 1
+        elif status == CHANGED and digest != old.digest:
+            self.changed += 1
+        elif not self.full:
+            # Unchanged, or touched without changing its content
+            return
+        self.archived += 1
+        yield archive.TarMember(os.path.join(self.folder, path), f"{self.asset}/{path}")
+
+    def members(self, executor: ThreadPoolExecutor) -> Iterator[archive.TarMember]:
+        # Files are hashed on the executor, but the journal is written (and files are archived)
+        # in walk order. Files whose size and mtime didn't change keep their digest.
+        pending: Deque[Tuple[int, Tuple[str, int, int], Optional[JournalEntry], Optional[Future]]] = deque()
+        max_pending = self.hash_workers * 64
+        for status, file, old in diff(walk(self.folder), self.journal.entries()):
+            if status == DELETED:
+                self.deleted += 1
+                if not self.full:
+                    self._deleted_list.write(f"{self.asset}/{old.path}\n".encode("utf-8", "surrogateescape"))
+                continue
+            self.files += 1
+            future = None
+            if status != UNCHANGED:
+                future = executor.submit(_digest, os.path.join(self.folder, file[0]))
+            pending.append((status, file, old, future))
+            while pending and (len(pending) > max_pending or pending[0][3] is None or pending[0][3].done()):
+                yield from self._resolve(*pending.popleft())
+        while pending:
+            yield from self._resolve(*pending.popleft())
+        if self.deleted and not self.full:
+            self._deleted_list.flush()
+            yield archive.TarMember(self._deleted_list.name, f"{self.asset}/{DELETED_MEMBER}")
+
+    def build(self, path: str, config: Config) -> None:
+        # Writes the archive to path (if there's something to archive) and the new journal next to the
+        # old one. Nothing is replaced until commit(), so a failed upload is simply retried next time.
+        start = time.monotonic()
+        self.writer = JournalWriter(self.journal.path)
+        member_index = archive.MemberIndex() if config["ARCHIVE_MEMBER_INDEX"] else None
+        try:
+            with tempfile.NamedTemporaryFile(prefix=f"oiseau_{self.asset}_deleted_") as self._deleted_list:
+                with ThreadPoolExecutor(self.hash_workers) as executor, open(f"{path}.tmp", "wb") as f:
+                    compressor = archive.compressor_from_config(f, config, replays=False)
+                    archive.write_tar(compressor, self.members(executor), member_index, skip_missing=True)
+        except BaseException:
+            self.writer.discard()
+            if os.path.isfile(f"{path}.tmp"):
+                os.remove(f"{path}.tmp")
+            raise
+        self.bytes_in = compressor.bytes_in
+        self.bytes_out = compressor.bytes_out
+        if self.archived or (self.deleted and not self.full):
+            if member_index is not None:
+                member_index.save(archive.member_index_name(path))
+            os.replace(f"{path}.tmp", path)
+            self.path = path
+        else:
+            os.remove(f"{path}.tmp")
+        self.writer.close(
+            int(time.time()) if self.full else self.journal.last_full,
+            self.journal.sequence + 1 if self.path is not None else self.journal.sequence
+        )
+        self.elapsed = time.monotonic() - start
+
+    def commit(self) -> None:
+        self.writer.commit()
+
+    def discard(self) -> None:
+        # The backup failed. The next attempt builds an archive with a new name, don't leave this one behind.
+        if self.writer is not None:
+            self.writer.discard()
+        if self.path is not None:
+            for x in (self.path, archive.member_index_name(self.path)):
+                if os.path.isfile(x):
+                    os.remove(x)
+
+
+def configured_assets(config: Config, names: Optional[List[str]] = None) -> List[Tuple[str, str]]:
+    # (asset, folder) of the assets that are enabled (SYNC_*) and have a folder (*_FOLDER)
+    result = []
+    for asset in ASSETS:
+        if names and asset not in names:
+            continue
+        if not config[f"SYNC_{asset.upper()}"] or not config[f"{asset.upper()}_FOLDER"]:
+            continue
+        folder = os.path.expanduser(config[f"{asset.upper()}_FOLDER"])
+        # An unmounted folder would look like every file has been deleted
+        if not os.path.isdir(folder):
+            raise CriticalError(f"{asset} folder {folder} does not exist")
+        result.append((asset, folder))
+    return result
+
+
+def backup_assets(state: oiseau.BackupState, names: Optional[List[str]] = None, full: bool = False) -> bool:
+    # Walks the asset folders in parallel, uploading each archive as soon as it's ready.
+    # Returns True if every asset has been backed up.
+    config = state.config
+    assets = configured_assets(config, names)
+    if not assets:
+        printc("* No assets to back up", utils.BColors.YELLOW)
+        return True
+    pipeline = oiseau.Pipeline(state)
+    if not pipeline.connect():
+        return False
+
+    os.makedirs(config["ASSETS_JOURNAL_FOLDER"], exist_ok=True)
+    the_time = int(time.time())
+    extension = archive.get_codec(config["ARCHIVE_CODEC"]).extension
+    try:
+        backups = [
+            AssetBackup(
+                asset,
+                folder,
+                os.path.join(config["ASSETS_JOURNAL_FOLDER"], f"{asset}.journal"),
+                full_interval=config["ASSETS_FULL_INTERVAL"] * 86400,
+                force_full=full,
+                hash_workers=config["ASSETS_HASH_WORKERS"]
+            ) for asset, folder in assets
+        ]
+    except ValueError as e:
+        raise CriticalError(f"Cannot read the asset journal ({e})")
+
+    ok = True
+    summary = []
+    with ThreadPoolExecutor(len(backups)) as executor:
+        futures = {
+            executor.submit(
+                x.build,
+                f"{the_time}_{x.asset}_{'full' if x.full else 'incr'}_{x.journal.sequence + 1}.{extension}",
+                config
+            ): x for x in backups
+        }
+        for future in as_completed(futures):
+            backup = futures[future]
+            try:
+                future.result()
+                if backup.path is not None:
+                    printc(
+                        f"* {backup.path} created ({backup.archived} files, {backup.deleted} deleted, "
+                        f"{backup.bytes_out / 1024 / 1024:.2f} MB in {backup.elapsed:.1f} s). Now uploading.",
+                        utils.BColors.BLUE
+                    )
+                    oiseau.upload_archive(state, pipeline.ftp_credentials, backup.path)
+                    # The files are still in the asset folder, no need to keep the archive around
+                    os.remove(backup.path)
+                    if os.path.isfile(archive.member_index_name(backup.path)):
+                        os.remove(archive.member_index_name(backup.path))
+                backup.commit()
+            except Exception as e:
+                ok = False
+                backup.discard()
+                printc(f"# Could not back up {backup.asset} ({e})", utils.BColors.RED)
+                utils.telegram_notify(
+                    f"<b>Could not back up {backup.asset}.</b>\n\n<code>{html.escape(str(e))}</code>",
+                    prefix=utils.TelegramPrefixes.ERROR
+                )
+                continue
+            line = (
+                f"{backup.asset}: {backup.files} files, {backup.new} new, {backup.changed} changed, "
+                f"{backup.deleted} deleted ({backup.kind})"
+            )
+            summary.append(line)
+            printc(f"* Done backing up {line}", utils.BColors.GREEN)
+    if summary:
+        utils.telegram_notify("Assets backup done\n\n" + "\n".join(summary))
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Incremental backup of avatars, screenshots and profile backgrounds")
+    parser.add_argument("--asset", action="append", choices=ASSETS, help="back up only this asset (can be repeated)")
+    parser.add_argument("--full", action="store_true", help="make full archives, whatever ASSETS_FULL_INTERVAL says")
+    args = parser.parse_args(argv)
+
+    oiseau.print_banner()
+    state = oiseau.BackupState(get_config())
+    try:
+        return 0 if backup_assets(state, args.asset, args.full) else 1
+    except CriticalError as e:
+        printc("# {}".format(e.message), utils.BColors.RED + utils.BColors.BOLD)
+        utils.telegram_notify(
+            "<b>Critical error during assets backup.</b>\n\n<code>{}</code>".format(e.message),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    except Exception as e:
+        printc("# Unknown error while backing up assets ({})".format(str(e)), utils.BColors.RED)
+        utils.telegram_notify(
+            "<b>Unhandled exception during assets backup.</b>\n\n<code>{}</code>".format(
+                html.escape(traceback.format_exc())
+            ),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    return -1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
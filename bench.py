@@ -0,0 +1,637 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import archive
+import c14_index
+import dedup
+import dictionaries
+import ftp
+import rclone
+import scanner
+import sharding
+
+
+def _osr_string(s: str) -> bytes:
+    # osu! string: 0x0b, ULEB128 length, utf-8 bytes
+    data = s.encode("utf-8")
+    length = len(data)
+    uleb = bytearray()
+    while True:
+        b = length & 0x7F
+        length >>= 7
+        if length:
+            uleb.append(b | 0x80)
+        else:
+            uleb.append(b)
+            break
+    return b"\x0b" + bytes(uleb) + data
+
+
+def synthetic_replay(rng: random.Random, replay_id: int, size: int) -> bytes:
+    # Something that looks like a real .osr file: a structured header with values
+    # drawn from small pools (so files share a lot of bytes, like real replays do)
+    # followed by an incompressible blob standing in for the LZMA replay frames
+    beatmap_md5 = "{:032x}".format(rng.randrange(64))
+    player = "player{}".format(rng.randrange(256))
+    life_bar = ",".join("{}|{:.2f}".format(t * 2000, rng.random()) for t in range(rng.randrange(4, 32)))
+    header = b"".join((
+        struct.pack("<bi", rng.randrange(4), 20200101),
+        _osr_string(beatmap_md5),
+        _osr_string(player),
+        _osr_string("{:032x}".format(rng.getrandbits(128))),
+        struct.pack("<6hiHbi", *(rng.randrange(2000) for _ in range(6)), rng.randrange(10 ** 7), rng.randrange(3000), 0, 0),
+        _osr_string(life_bar),
+        struct.pack("<q", 637000000000000000 + replay_id),
+    ))
+    blob_size = max(0, size - len(header) - 12)
+    blob = rng.getrandbits(blob_size * 8).to_bytes(blob_size, "little") if blob_size else b""
+    return header + struct.pack("<i", blob_size) + blob + struct.pack("<q", replay_id)
+
+
+def generate_corpus(
+    path: str,
+    count: int,
+    median_size: int,
+    *,
+    seed: int = 0,
+    first_id: int = 1,
+    sigma: float = 0.5
+) -> int:
+    # Deterministic for a given (count, median_size, seed, sigma): sizes follow a log-normal
+    # distribution around median_size (sigma=0 makes them all the same). Returns the total number of bytes written.
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    total = 0
+    for replay_id in range(first_id, first_id + count):
+        size = max(256, int(rng.lognormvariate(0, sigma) * median_size))
+        data = synthetic_replay(rng, replay_id, size)
+        with open(os.path.join(path, f"replay_{replay_id}.osr"), "wb") as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+def bench_archive(corpus: str, codecs: List[str], workers: List[int], levels: List[int], block_size: int) -> List[Dict[str, Any]]:
+    members = [archive.TarMember(os.path.join(corpus, x), x) for x in sorted(os.listdir(corpus))]
+    results = []
+    for codec in codecs:
+        for level in levels:
+            for w in workers:
+                with tempfile.TemporaryFile() as f:
+                    compressor = archive.ParallelCompressor(f, codec=codec, level=level, workers=w, block_size=block_size)
+                    wall = time.perf_counter()
+                    cpu = time.process_time()
+                    archive.write_tar(compressor, members)
+                    wall = time.perf_counter() - wall
+                    cpu = time.process_time() - cpu
+                results.append({
+                    "codec": codec,
+                    "level": compressor.level,
+                    "workers": compressor.workers,
+                    "block_size": block_size,
+                    "files": len(members),
+                    "bytes_in": compressor.bytes_in,
+                    "bytes_out": compressor.bytes_out,
+                    "ratio": round(compressor.ratio, 4),
+                    "wall_s": round(wall, 4),
+                    # Parent process only, the workers are not accounted for
+                    "cpu_s": round(cpu, 4),
+                    "mb_s": round(compressor.bytes_in / 1024 / 1024 / wall, 2) if wall else 0,
+                })
+    return results
+
+
+def bench_dictionary(
+    corpus: str,
+    level: int,
+    workers: int,
+    block_size: int,
+    dict_size: int,
+    samples: int,
+    restores: int,
+    seed: int
+) -> List[Dict[str, Any]]:
+    # The zstd-dict codec against tarfile's "w:gz" (what oiseau used to write) and the block codecs.
+    # ratio is against the size of the replays, so tar overhead counts too. restore_bytes is what
+    # restoring a single replay downloads: the whole archive without a member index, its blocks with one.
+    members = [archive.TarMember(os.path.join(corpus, x), x) for x in sorted(os.listdir(corpus))]
+    files_bytes = sum(os.path.getsize(x.path) for x in members)
+    rng = random.Random(seed)
+    restore_members = rng.sample(members, min(restores, len(members)))
+    results = []
+
+    with tempfile.TemporaryFile() as f:
+        wall = time.perf_counter()
+        with tarfile.open(fileobj=f, mode="w:gz") as tar:
+            for member in members:
+                tar.add(member.path, member.arcname)
+        wall = time.perf_counter() - wall
+        bytes_out = f.tell()
+    results.append({
+        "codec": "tarfile-gz",
+        "files": len(members),
+        "bytes": files_bytes,
+        "bytes_out": bytes_out,
+        "ratio": round(bytes_out / files_bytes, 4),
+        "wall_s": round(wall, 4),
+        "mb_s": round(files_bytes / 1024 / 1024 / wall, 2) if wall else 0,
+        "restore_bytes": bytes_out,
+    })
+
+    for codec in ("gzip", "zstd", "zstd-dict"):
+        if not archive.CODECS[codec].available:
+            continue
+        dictionary = None
+        train = 0.0
+        if archive.CODECS[codec].needs_dictionary:
+            train = time.perf_counter()
+            dictionary = dictionaries.train(dictionaries.sample_replays(corpus, samples, rng), dict_size)
+            train = time.perf_counter() - train
+        index = archive.MemberIndex()
+        with tempfile.TemporaryFile() as f:
+            compressor = archive.ParallelCompressor(
+                f, codec=codec, level=level, workers=workers, block_size=block_size, dictionary=dictionary
+            )
+            wall = time.perf_counter()
+            archive.write_tar(compressor, members, index)
+            wall = time.perf_counter() - wall
+            restore_bytes = 0
+            restore_time = 0.0
+            for member in restore_members:
+                offset, size = index.find(member.arcname)
+                first, last, start, end = index.compressed_range(offset, size)
+                f.seek(start)
+                compressed = f.read(end - start)
+                restore_bytes += len(compressed)
+                t = time.perf_counter()
+                index.extract(offset, size, compressed, first, last)
+                restore_time += time.perf_counter() - t
+        results.append({
+            "codec": codec,
+            "level": compressor.level,
+            "workers": compressor.workers,
+            "block_size": block_size,
+            "files": len(members),
+            "bytes": files_bytes,
+            "bytes_out": compressor.bytes_out,
+            "ratio": round(compressor.bytes_out / files_bytes, 4),
+            "wall_s": round(wall, 4),
+            "mb_s": round(files_bytes / 1024 / 1024 / wall, 2) if wall else 0,
+            "train_s": round(train, 4),
+            "dict_size": len(dictionary) if dictionary is not None else 0,
+            "restore_bytes": restore_bytes // len(restore_members) if restore_members else 0,
+            "restore_ms": round(restore_time * 1000 / len(restore_members), 3) if restore_members else 0,
+        })
+    return results
+
+
+def bench_shards(corpus: str, codec: str, shard_counts: List[int], workers: List[int], block_size: int) -> List[Dict[str, Any]]:
+    manifest = scanner.Manifest.scan(corpus)
+    results = []
+    with tempfile.TemporaryDirectory() as out:
+        config = {
+            "ARCHIVE_CODEC": codec,
+            "ARCHIVE_LEVEL": -1,
+            "ARCHIVE_BLOCK_SIZE": block_size,
+            "ARCHIVE_MEMBER_INDEX": True,
+            "ARCHIVE_WORKERS": 1,
+            "VERIFY_UPLOADS": True,
+        }
+        for count in shard_counts:
+            for w in workers:
+                shard_size = -(-manifest.total_size // count)
+                shards = [
+                    x._replace(name=os.path.join(out, x.name))
+                    for x in sharding.make_shards(manifest, shard_size, 0, 1, archive.get_codec(codec).extension)
+                ]
+                wall = time.perf_counter()
+                built = list(sharding.build_shards(shards, config, w))
+                wall = time.perf_counter() - wall
+                bytes_in = sum(x.bytes_in for x in built)
+                results.append({
+                    "codec": codec,
+                    "shards": len(shards),
+                    "workers": w,
+                    "files": manifest.file_count,
+                    "bytes_in": bytes_in,
+                    "bytes_out": sum(x.bytes_out for x in built),
+                    "wall_s": round(wall, 4),
+                    "mb_s": round(bytes_in / 1024 / 1024 / wall, 2) if wall else 0,
+                })
+                for x in built:
+                    os.remove(x.path)
+    return results
+
+
+def _peak_rss() -> int:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_manifest(replays: int, seed: int, gap_rate: float) -> Dict[str, Any]:
+    # Memory used by the per-file bookkeeping of a backup cycle (manifest, id set and
+    # member index) for a temp folder with that many replays, without touching the disk.
+    # Run it in a fresh process, peak RSS can't go down.
+    rng = random.Random(seed)
+    baseline = _peak_rss()
+    wall = time.perf_counter()
+    manifest = scanner.Manifest("temp")
+    replay_id = 1
+    for _ in range(replays):
+        replay_id += 1 + (rng.random() < gap_rate)
+        manifest.add(scanner.replay_file_name(replay_id), 100 * 1024, 1600000000.0)
+    scan_rss = _peak_rss()
+    id_set = manifest.id_set()
+    member_index = archive.MemberIndex()
+    for member in manifest.members():
+        member_index.add_member(member.arcname, 0, member.size)
+    wall = time.perf_counter() - wall
+    peak = _peak_rss()
+    return {
+        "replays": replays,
+        "id_stats": repr(manifest.id_stats),
+        "id_set_bytes": id_set.nbytes,
+        "baseline_rss": baseline,
+        "scan_rss": scan_rss - baseline,
+        "peak_rss": peak - baseline,
+        "bytes_per_replay": round((peak - baseline) / replays, 1) if replays else 0,
+        "wall_s": round(wall, 2),
+    }
+
+
+class _Stage:
+    # Wall time, CPU time and peak RSS of one pipeline stage. CPU time includes child processes
+    # (the archive workers, rclone) once they have exited. Peak RSS is a high-water mark for the
+    # whole run, so it only grows from one stage to the next: compare it across commits, not stages.
+    def __init__(self, name: str, backend: Optional[str] = None):
+        self.name = name
+        self.backend = backend
+
+    @staticmethod
+    def _cpu() -> float:
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+    def __enter__(self) -> "_Stage":
+        self.wall = time.perf_counter()
+        self.cpu = self._cpu()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = self._cpu() - self.cpu
+
+    def result(self, bytes_count: int, files: int, **extra: Any) -> Dict[str, Any]:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        return {
+            "stage": self.name,
+            "backend": self.backend,
+            "files": files,
+            "bytes": bytes_count,
+            "wall_s": round(self.wall, 4),
+            "cpu_s": round(self.cpu, 4),
+            "peak_rss": _peak_rss(),
+            "peak_rss_children": children,
+            "mb_s": round(bytes_count / 1024 / 1024 / self.wall, 2) if self.wall else 0,
+            **extra,
+        }
+
+
+def _skipped(stage: str, backend: str, reason: str) -> Dict[str, Any]:
+    print(f"* Skipping {stage} on {backend}: {reason}", file=sys.stderr)
+    return {"stage": stage, "backend": backend, "skipped": reason}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_ftp_server(root: str) -> Optional[Tuple[subprocess.Popen, ftp.FtpCredentials]]:
+    # pyftpdlib in its own process, so its CPU time is not counted as ours. Optional, the ftp
+    # stages are skipped without it.
+    if importlib.util.find_spec("pyftpdlib") is None:
+        return None
+    credentials = ftp.FtpCredentials("127.0.0.1", _free_port(), "bench", "bench")
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "pyftpdlib", "-i", credentials.host, "-p", str(credentials.port),
+            "-w", "-d", root, "-u", credentials.user, "-P", credentials.password
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            ftp.connect(credentials).quit()
+            return server, credentials
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                server.wait()
+                return None
+            time.sleep(0.1)
+
+
+def _link_corpus(corpus: str, folder: str) -> None:
+    # Cleanup deletes what it archived, so the pipeline runs on hard links to the corpus
+    os.makedirs(folder)
+    for name in os.listdir(corpus):
+        try:
+            os.link(os.path.join(corpus, name), os.path.join(folder, name))
+        except OSError:
+            shutil.copy2(os.path.join(corpus, name), os.path.join(folder, name))
+
+
+def _write_index(path: str, archives: int) -> int:
+    index = c14_index.C14Index()
+    for archive_id in range(1, archives + 1):
+        index.append(archive_id, archive_id * 10000)
+    index.save_text(path)
+    return os.path.getsize(path)
+
+
+def bench_pipeline(
+    corpus: str,
+    *,
+    codec: str,
+    workers: int,
+    shards: int,
+    shard_workers: int,
+    block_size: int,
+    cleanup_workers: int,
+    index_archives: int,
+    use_dedup: bool,
+    backends: List[str]
+) -> List[Dict[str, Any]]:
+    # Runs the stages of a backup cycle one after the other, like oiseau.py does, against local
+    # stand-ins: a pyftpdlib server for C14 and a local folder as the rclone remote.
+    results = []
+    work = tempfile.mkdtemp(prefix="oiseau_pipeline_")
+    ftp_server = None
+    try:
+        temp = os.path.join(work, "temp")
+        out = os.path.join(work, "out")
+        download = os.path.join(work, "download")
+        remotes = {x: os.path.join(work, x) for x in backends}
+        for folder in (out, download, *remotes.values()):
+            os.makedirs(folder)
+        _link_corpus(corpus, temp)
+        index_size = 0
+        for remote in remotes.values():
+            index_size = _write_index(os.path.join(remote, "c14_index.txt"), index_archives)
+
+        credentials = None
+        if "ftp" in backends:
+            ftp_server = _start_ftp_server(remotes["ftp"])
+            if ftp_server is not None:
+                credentials = ftp_server[1]
+        have_rclone = shutil.which("rclone") is not None
+
+        with _Stage("scan") as stage:
+            if use_dedup:
+                manifest = dedup.scan(temp, dedup.DedupStore())
+            else:
+                manifest = scanner.Manifest.scan(temp)
+        results.append(stage.result(manifest.total_size, manifest.file_count, dedup=use_dedup))
+
+        for backend in backends:
+            local_index = os.path.join(download, f"{backend}_c14_index.txt")
+            if backend == "ftp" and credentials is None:
+                results.append(_skipped("index", backend, "pyftpdlib is not installed or did not start"))
+                continue
+            if backend == "rclone" and not have_rclone:
+                results.append(_skipped("index", backend, "rclone is not in PATH"))
+                continue
+            with _Stage("index", backend) as stage:
+                if backend == "ftp":
+                    session = ftp.connect(credentials)
+                    with open(local_index, "wb") as f:
+                        session.retrbinary("RETR c14_index.txt", f.write)
+                    session.quit()
+                else:
+                    rclone.run("copyto", os.path.join(remotes[backend], "c14_index.txt"), local_index)
+                index = c14_index.C14Index.load_text(local_index)
+            results.append(stage.result(index_size, 1, archives=len(index)))
+
+        config = {
+            "ARCHIVE_CODEC": codec,
+            "ARCHIVE_LEVEL": -1,
+            "ARCHIVE_BLOCK_SIZE": block_size,
+            "ARCHIVE_MEMBER_INDEX": True,
+            "ARCHIVE_WORKERS": workers,
+            # Archives are hashed while they're written, for the upload verification
+            "VERIFY_UPLOADS": True,
+        }
+        shard_size = -(-manifest.total_size // shards) if shards > 1 else 0
+        with _Stage("archive") as stage:
+            built = list(sharding.build_shards(
+                [
+                    x._replace(name=os.path.join(out, x.name))
+                    for x in sharding.make_shards(manifest, shard_size, 0, 1, archive.get_codec(codec).extension)
+                ],
+                config,
+                shard_workers
+            ))
+        bytes_out = sum(x.bytes_out for x in built)
+        results.append(stage.result(
+            sum(x.bytes_in for x in built),
+            sum(x.files for x in built),
+            codec=codec,
+            workers=workers,
+            shards=len(built),
+            bytes_out=bytes_out
+        ))
+
+        uploads = []
+        for x in built:
+            uploads.append(x.path)
+            if os.path.isfile(archive.member_index_name(x.path)):
+                uploads.append(archive.member_index_name(x.path))
+        upload_size = sum(os.path.getsize(x) for x in uploads)
+        for backend in backends:
+            if backend == "ftp" and credentials is None:
+                results.append(_skipped("upload", backend, "pyftpdlib is not installed or did not start"))
+                continue
+            if backend == "rclone" and not have_rclone:
+                results.append(_skipped("upload", backend, "rclone is not in PATH"))
+                continue
+            with _Stage("upload", backend) as stage:
+                for path in uploads:
+                    if backend == "ftp":
+                        ftp.upload_with_retries(credentials, path, os.path.basename(path), retries=0)
+                    else:
+                        rclone.run("copy", path, remotes[backend])
+            results.append(stage.result(upload_size, len(uploads)))
+
+        with _Stage("cleanup") as stage:
+            cleanup = scanner.remove_unchanged(manifest, workers=cleanup_workers)
+        results.append(stage.result(0, cleanup.deleted, files_s=round(cleanup.rate)))
+    finally:
+        if ftp_server is not None:
+            ftp_server[0].terminate()
+            ftp_server[0].wait()
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def run_info(args: argparse.Namespace) -> Dict[str, Any]:
+    # Everything needed to tell whether two results can be compared
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k != "json"},
+        "time": int(time.time()),
+    }
+
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+def _str_list(s: str) -> List[str]:
+    return [x.strip() for x in s.split(",") if x.strip()]
+
+
+def _run_corpus_bench(parser: argparse.ArgumentParser, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    corpus = args.corpus
+    temp_corpus = corpus is None
+    if temp_corpus:
+        corpus = tempfile.mkdtemp(prefix="oiseau_bench_")
+    try:
+        os.makedirs(corpus, exist_ok=True)
+        if not os.listdir(corpus):
+            print(f"* Generating {args.files} synthetic replays in {corpus}", file=sys.stderr)
+            generate_corpus(corpus, args.files, args.size, seed=args.seed, sigma=args.size_sigma)
+
+        if args.command == "archive":
+            codecs = [x for x in args.codecs if archive.CODECS.get(x) is not None and archive.CODECS[x].available]
+            results = bench_archive(corpus, codecs, args.workers, args.levels, args.block_size)
+        elif args.command == "dictionary":
+            results = bench_dictionary(
+                corpus,
+                level=args.level,
+                workers=args.workers,
+                block_size=args.block_size,
+                dict_size=args.dict_size,
+                samples=args.samples,
+                restores=args.restores,
+                seed=args.seed
+            )
+        elif args.command == "shards":
+            results = bench_shards(corpus, args.codec, args.shards, args.workers, args.block_size)
+        elif args.command == "pipeline":
+            results = bench_pipeline(
+                corpus,
+                codec=args.codec,
+                workers=args.workers,
+                shards=args.shards,
+                shard_workers=args.shard_workers,
+                block_size=args.block_size,
+                cleanup_workers=args.cleanup_workers,
+                index_archives=args.index_archives,
+                use_dedup=args.dedup,
+                backends=args.backends
+            )
+        else:
+            parser.error(f"unknown command {args.command}")
+    finally:
+        if temp_corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="oiseau benchmarks")
+    parser.add_argument("--files", type=int, default=2000, help="number of synthetic replays")
+    parser.add_argument("--size", type=int, default=100 * 1024, help="median replay size, in bytes")
+    parser.add_argument("--size-sigma", type=float, default=0.5, help="spread of the log-normal size distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=None, help="use (or create) this folder instead of a temporary one")
+    parser.add_argument("--json", default=None, help="write the results to this file as well")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("archive", help="archive builder throughput")
+    p.add_argument("--codecs", type=_str_list, default=["gzip", "xz", "zstd"])
+    p.add_argument("--workers", type=_int_list, default=[1, 2, 4])
+    p.add_argument("--levels", type=_int_list, default=[-1], help="-1 is the codec default")
+    p.add_argument("--block-size", type=int, default=archive.DEFAULT_BLOCK_SIZE)
+
+    p = subparsers.add_parser("dictionary", help="zstd-dict codec against tarfile w:gz and the block codecs")
+    p.add_argument("--level", type=int, default=-1, help="-1 is the codec default")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--block-size", type=int, default=archive.DEFAULT_BLOCK_SIZE)
+    p.add_argument("--dict-size", type=int, default=112640)
+    p.add_argument("--samples", type=int, default=1000, help="replays the dictionary is trained on")
+    p.add_argument("--restores", type=int, default=100, help="single replay restores timed")
+
+    p = subparsers.add_parser("shards", help="sharded archive throughput")
+    p.add_argument("--codec", default="gzip")
+    p.add_argument("--shards", type=_int_list, default=[1, 2, 4, 8])
+    p.add_argument("--workers", type=_int_list, default=[1, 2, 4])
+    p.add_argument("--block-size", type=int, default=archive.DEFAULT_BLOCK_SIZE)
+
+    p = subparsers.add_parser("manifest", help="peak memory of the per-file bookkeeping (no corpus needed)")
+    p.add_argument("--replays", type=int, default=5000000)
+    p.add_argument("--gap-rate", type=float, default=0.05, help="probability of a missing id between two replays")
+
+    p = subparsers.add_parser("pipeline", help="time, CPU and memory of each stage of a backup cycle")
+    p.add_argument("--codec", default="gzip")
+    p.add_argument("--workers", type=int, default=0, help="ARCHIVE_WORKERS")
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--shard-workers", type=int, default=0, help="ARCHIVE_SHARD_WORKERS")
+    p.add_argument("--block-size", type=int, default=archive.DEFAULT_BLOCK_SIZE)
+    p.add_argument("--cleanup-workers", type=int, default=8)
+    p.add_argument("--index-archives", type=int, default=10000, help="lines in the downloaded c14_index.txt")
+    p.add_argument("--dedup", action="store_true", help="hash the replays while scanning")
+    p.add_argument("--backends", type=_str_list, default=["ftp", "rclone"])
+
+    args = parser.parse_args(argv)
+    info = run_info(args)
+
+    if args.command == "manifest":
+        results = [bench_manifest(args.replays, args.seed, args.gap_rate)]
+    else:
+        results = _run_corpus_bench(parser, args)
+
+    print(json.dumps({"run": info}))
+    for r in results:
+        print(json.dumps(r))
+    if args.json is not None:
+        # Still a list of results, as before the run info existed. Each one carries it.
+        with open(args.json, "w") as f:
+            json.dump([{**r, "run": info} for r in results], f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
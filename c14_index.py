@@ -0,0 +1,229 @@
+import argparse
+import io
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from typing import Iterator, List, Optional, Tuple
+
+# c14_index.txt has one "archive_id\tmax_replay_id" line per archive. Archive ids are increasing
+# and the max replay ids usually are too, so the replays in archive n are the ones in
+# (max_replay_id[n - 1], max_replay_id[n]] and we can find the right archive with a binary search.
+# When older replays are synced again and archived, an archive can have a lower max replay id than
+# the one before it. The index is then flagged as unsorted and lookups fall back to a linear scan.
+#
+# The binary version of the index (c14_index.bin) is a 32 bytes header followed by fixed-width
+# little endian (archive_id, max_replay_id) u64 pairs, so it can be mmap'd and searched in place.
+# The header contains the number of records, the crc32 of all of them and some flags.
+
+MAGIC = b"OIDX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQI8x")
+RECORD = struct.Struct("<QQ")
+
+# Header flags
+UNSORTED = 1
+
+
+class C14Index:
+    def __init__(self):
+        self.archive_ids = array("Q")
+        self.max_replay_ids = array("Q")
+        # Whether the max replay ids are increasing
+        self.sorted = True
+
+    def __len__(self) -> int:
+        return len(self.archive_ids)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return zip(self.archive_ids, self.max_replay_ids)
+
+    @property
+    def last_archive_id(self) -> Optional[int]:
+        return self.archive_ids[-1] if self.archive_ids else None
+
+    @property
+    def last_max_replay_id(self) -> Optional[int]:
+        return self.max_replay_ids[-1] if self.max_replay_ids else None
+
+    def append(self, archive_id: int, max_replay_id: int) -> None:
+        if self.archive_ids and archive_id <= self.archive_ids[-1]:
+            raise ValueError(f"Archive id {archive_id} is not greater than the last one ({self.archive_ids[-1]})")
+        if self.max_replay_ids and max_replay_id < self.max_replay_ids[-1]:
+            self.sorted = False
+        self.archive_ids.append(archive_id)
+        self.max_replay_ids.append(max_replay_id)
+
+    def locate(self, replay_id: int) -> Optional[int]:
+        # Returns the id of the archive that contains replay_id, or None if it's newer than the last archive
+        return _locate(self.archive_ids, self.max_replay_ids, replay_id, self.sorted)
+
+    def candidates(self, replay_id: int) -> List[int]:
+        # Ids of the archives that can contain replay_id. A single one unless the index is unsorted.
+        if self.sorted:
+            archive_id = self.locate(replay_id)
+            return [archive_id] if archive_id is not None else []
+        return [a for a, m in self if m >= replay_id]
+
+    @property
+    def checksum(self) -> int:
+        return zlib.crc32(self._records())
+
+    def _records(self) -> bytes:
+        return b"".join(RECORD.pack(a, m) for a, m in self)
+
+    @classmethod
+    def load_text(cls, path: str) -> "C14Index":
+        index = cls()
+        with open(path, "r") as f:
+            for n, line in enumerate(f, start=1):
+                # Skip empty lines
+                if not line.strip():
+                    continue
+                parts = line.split("\t")
+                if len(parts) < 2:
+                    raise ValueError(f"{path}:{n}: malformed line")
+                index.append(int(parts[0]), int(parts[1]))
+        return index
+
+    def to_text(self) -> str:
+        return "".join(f"{a}\t{m}\n" for a, m in self)
+
+    def save_text(self, path: str) -> None:
+        with open(path, "w") as f:
+            f.write(self.to_text())
+
+    @classmethod
+    def load(cls, path: str) -> "C14Index":
+        with open(path, "rb") as f:
+            try:
+                return cls.from_bytes(f.read())
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}") from e
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "C14Index":
+        index = cls()
+        f = io.BytesIO(data)
+        count, crc, _ = _read_header(f)
+        records = f.read(count * RECORD.size)
+        if len(records) != count * RECORD.size or zlib.crc32(records) != crc:
+            raise ValueError("Corrupted c14 index (checksum mismatch)")
+        for archive_id, max_replay_id in RECORD.iter_unpack(records):
+            index.append(archive_id, max_replay_id)
+        return index
+
+    def to_bytes(self) -> bytes:
+        records = self._records()
+        flags = UNSORTED if not self.sorted else 0
+        return HEADER.pack(MAGIC, VERSION, RECORD.size, zlib.crc32(records), len(self), flags) + records
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+
+def _read_header(f) -> Tuple[int, int, int]:
+    header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        raise ValueError("Not a c14 index file (too short)")
+    magic, version, record_size, crc, count, flags = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError("Not a c14 index file (bad header)")
+    return count, crc, flags
+
+
+def _locate(archive_ids, max_replay_ids, replay_id: int, is_sorted: bool) -> Optional[int]:
+    if is_sorted:
+        i = bisect_left(max_replay_ids, replay_id)
+        return archive_ids[i] if i < len(archive_ids) else None
+    # First archive that can contain it
+    for i in range(len(max_replay_ids)):
+        if max_replay_ids[i] >= replay_id:
+            return archive_ids[i]
+    return None
+
+
+class _MappedColumn:
+    # Sequence view over one of the two u64 columns of a mmap'd index, for bisect
+    def __init__(self, buffer, count: int, column: int):
+        self.buffer = buffer
+        self.count = count
+        self.column = column
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> int:
+        return struct.unpack_from("<Q", self.buffer, HEADER.size + i * RECORD.size + self.column * 8)[0]
+
+
+class MappedC14Index:
+    # Searches a binary index in place without loading it. The checksum is not verified,
+    # use C14Index.load for that.
+    def __init__(self, path: str):
+        self._f = open(path, "rb")
+        count, _, flags = _read_header(self._f)
+        self.sorted = not flags & UNSORTED
+        self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size + count * RECORD.size:
+            self.close()
+            raise ValueError(f"{path} is truncated")
+        self.archive_ids = _MappedColumn(self._mmap, count, 0)
+        self.max_replay_ids = _MappedColumn(self._mmap, count, 1)
+
+    def __len__(self) -> int:
+        return len(self.archive_ids)
+
+    def locate(self, replay_id: int) -> Optional[int]:
+        return _locate(self.archive_ids, self.max_replay_ids, replay_id, self.sorted)
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="c14 index tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("convert", help="convert c14_index.txt to the binary format (or back, with --text)")
+    p.add_argument("source")
+    p.add_argument("destination")
+    p.add_argument("--text", action="store_true", help="convert from binary to text instead")
+    p = subparsers.add_parser("locate", help="find the archive that contains a replay")
+    p.add_argument("index", help="c14_index.txt or c14_index.bin")
+    p.add_argument("replay_id", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        if args.text:
+            C14Index.load(args.source).save_text(args.destination)
+        else:
+            C14Index.load_text(args.source).save(args.destination)
+        return 0
+
+    if args.index.endswith(".txt"):
+        archive_id = C14Index.load_text(args.index).locate(args.replay_id)
+    else:
+        with MappedC14Index(args.index) as index:
+            archive_id = index.locate(args.replay_id)
+    if archive_id is None:
+        print(f"Replay {args.replay_id} is not in any archive", file=sys.stderr)
+        return 1
+    print(archive_id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from decouple import config
 from decouple import Csv
@@ -8,8 +8,17 @@ class Config:
     def __init__(self):
         self._config: Dict[str, Any] = {
             "ONLINE_API_KEY": config("ONLINE_API_KEY", default=""),
+            "ONLINE_API_TIMEOUT": config("ONLINE_API_TIMEOUT", default="30", cast=float),
+            "ONLINE_API_RETRIES": config("ONLINE_API_RETRIES", default="4", cast=int),
+            "ONLINE_API_CACHE_FILE": config("ONLINE_API_CACHE_FILE", default="online_api_cache.json"),
 
             "RCLONE_REMOTE": config("RCLONE_REMOTE", default= ""),
+            "RCLONE_TRANSFERS": config("RCLONE_TRANSFERS", default="0", cast=int),
+            "RCLONE_CHUNK_SIZE": config("RCLONE_CHUNK_SIZE", default=""),
+            "RCLONE_TIMEOUT": config("RCLONE_TIMEOUT", default="0", cast=float),
+            "MIRROR_REMOTES": config("MIRROR_REMOTES", default="", cast=Csv(str)),
+            "OPTIONAL_MIRROR_REMOTES": config("OPTIONAL_MIRROR_REMOTES", default="", cast=Csv(str)),
+            "MIRROR_RETRIES": config("MIRROR_RETRIES", default="3", cast=int),
 
             "C14_SYNC_NAME": config("C14_SYNC_NAME", default="sync"),
             "C14_ALLOWED_SSH_KEYS": config("C14_ALLOWED_SSH_KEYS", default="", cast=Csv(str)),
@@ -29,11 +38,69 @@ class Config:
             "DB_USERNAME": config("DB_USERNAME", default=""),
             "DB_PASSWORD": config("DB_PASSWORD", default=""),
             "DB_NAME": config("DB_NAME", default=""),
+            "DB_ENGINE": config("DB_ENGINE", default="mysql"),
+            "DB_HOST": config("DB_HOST", default="localhost"),
+            "DB_PORT": config("DB_PORT", default="3306", cast=int),
+            "DB_WORKERS": config("DB_WORKERS", default="4", cast=int),
+            "DB_BATCH_ROWS": config("DB_BATCH_ROWS", default="1000", cast=int),
 
             "TELEGRAM_TOKEN": config("TELEGRAM_TOKEN", default=""),
             "TELEGRAM_CHAT_ID": config("TELEGRAM_CHAT_ID", default=""),
+            "TELEGRAM_API_BASE": config("TELEGRAM_API_BASE", default="https://api.telegram.org"),
+            "TELEGRAM_TIMEOUT": config("TELEGRAM_TIMEOUT", default="10", cast=float),
+            "TELEGRAM_QUEUE_SIZE": config("TELEGRAM_QUEUE_SIZE", default="100", cast=int),
 
-            "COMPRESS_DATABASE": config("COMPRESS_DATABASE", default="False", cast=bool)
+            "COMPRESS_DATABASE": config("COMPRESS_DATABASE", default="False", cast=bool),
+
+            "ARCHIVE_CODEC": config("ARCHIVE_CODEC", default="gzip"),
+            "ARCHIVE_LEVEL": config("ARCHIVE_LEVEL", default="-1", cast=int),
+            "ARCHIVE_WORKERS": config("ARCHIVE_WORKERS", default="0", cast=int),
+            "ARCHIVE_BLOCK_SIZE": config("ARCHIVE_BLOCK_SIZE", default="1048576", cast=int),
+            "ARCHIVE_MEMBER_INDEX": config("ARCHIVE_MEMBER_INDEX", default="True", cast=bool),
+            "ARCHIVE_SHARD_SIZE": config("ARCHIVE_SHARD_SIZE", default="0", cast=int),
+            "ARCHIVE_SHARD_WORKERS": config("ARCHIVE_SHARD_WORKERS", default="0", cast=int),
+
+            "ZSTD_DICT_FOLDER": config("ZSTD_DICT_FOLDER", default="zstd_dictionaries"),
+            "ZSTD_DICT_SIZE": config("ZSTD_DICT_SIZE", default="112640", cast=int),
+            "ZSTD_DICT_SAMPLES": config("ZSTD_DICT_SAMPLES", default="1000", cast=int),
+            "ZSTD_DICT_MAX_AGE": config("ZSTD_DICT_MAX_AGE", default="30", cast=float),
+
+            "DEDUP_STORE": config("DEDUP_STORE", default=""),
+            "DEDUP_WORKERS": config("DEDUP_WORKERS", default="4", cast=int),
+
+            "STREAM_UPLOAD": config("STREAM_UPLOAD", default="False", cast=bool),
+            "STREAM_BUFFER_SIZE": config("STREAM_BUFFER_SIZE", default="67108864", cast=int),
+            "STREAM_SPOOL_ARCHIVE": config("STREAM_SPOOL_ARCHIVE", default="False", cast=bool),
+
+            "FTP_BLOCK_SIZE": config("FTP_BLOCK_SIZE", default="1048576", cast=int),
+            "FTP_UPLOAD_RETRIES": config("FTP_UPLOAD_RETRIES", default="3", cast=int),
+            "FTP_PART_SIZE": config("FTP_PART_SIZE", default="0", cast=int),
+            "FTP_PARALLEL_UPLOADS": config("FTP_PARALLEL_UPLOADS", default="4", cast=int),
+
+            "BACKUP_MIN_SIZE": config("BACKUP_MIN_SIZE", default="524288000", cast=int),
+            "BACKUP_MIN_FILES": config("BACKUP_MIN_FILES", default="0", cast=int),
+
+            "DAEMON_POLL_INTERVAL": config("DAEMON_POLL_INTERVAL", default="60", cast=float),
+            "DAEMON_RETRY_INTERVAL": config("DAEMON_RETRY_INTERVAL", default="600", cast=float),
+            "DAEMON_METADATA_TTL": config("DAEMON_METADATA_TTL", default="900", cast=float),
+
+            "CLEANUP_WORKERS": config("CLEANUP_WORKERS", default="8", cast=int),
+            "CLEANUP_BATCH_SIZE": config("CLEANUP_BATCH_SIZE", default="1000", cast=int),
+
+            "ASSETS_JOURNAL_FOLDER": config("ASSETS_JOURNAL_FOLDER", default="assets_journal"),
+            "ASSETS_FULL_INTERVAL": config("ASSETS_FULL_INTERVAL", default="30", cast=float),
+            "ASSETS_HASH_WORKERS": config("ASSETS_HASH_WORKERS", default="4", cast=int),
+
+            "VERIFY_UPLOADS": config("VERIFY_UPLOADS", default="True", cast=bool),
+            "VERIFY_SAMPLES": config("VERIFY_SAMPLES", default="8", cast=int),
+            "VERIFY_SAMPLE_SIZE": config("VERIFY_SAMPLE_SIZE", default="1048576", cast=int),
+            "DELETE_VERIFIED_ARCHIVES": config("DELETE_VERIFIED_ARCHIVES", default="False", cast=bool),
+            "SCRUB_INTERVAL": config("SCRUB_INTERVAL", default="0", cast=float),
+            "SCRUB_ARCHIVES": config("SCRUB_ARCHIVES", default="4", cast=int),
+            "SCRUB_STATE_FILE": config("SCRUB_STATE_FILE", default="scrub_state.json"),
+
+            "METRICS_TEXTFILE": config("METRICS_TEXTFILE", default=""),
+            "METRICS_JSON": config("METRICS_JSON", default="")
         }
 
     @property
@@ -46,3 +113,14 @@ class Config:
 
     def __getitem__(self, item) -> Any:
         return self._config[item]
+
+
+_config: Optional[Config] = None
+
+
+def get_config() -> Config:
+    # Settings are read once per process, everything else shares the same Config
+    global _config
+    if _config is None:
+        _config = Config()
+    return _config
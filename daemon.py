@@ -0,0 +1,257 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from typing import Dict
+
+import metrics
+import oiseau
+import scanner
+import utils
+import verify
+from config import Config, get_config
+from utils import printc
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+
+_EVENT = struct.Struct("iIII")
+
+
+class FolderWatcher:
+    # Keeps an approximate count of the files in a folder and of their total size.
+    # The counters are only used to decide when to start a backup cycle,
+    # which scans the folder for real anyway.
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.total_size = 0
+        self.file_count = 0
+        # True if the counters can't be trusted anymore and the folder must be rescanned
+        self.dirty = True
+
+    def _scan(self) -> Dict[str, int]:
+        # Size of every file in the folder
+        sizes = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+        return sizes
+
+    def rescan(self) -> None:
+        sizes = self._scan()
+        self.total_size = sum(sizes.values())
+        self.file_count = len(sizes)
+        self.dirty = False
+
+    def reset(self) -> None:
+        # Called after a backup cycle, the folder has probably changed a lot
+        self.rescan()
+
+    def wait(self, timeout: float, stop: threading.Event) -> None:
+        # Waits until something changes in the folder, timeout expires or stop is set
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class PollingWatcher(FolderWatcher):
+    # Fallback for systems without inotify. Files are added to the temp folder by renaming
+    # (rsync) or creating them, both update the folder's mtime, so we rescan only if that changed.
+    def __init__(self, folder: str):
+        super(PollingWatcher, self).__init__(folder)
+        self._mtime = None
+
+    def rescan(self) -> None:
+        self._mtime = os.stat(self.folder).st_mtime_ns
+        super(PollingWatcher, self).rescan()
+
+    def wait(self, timeout: float, stop: threading.Event) -> None:
+        stop.wait(timeout)
+        if os.stat(self.folder).st_mtime_ns != self._mtime:
+            self.dirty = True
+
+
+class InotifyWatcher(FolderWatcher):
+    # Updates the counters incrementally from inotify events (through libc, no extra modules needed)
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    def __init__(self, folder: str):
+        super(InotifyWatcher, self).__init__(folder)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this system")
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self._fd, os.fsencode(folder), self.MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err))
+        # Sizes of the files found by the last rescan and of the ones we've been notified about
+        # since, so we can subtract them if they get rewritten, renamed (rsync temp files) or deleted
+        self._sizes: Dict[str, int] = {}
+
+    def _scan(self) -> Dict[str, int]:
+        self._sizes = super(InotifyWatcher, self)._scan()
+        return self._sizes
+
+    def reset(self) -> None:
+        # Discard the events caused by the cleanup, we're rescanning anyway
+        self._read_events(discard=True)
+        super(InotifyWatcher, self).reset()
+
+    def wait(self, timeout: float, stop: threading.Event) -> None:
+        deadline = time.monotonic() + timeout
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Wake up every now and then to check the stop event
+            readable, _, _ = select.select([self._fd], [], [], min(remaining, 1.0))
+            if readable and self._read_events():
+                return
+
+    def _read_events(self, discard: bool = False) -> bool:
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            if discard:
+                continue
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0").decode("utf-8", "replace")
+                offset += _EVENT.size + length
+                self._handle_event(mask, name)
+                changed = True
+
+    def _handle_event(self, mask: int, name: str) -> None:
+        if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+            self.dirty = True
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            try:
+                size = os.stat(os.path.join(self.folder, name)).st_size
+            except FileNotFoundError:
+                # Already renamed or deleted, remember we've seen it so the
+                # matching IN_MOVED_FROM/IN_DELETE event doesn't trigger a rescan
+                self._sizes.setdefault(name, -1)
+                return
+            old_size = self._sizes.get(name, -1)
+            if old_size < 0:
+                self.file_count += 1
+            else:
+                self.total_size -= old_size
+            self._sizes[name] = size
+            self.total_size += size
+        elif mask & (IN_MOVED_FROM | IN_DELETE):
+            size = self._sizes.pop(name, None)
+            if size is None:
+                # A file we've never heard of, we don't know its size
+                self.dirty = True
+            elif size >= 0:
+                self.file_count -= 1
+                self.total_size -= size
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def make_watcher(folder: str) -> FolderWatcher:
+    try:
+        watcher = InotifyWatcher(folder)
+        printc(f"* Watching {folder} with inotify", utils.BColors.BLUE)
+    except OSError as e:
+        watcher = PollingWatcher(folder)
+        printc(f"* inotify not available ({e}), polling {folder}", utils.BColors.YELLOW)
+    return watcher
+
+
+def run(config: Config, watcher: FolderWatcher, stop: threading.Event) -> None:
+    state = oiseau.BackupState(config)
+    ttl = config["DAEMON_METADATA_TTL"]
+    next_attempt = 0.0
+    last_warm_up = 0.0
+    last_scrub = 0.0
+    watcher.rescan()
+    while not stop.is_set():
+        if watcher.dirty:
+            watcher.rescan()
+
+        now = time.monotonic()
+        if oiseau.threshold_reached(config, watcher.total_size, watcher.file_count) and now >= next_attempt:
+            printc(
+                f"* Threshold reached ({watcher.total_size / 1024 / 1024:.2f} MB, {watcher.file_count} files), "
+                "starting a backup cycle",
+                utils.BColors.BLUE
+            )
+            run_metrics = metrics.RunMetrics()
+            with run_metrics.stage("scan"):
+                manifest = scanner.Manifest.scan(watcher.folder)
+            oiseau.run_cycle(state, manifest, metadata_max_age=ttl, run_metrics=run_metrics)
+            # Free the manifest arrays before sleeping
+            del manifest
+            watcher.reset()
+            if oiseau.threshold_reached(config, watcher.total_size, watcher.file_count):
+                # The cycle failed (or we're waiting for C14 to unarchive the bucket), don't hammer it
+                next_attempt = time.monotonic() + config["DAEMON_RETRY_INTERVAL"]
+                printc(
+                    f"* Temp folder still above threshold, next attempt in {config['DAEMON_RETRY_INTERVAL']} seconds",
+                    utils.BColors.YELLOW
+                )
+        elif 0 < config["SCRUB_INTERVAL"] <= now - last_scrub:
+            # Nothing to back up, check some of the old archives meanwhile
+            last_scrub = now
+            try:
+                verify.scrub_remote(state, config["SCRUB_ARCHIVES"], config["VERIFY_SAMPLES"])
+            except Exception as e:
+                printc(f"* Could not scrub the archives ({e})", utils.BColors.YELLOW)
+        elif config.is_c14 and now - last_warm_up >= ttl:
+            # Keep the API session and archives list warm, so the next cycle starts right away
+            last_warm_up = now
+            try:
+                state.api_checks(max_age=ttl)
+            except Exception as e:
+                state.invalidate()
+                printc(f"* Could not refresh C14 metadata ({e})", utils.BColors.YELLOW)
+
+        watcher.wait(config["DAEMON_POLL_INTERVAL"], stop)
+
+
+def main() -> int:
+    oiseau.print_banner()
+    config = get_config()
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        printc("* Stopping after the current cycle", utils.BColors.YELLOW)
+        stop.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    watcher = make_watcher("temp")
+    try:
+        run(config, watcher, stop)
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
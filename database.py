@@ -0,0 +1,548 @@
+import argparse
+import html
+import json
+import math
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Collection, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import archive
+import destinations
+import ftp
+import oiseau
+import streaming
+import utils
+import verify
+from config import Config, get_config
+from destinations import Destination
+from exceptions import CriticalError
+from utils import printc
+
+# Database backups. Every table is dumped as SQL statements by its own connection, on a pool of
+# DB_WORKERS threads, and each dump goes through a compressor straight to the upload backend
+# (FTP STOR or rclone rcat) without ever touching the disk. Once all the tables are uploaded,
+# a manifest with the row count, size and sha256 of every dump is uploaded as well.
+#
+# MySQL/MariaDB are read with PyMySQL (an unbuffered cursor, so a table is never loaded in
+# memory). Every worker has its own connection, and they all read from the same snapshot: like
+# mydumper, the transactions are started while a global read lock blocks writes. DB_ENGINE=sqlite
+# reads the SQLite database at DB_NAME instead, which is handy to try things out without a MySQL server.
+# SQLite has no way to share a snapshot between connections, so its tables are dumped one at a time
+# by a single connection.
+
+# INSERT statements are split once they're this big, well below MySQL's default max_allowed_packet
+MAX_STATEMENT_SIZE = 1024 * 1024
+
+
+class Database:
+    # A connection to the database. Connections are not shared between threads.
+    quote_char = '"'
+    header = ""
+    footer = ""
+
+    def tables(self) -> List[str]:
+        # Base tables only, biggest first when the size is known, so they start early
+        raise NotImplementedError()
+
+    def create_statement(self, table: str) -> str:
+        raise NotImplementedError()
+
+    def rows(self, table: str, batch_size: int) -> Iterator[Sequence[tuple]]:
+        # Consistent view of the table, in batches of rows
+        raise NotImplementedError()
+
+    def values(self, row: tuple) -> str:
+        # "(1,'foo',NULL)"
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        raise NotImplementedError()
+
+    @classmethod
+    def snapshots(cls, config: Config, count: int) -> List["Database"]:
+        # count connections that read the database as it was at the same point in time
+        connections: List[Database] = []
+        try:
+            for _ in range(count):
+                connections.append(cls(config))
+        except BaseException:
+            for x in connections:
+                x.close()
+            raise
+        return connections
+
+    def quote(self, name: str) -> str:
+        return self.quote_char + name.replace(self.quote_char, self.quote_char * 2) + self.quote_char
+
+
+class MysqlDatabase(Database):
+    quote_char = "`"
+    header = "SET NAMES utf8mb4;\nSET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\n"
+    footer = "SET UNIQUE_CHECKS=1;\nSET FOREIGN_KEY_CHECKS=1;\n"
+
+    def __init__(self, config: Config, snapshot: bool = True):
+        # Optional dependency, only needed when backing up a MySQL database
+        try:
+            import pymysql
+            import pymysql.cursors
+        except ImportError:
+            raise CriticalError("Database backups need the PyMySQL module (pip install pymysql)")
+        self._cursor_class = pymysql.cursors.SSCursor
+        self._error_class = pymysql.MySQLError
+        try:
+            self.connection = pymysql.connect(
+                host=config["DB_HOST"],
+                port=config["DB_PORT"],
+                user=config["DB_USERNAME"],
+                password=config["DB_PASSWORD"],
+                database=config["DB_NAME"],
+                charset="utf8mb4"
+            )
+        except pymysql.MySQLError as e:
+            raise CriticalError(f"Cannot connect to the database ({e})")
+        self.database = config["DB_NAME"]
+        if snapshot:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+    @classmethod
+    def snapshots(cls, config: Config, count: int) -> List[Database]:
+        if count <= 1:
+            return super().snapshots(config, count)
+        # Each transaction sees the database as it was when it started. Writes are blocked while
+        # they're started, so they all see the same thing and foreign keys hold across tables.
+        lock = cls(config, snapshot=False)
+        connections: List[Database] = []
+        try:
+            with lock.connection.cursor() as cursor:
+                try:
+                    cursor.execute("FLUSH TABLES WITH READ LOCK")
+                except lock._error_class as e:
+                    raise CriticalError(
+                        f"Cannot lock the tables to start the snapshots ({e}). "
+                        "The database user needs the RELOAD privilege, or use DB_WORKERS=1"
+                    )
+                connections = super().snapshots(config, count)
+                cursor.execute("UNLOCK TABLES")
+        finally:
+            # Releases the lock if something went wrong
+            lock.close()
+        return connections
+
+    def tables(self) -> List[str]:
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_NAME FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE' ORDER BY DATA_LENGTH DESC, TABLE_NAME",
+                (self.database,)
+            )
+            return [x[0] for x in cursor.fetchall()]
+
+    def create_statement(self, table: str) -> str:
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SHOW CREATE TABLE {self.quote(table)}")
+            return cursor.fetchone()[1]
+
+    def rows(self, table: str, batch_size: int) -> Iterator[Sequence[tuple]]:
+        with self.connection.cursor(self._cursor_class) as cursor:
+            cursor.execute(f"SELECT * FROM {self.quote(table)}")
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+
+    def values(self, row: tuple) -> str:
+        # PyMySQL escapes tuples as "(a,b,c)", and knows about bytes, dates and decimals
+        return self.connection.escape(row)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def _sqlite_literal(value: Any) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NULL"
+        if math.isinf(value):
+            return "9e999" if value > 0 else "-9e999"
+        # 17 digits, SQLite doesn't always parse the shortest repr back to the same double
+        return "%.17g" % value
+    if isinstance(value, bytes):
+        return f"X'{value.hex()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class SqliteDatabase(Database):
+    header = "BEGIN;\n"
+    footer = "COMMIT;\n"
+
+    def __init__(self, config: Config):
+        try:
+            # Read only, so a typo in DB_NAME doesn't create an empty database. Opened in the main
+            # thread and used by a worker thread.
+            self.connection = sqlite3.connect(f"file:{config['DB_NAME']}?mode=ro", uri=True, check_same_thread=False)
+            self.connection.text_factory = lambda x: x.decode("utf-8", "surrogateescape")
+            # The snapshot starts with the first read and lasts until the connection is closed
+            self.connection.isolation_level = None
+            self.connection.execute("BEGIN")
+        except sqlite3.Error as e:
+            raise CriticalError(f"Cannot open the database ({e})")
+
+    @classmethod
+    def snapshots(cls, config: Config, count: int) -> List[Database]:
+        # SQLite can't start several transactions on the same snapshot, so there's a single
+        # connection and tables are dumped one at a time
+        return super().snapshots(config, 1)
+
+    def tables(self) -> List[str]:
+        return [
+            x[0] for x in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+            )
+        ]
+
+    def create_statement(self, table: str) -> str:
+        return self.connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+
+    def rows(self, table: str, batch_size: int) -> Iterator[Sequence[tuple]]:
+        cursor = self.connection.execute(f"SELECT * FROM {self.quote(table)}")
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            yield batch
+
+    def values(self, row: tuple) -> str:
+        return "(" + ",".join(_sqlite_literal(x) for x in row) + ")"
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+ENGINES: Dict[str, Callable[[Config], Database]] = {"mysql": MysqlDatabase, "sqlite": SqliteDatabase}
+
+
+def engine_from_config(config: Config) -> Callable[[Config], Database]:
+    engine = ENGINES.get(config["DB_ENGINE"].lower())
+    if engine is None:
+        raise CriticalError(f"Unknown database engine '{config['DB_ENGINE']}'. Valid engines: {', '.join(ENGINES)}")
+    return engine
+
+
+def connect(config: Config) -> Database:
+    return engine_from_config(config)(config)
+
+
+class TableDump(NamedTuple):
+    table: str
+    name: str
+    rows: int
+    bytes_in: int
+    bytes_out: int
+    # Of the uploaded file
+    digests: Dict[str, str]
+    elapsed: float
+    # Per destination, only optional ones can have failed
+    uploads: Dict[str, streaming.UploadResult]
+
+    @property
+    def throughput(self) -> float:
+        # Uncompressed MB/s
+        return self.bytes_in / 1024 / 1024 / self.elapsed if self.elapsed else 0.0
+
+
+class _CountingWriter:
+    # Counts what goes through, for dumps that are not compressed
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_in = 0
+
+    def write(self, data) -> int:
+        self.bytes_in += len(data)
+        return self.fileobj.write(data)
+
+    def close(self) -> None:
+        self.fileobj.flush()
+
+
+def write_dump(db: Database, table: str, fileobj, batch_rows: int) -> int:
+    # Writes the SQL statements that re-create the table to fileobj. Returns the number of rows.
+    quoted = db.quote(table)
+    fileobj.write(
+        f"{db.header}DROP TABLE IF EXISTS {quoted};\n{db.create_statement(table)};\n".encode("utf-8", "surrogateescape")
+    )
+    rows = 0
+    insert = f"INSERT INTO {quoted} VALUES "
+    for batch in db.rows(table, batch_rows):
+        values: List[str] = []
+        size = 0
+        for row in batch:
+            literal = db.values(row)
+            values.append(literal)
+            size += len(literal) + 1
+            if size >= MAX_STATEMENT_SIZE:
+                fileobj.write(f"{insert}{','.join(values)};\n".encode("utf-8", "surrogateescape"))
+                values = []
+                size = 0
+        if values:
+            fileobj.write(f"{insert}{','.join(values)};\n".encode("utf-8", "surrogateescape"))
+        rows += len(batch)
+    fileobj.write(db.footer.encode("utf-8"))
+    return rows
+
+
+def dump_name(the_time: int, table: str, config: Config) -> str:
+    # Table names can contain anything, file names can't
+    name = "{}_database_{}.sql".format(the_time, re.sub(r"[^\w.-]", "_", table))
+    if config["COMPRESS_DATABASE"]:
+        name += "." + archive.get_codec(archive.codec_from_config(config, replays=False)).suffix
+    return name
+
+
+def dump_table(
+    config: Config,
+    table: str,
+    name: str,
+    uploads: Dict[str, Callable[[streaming.BoundedPipe], Any]],
+    connections: "queue.Queue[Database]",
+    cancel: Optional[threading.Event] = None,
+    optional: Collection[str] = ()
+) -> Optional[TableDump]:
+    # Dumps a table with one of the snapshot connections (none of the other workers uses it
+    # meanwhile) and uploads it (to all destinations) as it's being written.
+    # Returns None if cancel was set before the dump started.
+    if cancel is not None and cancel.is_set():
+        return None
+    start = time.monotonic()
+    db = connections.get()
+    try:
+        def produce(tee: streaming.HashingTee) -> Any:
+            if config["COMPRESS_DATABASE"]:
+                # Compressed in this thread: the tables are already dumped in parallel,
+                # and zlib, lzma and zstd release the GIL
+                writer = archive.ParallelCompressor(
+                    tee,
+                    codec=archive.codec_from_config(config, replays=False),
+                    level=config["ARCHIVE_LEVEL"],
+                    workers=1,
+                    block_size=config["ARCHIVE_BLOCK_SIZE"]
+                )
+            else:
+                writer = _CountingWriter(tee)
+            rows = write_dump(db, table, writer, config["DB_BATCH_ROWS"])
+            writer.close()
+            return rows, writer.bytes_in
+
+        (rows, bytes_in), tee, results = streaming.stream_output(
+            produce,
+            uploads,
+            config["STREAM_BUFFER_SIZE"],
+            optional=optional,
+            algorithms=verify.DIGESTS if config["VERIFY_UPLOADS"] else ("sha256",)
+        )
+    finally:
+        connections.put(db)
+    return TableDump(
+        table=table,
+        name=name,
+        rows=rows,
+        bytes_in=bytes_in,
+        bytes_out=tee.size,
+        digests=tee.digests,
+        elapsed=time.monotonic() - start,
+        uploads=results
+    )
+
+
+def uploader(
+    state: oiseau.BackupState,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    destination: Destination,
+    name: str
+) -> Callable[[Any], Any]:
+    # upload(fileobj) that streams fileobj to name on the destination
+    config = state.config
+    if not destination.is_c14:
+        return lambda fileobj: utils.rclone_rcat(fileobj, f"{destination.remote}/{name}")
+
+    def upload(fileobj) -> None:
+        # One FTP session per upload, they run in parallel
+        session = ftp.connect(ftp_credentials, state.ftp_login)
+        try:
+            session.storbinary(f"STOR {name}", fileobj, config["FTP_BLOCK_SIZE"])
+        finally:
+            session.quit()
+    return upload
+
+
+def backup_database(state: oiseau.BackupState, tables: Optional[List[str]] = None) -> bool:
+    # Dumps and uploads every table (or only the given ones). Returns True if the backup is complete.
+    config = state.config
+    if not config["DB_NAME"]:
+        raise CriticalError("DB_NAME is not set")
+    db = connect(config)
+    try:
+        all_tables = db.tables()
+    finally:
+        db.close()
+    if tables:
+        missing = set(tables) - set(all_tables)
+        if missing:
+            raise CriticalError(f"Unknown table(s): {', '.join(sorted(missing))}")
+        all_tables = [x for x in all_tables if x in tables]
+    if not all_tables:
+        printc("* No tables to back up", utils.BColors.YELLOW)
+        return True
+
+    pipeline = oiseau.Pipeline(state)
+    if not pipeline.connect():
+        return False
+
+    all_destinations = destinations.get_destinations(config)
+    optional = [x.name for x in all_destinations if not x.required]
+    the_time = int(time.time())
+    start = time.monotonic()
+    snapshots = engine_from_config(config).snapshots(config, max(1, min(config["DB_WORKERS"], len(all_tables))))
+    # One worker per connection, the engine may open fewer than asked
+    workers = len(snapshots)
+    printc(f"* Dumping {len(all_tables)} table(s) with {workers} worker(s)", utils.BColors.BLUE)
+    dumps: List[TableDump] = []
+    cancel = threading.Event()
+    connections: "queue.Queue[Database]" = queue.Queue()
+    for db in snapshots:
+        connections.put(db)
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            futures: List[Future] = []
+            for table in all_tables:
+                name = dump_name(the_time, table, config)
+                uploads = {x.name: uploader(state, pipeline.ftp_credentials, x, name) for x in all_destinations}
+                futures.append(executor.submit(dump_table, config, table, name, uploads, connections, cancel, optional))
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception() is not None:
+                        # The tables that haven't started yet are skipped, the others are left to finish
+                        cancel.set()
+                        continue
+                    dump = future.result()
+                    if dump is None:
+                        continue
+                    dumps.append(dump)
+                    printc(
+                        f"* {dump.name} uploaded ({dump.rows} rows, {dump.bytes_in / 1024 / 1024:.2f} MB, "
+                        f"{dump.bytes_out / 1024 / 1024:.2f} MB uploaded, {dump.throughput:.1f} MB/s)",
+                        utils.BColors.BLUE
+                    )
+    finally:
+        while not connections.empty():
+            connections.get().close()
+    errors = [x.exception() for x in futures if x.exception() is not None]
+    if errors:
+        raise errors[0]
+
+    # Without a manifest, the dumps of a backup are incomplete
+    elapsed = time.monotonic() - start
+    manifest = {
+        "time": the_time,
+        "engine": config["DB_ENGINE"].lower(),
+        "database": config["DB_NAME"],
+        "codec": archive.codec_from_config(config, replays=False) if config["COMPRESS_DATABASE"] else None,
+        "elapsed": round(elapsed, 3),
+        "tables": {
+            x.table: {
+                "file": x.name,
+                "rows": x.rows,
+                "bytes": x.bytes_in,
+                "compressed_bytes": x.bytes_out,
+                "sha256": x.digests["sha256"],
+                "elapsed": round(x.elapsed, 3),
+            } for x in sorted(dumps, key=lambda x: x.table)
+        },
+    }
+    manifest_name = f"{the_time}_database.json"
+    manifest_data = json.dumps(manifest, indent=2).encode()
+
+    # Optional mirrors that missed a table don't get the manifest
+    failed = set()
+    for dump in dumps:
+        results = [
+            destinations.FanOutResult(x, dump.uploads[x.name].error, dump.uploads[x.name].elapsed, 1)
+            for x in all_destinations
+        ]
+        oiseau.record_destination_metrics(state, results, dump.bytes_out)
+        succeeded = destinations.check_results(results, dump.name)
+        failed.update(x for x in all_destinations if x not in succeeded)
+
+    def finish_upload(destination: Destination) -> None:
+        oiseau.upload_bytes(state, destination, pipeline.ftp_credentials, manifest_name, manifest_data)
+        # There's no local copy, the sizes and hashes computed while uploading are all we can check
+        oiseau.verify_uploads(state, destination, pipeline.ftp_credentials, [
+            {"name": x.name, "size": x.bytes_out, "digests": x.digests} for x in dumps
+        ] + [{"name": manifest_name, "size": len(manifest_data), "digests": verify.data_digests(manifest_data)}])
+
+    # Like c14_index.txt, the manifest goes to the main destination last
+    main, *mirrors = all_destinations
+    mirrors = [x for x in mirrors if x not in failed]
+    if mirrors:
+        destinations.check_results(destinations.fan_out(mirrors, finish_upload), manifest_name)
+    finish_upload(main)
+
+    rows = sum(x.rows for x in dumps)
+    bytes_in = sum(x.bytes_in for x in dumps)
+    bytes_out = sum(x.bytes_out for x in dumps)
+    throughput = bytes_in / 1024 / 1024 / elapsed if elapsed else 0.0
+    summary = (
+        f"{len(dumps)} tables, {rows} rows, {bytes_in / 1024 / 1024:.2f} MB "
+        f"({bytes_out / 1024 / 1024:.2f} MB uploaded) in {elapsed:.1f} s, {throughput:.1f} MB/s"
+    )
+    printc(f"* Database backup done: {summary}", utils.BColors.GREEN)
+    utils.telegram_notify(f"Database backup done ({manifest_name})\n\n{summary}")
+    return True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Parallel, streaming backup of the database")
+    parser.add_argument("--table", action="append", help="back up only this table (can be repeated)")
+    args = parser.parse_args(argv)
+
+    oiseau.print_banner()
+    config = get_config()
+    if not config["SYNC_DATABASE"]:
+        printc("* Database backups are disabled (SYNC_DATABASE)", utils.BColors.YELLOW)
+        return 0
+    state = oiseau.BackupState(config)
+    try:
+        return 0 if backup_database(state, args.table) else 1
+    except CriticalError as e:
+        printc("# {}".format(e.message), utils.BColors.RED + utils.BColors.BOLD)
+        utils.telegram_notify(
+            "<b>Critical error during database backup.</b>\n\n<code>{}</code>".format(e.message),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    except Exception as e:
+        printc("# Unknown error while backing up the database ({})".format(str(e)), utils.BColors.RED)
+        utils.telegram_notify(
+            "<b>Unhandled exception during database backup.</b>\n\n<code>{}</code>".format(
+                html.escape(traceback.format_exc())
+            ),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    return -1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+
+import scanner
+
+# Content hashes of the replays that have been archived, so replays that are synced to the
+# temp folder again (or left there by a failed run) are not archived twice.
+#
+# The store file is a 16 bytes header followed by the sorted replay ids (u64) and then the
+# digests (DIGEST_SIZE bytes each) in the same order: 24 bytes per replay, searched with bisect.
+
+DIGEST_SIZE = 16
+MAGIC = b"OIDD"
+VERSION = 1
+HEADER = struct.Struct("<4sBB2xQ")
+
+
+def file_digest(path: str, blocksize: int = 1024 * 1024) -> bytes:
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            h.update(data)
+    return h.digest()
+
+
+class DedupStore:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.ids = array("Q")
+        self.digests = bytearray()
+        # Added since the last save, merged into the sorted arrays by save()
+        self._new: Dict[int, bytes] = {}
+        if path is not None and os.path.isfile(path):
+            self._load()
+
+    def _find(self, replay_id: int) -> Optional[int]:
+        i = bisect_left(self.ids, replay_id)
+        return i if i < len(self.ids) and self.ids[i] == replay_id else None
+
+    def get(self, replay_id: int) -> Optional[bytes]:
+        digest = self._new.get(replay_id)
+        if digest is not None:
+            return digest
+        i = self._find(replay_id)
+        return bytes(self.digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]) if i is not None else None
+
+    def add(self, replay_id: int, digest: bytes) -> None:
+        self._new[replay_id] = digest
+
+    def add_manifest(self, manifest: scanner.Manifest) -> int:
+        # Records the replays that have been archived from manifest. Returns how many.
+        if manifest.digest_size != DIGEST_SIZE:
+            return 0
+        count = 0
+        zero = bytes(DIGEST_SIZE)
+        for i, (replay_id, flags) in enumerate(zip(manifest.ids, manifest.flags)):
+            digest = manifest.digest(i)
+            if not flags & scanner.DUPLICATE and digest != zero:
+                self.add(replay_id, digest)
+                count += 1
+        return count
+
+    def _merge(self) -> None:
+        if not self._new:
+            return
+        ids = array("Q")
+        digests = bytearray()
+        start = 0
+        for replay_id in sorted(self._new):
+            # Ids mostly grow over time, so this is usually a single slice plus appends
+            i = bisect_left(self.ids, replay_id, start)
+            ids.extend(self.ids[start:i])
+            digests += self.digests[start * DIGEST_SIZE:i * DIGEST_SIZE]
+            ids.append(replay_id)
+            digests += self._new[replay_id]
+            start = i + 1 if i < len(self.ids) and self.ids[i] == replay_id else i
+        ids.extend(self.ids[start:])
+        digests += self.digests[start * DIGEST_SIZE:]
+        self.ids, self.digests = ids, digests
+        self._new.clear()
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        self._merge()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, DIGEST_SIZE, len(self.ids)))
+            self.ids.tofile(f)
+            f.write(self.digests)
+        os.replace(tmp_path, path)
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            magic, version, digest_size, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION or digest_size != DIGEST_SIZE:
+                raise ValueError(f"{self.path} is not a valid dedup store")
+            self.ids.fromfile(f, count)
+            self.digests = bytearray(f.read(count * DIGEST_SIZE))
+        if len(self.digests) != count * DIGEST_SIZE:
+            raise ValueError(f"{self.path} is truncated")
+
+
+def _hash_batch(batch: List[Tuple[int, str]]) -> List[Tuple[int, Optional[bytes]]]:
+    results = []
+    for i, path in batch:
+        try:
+            results.append((i, file_digest(path)))
+        except FileNotFoundError:
+            # Deleted in the meantime. Not a duplicate, cleanup will skip it.
+            results.append((i, None))
+    return results
+
+
+class _Hasher:
+    # Hashes the i-th replay of a manifest on a thread pool, keeping a bounded number of batches in flight
+    def __init__(self, executor: ThreadPoolExecutor, workers: int, batch_size: int):
+        self.executor = executor
+        self.max_pending = max(1, workers) * 4
+        self.batch_size = batch_size
+        self.digests = bytearray()
+        self._batch: List[Tuple[int, str]] = []
+        self._pending: Deque[Future] = deque()
+
+    def add(self, i: int, path: str) -> None:
+        self._batch.append((i, path))
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    def _submit(self) -> None:
+        self._pending.append(self.executor.submit(_hash_batch, self._batch))
+        self._batch = []
+        while len(self._pending) > self.max_pending:
+            self._collect(self._pending.popleft())
+
+    def _collect(self, future: Future) -> None:
+        for i, digest in future.result():
+            end = (i + 1) * DIGEST_SIZE
+            if len(self.digests) < end:
+                self.digests.extend(bytes(end - len(self.digests)))
+            if digest is not None:
+                self.digests[i * DIGEST_SIZE:end] = digest
+
+    def finish(self, manifest: scanner.Manifest) -> None:
+        if self._batch:
+            self._submit()
+        while self._pending:
+            self._collect(self._pending.popleft())
+        # Replays that could not be hashed have an all zeros digest
+        self.digests.extend(bytes(manifest.replay_count * DIGEST_SIZE - len(self.digests)))
+        manifest.digest_size = DIGEST_SIZE
+        manifest.digests = self.digests
+
+
+def scan(folder: str, store: DedupStore, *, workers: int = 4, batch_size: int = 256) -> scanner.Manifest:
+    # Same as scanner.Manifest.scan, but replays are hashed on a thread pool while the folder is
+    # still being scanned (Pipeline.scan uses it when DEDUP_STORE is set). Replays whose digest
+    # matches the store are flagged as duplicates, they are not archived again but they are
+    # deleted from the temp folder like the others.
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        hasher = _Hasher(executor, workers, batch_size)
+        manifest = scanner.Manifest.scan(folder, hasher.add)
+        hasher.finish(manifest)
+    mark_duplicates(manifest, store)
+    return manifest
+
+
+def hash_manifest(manifest: scanner.Manifest, store: DedupStore, *, workers: int = 4, batch_size: int = 256) -> None:
+    # For manifests built without dedup.scan (the daemon's, scanned before it knows whether there's
+    # enough to archive). Hashing doesn't overlap the scan there.
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        hasher = _Hasher(executor, workers, batch_size)
+        for i, replay_id in enumerate(manifest.ids):
+            hasher.add(i, os.path.join(manifest.folder, scanner.replay_file_name(replay_id)))
+        hasher.finish(manifest)
+    mark_duplicates(manifest, store)
+
+
+def mark_duplicates(manifest: scanner.Manifest, store: DedupStore) -> int:
+    count = 0
+    zero = bytes(DIGEST_SIZE)
+    for i, replay_id in enumerate(manifest.ids):
+        digest = manifest.digest(i)
+        if digest != zero and store.get(replay_id) == digest:
+            manifest.flags[i] |= scanner.DUPLICATE
+            count += 1
+    return count
@@ -0,0 +1,92 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, NamedTuple, Optional
+
+import utils
+from config import Config
+from utils import printc
+
+# Where archives are uploaded. The main destination is C14, or RCLONE_REMOTE if it's set: that's
+# where c14_index.txt is read from. Mirrors are rclone remotes that get a copy of everything that's
+# uploaded to the main destination, at the same time, so an offsite copy doesn't need a second
+# run. If a required mirror (MIRROR_REMOTES) fails, so does the run, and c14_index.txt is not
+# updated. Optional mirrors (OPTIONAL_MIRROR_REMOTES) are best effort.
+
+
+class Destination(NamedTuple):
+    # "c14" or the rclone remote, for messages and metrics
+    name: str
+    # rclone remote, None for C14
+    remote: Optional[str]
+    required: bool
+    # How many times a failed upload is retried, on top of the retries of the transfer itself
+    retries: int
+
+    @property
+    def is_c14(self) -> bool:
+        return self.remote is None
+
+
+def get_destinations(config: Config) -> List[Destination]:
+    # The main destination comes first
+    if config.is_c14:
+        main = Destination("c14", None, True, 0)
+    else:
+        main = Destination(config["RCLONE_REMOTE"], config["RCLONE_REMOTE"], True, 0)
+    return [main] + [
+        Destination(x, x, True, config["MIRROR_RETRIES"]) for x in config["MIRROR_REMOTES"] if x
+    ] + [
+        Destination(x, x, False, config["MIRROR_RETRIES"]) for x in config["OPTIONAL_MIRROR_REMOTES"] if x
+    ]
+
+
+class FanOutResult(NamedTuple):
+    destination: Destination
+    error: Optional[BaseException]
+    elapsed: float
+    attempts: int
+
+
+def fan_out(
+    destinations: List[Destination],
+    work: Callable[[Destination], Any],
+    retry_delay: float = 5
+) -> List[FanOutResult]:
+    # Runs work(destination) for all destinations at the same time, one thread each.
+    # Failures are retried (destination.retries times, with a growing delay) and returned, not raised.
+    def run(destination: Destination) -> FanOutResult:
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                work(destination)
+                return FanOutResult(destination, None, time.monotonic() - start, attempt + 1)
+            except Exception as e:
+                if attempt >= destination.retries:
+                    return FanOutResult(destination, e, time.monotonic() - start, attempt + 1)
+                attempt += 1
+                printc(f"* Upload to {destination.name} failed ({e}), retrying ({attempt}/{destination.retries})", utils.BColors.YELLOW)
+                time.sleep(retry_delay * attempt)
+
+    if len(destinations) == 1:
+        return [run(destinations[0])]
+    with ThreadPoolExecutor(len(destinations), thread_name_prefix="oiseau-upload") as executor:
+        return list(executor.map(run, destinations))
+
+
+def check_results(results: List[FanOutResult], what: str) -> List[Destination]:
+    # Reports the failures, then raises the error of the first required destination that failed.
+    # Returns the destinations that succeeded.
+    required = [x for x in results if x.error is not None and x.destination.required]
+    for result in results:
+        if result.error is None:
+            continue
+        printc(f"# Could not upload {what} to {result.destination.name} ({result.error})", utils.BColors.RED)
+        if not result.destination.required:
+            utils.telegram_notify(
+                f"Could not upload {what} to the optional mirror {result.destination.name}",
+                prefix=utils.TelegramPrefixes.ALERT
+            )
+    if required:
+        raise required[0].error
+    return [x.destination for x in results if x.error is None]
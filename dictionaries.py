@@ -0,0 +1,169 @@
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import scanner
+import utils
+from config import get_config
+from exceptions import CriticalError
+from utils import printc
+
+# zstd dictionaries for the zstd-dict archive codec, trained on a sample of the replays in the
+# temp folder. Every dictionary is a new version: it's saved in ZSTD_DICT_FOLDER as {id}.zdict
+# (the id is the one zstd writes in every frame and the member index records) and never
+# changed, so archives compressed with an older one can still be read. The newest one is
+# used for new archives. It's uploaded next to them as zstd_dictionary_{id}.zdict, before
+# c14_index.txt, so restore tools can fetch it.
+
+SUFFIX = ".zdict"
+# Below that, training fails or gives a useless dictionary
+MIN_SAMPLES = 16
+
+
+def dictionary_name(dict_id: int) -> str:
+    # Name of the dictionary next to the archives
+    return f"zstd_dictionary_{dict_id}{SUFFIX}"
+
+
+def sample_replays(folder: str, count: int, rng: Optional[random.Random] = None) -> List[str]:
+    rng = rng or random.Random()
+    paths = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if scanner.parse_replay_id(entry.name) is not None:
+                paths.append(entry.path)
+    return rng.sample(paths, count) if len(paths) > count else paths
+
+
+def train(paths: List[str], dict_size: int, level: int = 3) -> bytes:
+    # Only the start of each replay: that's where replays look alike, the rest is
+    # LZMA compressed frames
+    if len(paths) < MIN_SAMPLES:
+        raise CriticalError(f"Not enough replays to train a zstd dictionary ({len(paths)}, at least {MIN_SAMPLES})")
+    samples = []
+    for path in paths:
+        with open(path, "rb") as f:
+            samples.append(f.read(128 * 1024))
+    try:
+        return zstandard.train_dictionary(dict_size, samples, level=level).as_bytes()
+    except zstandard.ZstdError as e:
+        raise CriticalError(f"Cannot train the zstd dictionary ({e})")
+
+
+def archive_dictionary(path: str) -> int:
+    # Id of the dictionary the archive at path is compressed with (0 if none), from its first frame header
+    if zstandard is None:
+        return 0
+    with open(path, "rb") as f:
+        # A frame header is at most 18 bytes
+        head = f.read(18)
+    if not head.startswith(zstandard.FRAME_HEADER):
+        return 0
+    try:
+        return zstandard.get_frame_parameters(head).dict_id
+    except zstandard.ZstdError:
+        return 0
+
+
+def dictionary_path(config, dict_id: int) -> str:
+    return os.path.join(config["ZSTD_DICT_FOLDER"], f"{dict_id}{SUFFIX}")
+
+
+def latest(folder: str) -> Optional[Tuple[int, str]]:
+    # (id, path) of the newest dictionary in folder
+    if not os.path.isdir(folder):
+        return None
+    found = []
+    for name in os.listdir(folder):
+        if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+            path = os.path.join(folder, name)
+            found.append((os.path.getmtime(path), int(name[:-len(SUFFIX)]), path))
+    if not found:
+        return None
+    _, dict_id, path = max(found)
+    return dict_id, path
+
+
+def save(folder: str, data: bytes) -> Tuple[int, str]:
+    dict_id = zstandard.ZstdCompressionDict(data).dict_id()
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{dict_id}{SUFFIX}")
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+    return dict_id, path
+
+
+def needs_dictionary(config) -> bool:
+    return config["ARCHIVE_CODEC"].lower() == "zstd-dict"
+
+
+def current(config) -> Optional[Tuple[int, str]]:
+    # (id, path) of the dictionary new archives are compressed with, None if the codec doesn't use one
+    if not needs_dictionary(config):
+        return None
+    found = latest(config["ZSTD_DICT_FOLDER"])
+    if found is None:
+        raise CriticalError(f"There's no zstd dictionary in {config['ZSTD_DICT_FOLDER']}, run dictionaries.py --train")
+    return found
+
+
+def load(config) -> Optional[bytes]:
+    found = current(config)
+    if found is None:
+        return None
+    with open(found[1], "rb") as f:
+        return f.read()
+
+
+def ensure(config, folder: str = "temp", force: bool = False) -> Optional[int]:
+    # Trains a new dictionary if there's none yet, or if the newest one is older than
+    # ZSTD_DICT_MAX_AGE days. Returns the id of the dictionary to use.
+    if not needs_dictionary(config):
+        return None
+    if zstandard is None:
+        raise CriticalError("The zstd-dict archive codec is not available (missing python module?)")
+    found = latest(config["ZSTD_DICT_FOLDER"])
+    max_age = config["ZSTD_DICT_MAX_AGE"] * 86400
+    if found is not None and not force and (max_age <= 0 or time.time() - os.path.getmtime(found[1]) < max_age):
+        return found[0]
+    start = time.monotonic()
+    paths = sample_replays(folder, config["ZSTD_DICT_SAMPLES"])
+    data = train(paths, config["ZSTD_DICT_SIZE"])
+    dict_id, path = save(config["ZSTD_DICT_FOLDER"], data)
+    printc(
+        f"* Trained zstd dictionary {dict_id} ({len(data) / 1024:.0f} KB) on {len(paths)} replays "
+        f"in {time.monotonic() - start:.1f} s",
+        utils.BColors.BLUE
+    )
+    return dict_id
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="zstd dictionaries for the zstd-dict archive codec")
+    parser.add_argument("--train", action="store_true", help="train a new dictionary even if there's a recent one")
+    parser.add_argument("--folder", default="temp", help="folder with the replays to sample")
+    args = parser.parse_args(argv)
+    config = get_config()
+    if not needs_dictionary(config):
+        print("ARCHIVE_CODEC is not zstd-dict, no dictionary needed", file=sys.stderr)
+        return 1
+    try:
+        dict_id = ensure(config, args.folder, force=args.train)
+    except CriticalError as e:
+        print(e.message, file=sys.stderr)
+        return 1
+    print(f"{dict_id} {current(config)[1]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
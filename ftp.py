@@ -0,0 +1,214 @@
+import ftplib
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+class FtpCredentials(NamedTuple):
+    host: str
+    port: int
+    user: str
+    password: str
+
+
+class FilePart(NamedTuple):
+    name: str
+    offset: int
+    size: int
+
+
+def connect(credentials: FtpCredentials, login: Optional[Callable[[ftplib.FTP, str, str], Any]] = None) -> ftplib.FTP:
+    session = ftplib.FTP()
+    session.connect(credentials.host, credentials.port)
+    if login is None:
+        session.login(credentials.user, credentials.password)
+    else:
+        login(session, credentials.user, credentials.password)
+    return session
+
+
+def remote_size(session: ftplib.FTP, name: str) -> Optional[int]:
+    # SIZE is only reliable in binary mode
+    session.voidcmd("TYPE I")
+    try:
+        return session.size(name)
+    except ftplib.error_perm:
+        # 550, file does not exist
+        return None
+
+
+class _SliceReader:
+    # Reads at most length bytes from fileobj, hashing them on the way
+    def __init__(self, fileobj, length: int, sha256=None):
+        self.fileobj = fileobj
+        self.remaining = length
+        self.sha256 = sha256
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        return data
+
+
+def _hash_range(fileobj, length: int, sha256, blocksize: int) -> None:
+    while length > 0:
+        data = fileobj.read(min(blocksize, length))
+        if not data:
+            break
+        sha256.update(data)
+        length -= len(data)
+
+
+def upload_file(
+    session: ftplib.FTP,
+    local_path: str,
+    remote_name: str,
+    *,
+    offset: int = 0,
+    length: Optional[int] = None,
+    blocksize: int = DEFAULT_BLOCK_SIZE,
+    resume: bool = True
+) -> str:
+    # Uploads length bytes of local_path starting from offset (the whole file by default).
+    # If the remote file already exists and is smaller, the upload is resumed with REST.
+    # Returns the sha256 of the uploaded range.
+    if length is None:
+        length = os.path.getsize(local_path) - offset
+    done = remote_size(session, remote_name) if resume else None
+    if done is not None and done > length:
+        # Bigger than what we want to upload, it's something else. Overwrite it.
+        done = None
+    sha256 = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        f.seek(offset)
+        if done:
+            # Already uploaded bytes are still hashed, but from the local copy
+            _hash_range(f, done, sha256, blocksize)
+        if done != length:
+            session.storbinary(
+                f"STOR {remote_name}",
+                _SliceReader(f, length - (done or 0), sha256),
+                blocksize,
+                rest=done or None
+            )
+    return sha256.hexdigest()
+
+
+def upload_with_retries(
+    credentials: FtpCredentials,
+    local_path: str,
+    remote_name: str,
+    *,
+    offset: int = 0,
+    length: Optional[int] = None,
+    blocksize: int = DEFAULT_BLOCK_SIZE,
+    retries: int = 3,
+    retry_delay: float = 5,
+    login: Optional[Callable[[ftplib.FTP, str, str], Any]] = None
+) -> str:
+    # Same as upload_file, on a dedicated session. If the connection drops,
+    # we reconnect and resume from where the server got to.
+    attempt = 0
+    while True:
+        session = None
+        try:
+            session = connect(credentials, login)
+            return upload_file(session, local_path, remote_name, offset=offset, length=length, blocksize=blocksize)
+        except (ftplib.error_temp, ftplib.error_reply, OSError, EOFError):
+            if attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(retry_delay * attempt)
+        finally:
+            if session is not None:
+                try:
+                    session.quit()
+                except (ftplib.Error, OSError, EOFError):
+                    session.close()
+
+
+def split_parts(name: str, size: int, part_size: int) -> List[FilePart]:
+    return [
+        FilePart(f"{name}.part{i:04d}", offset, min(part_size, size - offset))
+        for i, offset in enumerate(range(0, size, part_size))
+    ]
+
+
+def parts_manifest_name(name: str) -> str:
+    return f"{name}.parts.json"
+
+
+def upload_parts(
+    credentials: FtpCredentials,
+    local_path: str,
+    remote_name: str,
+    part_size: int,
+    *,
+    workers: int = 4,
+    blocksize: int = DEFAULT_BLOCK_SIZE,
+    retries: int = 3,
+    login: Optional[Callable[[ftplib.FTP, str, str], Any]] = None
+) -> Dict[str, Any]:
+    # Splits local_path in fixed size parts, uploaded over parallel FTP sessions.
+    # A json manifest listing the parts in order (with their offset, size and sha256)
+    # is uploaded last, the file can be rebuilt with reassemble().
+    size = os.path.getsize(local_path)
+    parts = split_parts(remote_name, size, part_size)
+    with ThreadPoolExecutor(max(1, min(workers, len(parts)))) as executor:
+        digests = list(executor.map(
+            lambda part: upload_with_retries(
+                credentials, local_path, part.name,
+                offset=part.offset, length=part.size, blocksize=blocksize, retries=retries, login=login
+            ),
+            parts
+        ))
+    manifest = {
+        "name": remote_name,
+        "size": size,
+        "part_size": part_size,
+        "parts": [{**part._asdict(), "sha256": digest} for part, digest in zip(parts, digests)]
+    }
+    session = connect(credentials, login)
+    try:
+        session.storbinary(
+            f"STOR {parts_manifest_name(remote_name)}",
+            io.BytesIO(json.dumps(manifest, indent=2).encode("utf-8"))
+        )
+    finally:
+        session.quit()
+    return manifest
+
+
+def reassemble(manifest_path: str, parts_folder: str, output_path: str, blocksize: int = DEFAULT_BLOCK_SIZE) -> None:
+    # Rebuilds a split file from its downloaded parts, checking each part's size and sha256
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    with open(output_path, "wb") as out:
+        for part in manifest["parts"]:
+            sha256 = hashlib.sha256()
+            with open(os.path.join(parts_folder, part["name"]), "rb") as f:
+                if f.seek(0, os.SEEK_END) != part["size"]:
+                    raise ValueError(f"{part['name']} has the wrong size")
+                f.seek(0)
+                while True:
+                    data = f.read(blocksize)
+                    if not data:
+                        break
+                    sha256.update(data)
+                    out.write(data)
+            if sha256.hexdigest() != part["sha256"]:
+                raise ValueError(f"{part['name']} is corrupted (sha256 mismatch)")
+        if out.tell() != manifest["size"]:
+            raise ValueError("Reassembled file has the wrong size")
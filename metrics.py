@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# Per-run metrics. Each backup cycle gets a RunMetrics, stages are timed with `with run.stage(name)`
+# and everything else is a gauge set (or added to) by the code that knows the value. Nothing
+# here is called per file: the archiver and the cleanup already count files and bytes, their
+# totals are recorded once the stage is over.
+#
+# At the end of the cycle, the metrics are written in the Prometheus text format (for
+# node_exporter's textfile collector) and appended to a JSON lines file, one record per run.
+
+PREFIX = "oiseau"
+
+HELP = {
+    "run_timestamp_seconds": "Unix time of the start of the last run",
+    "run_duration_seconds": "Duration of the last run",
+    "run_success": "1 if the last run completed without errors",
+    "stage_duration_seconds": "Time spent in each stage of the last run",
+    "scanned_files": "Files found in the temp folder",
+    "scanned_bytes": "Size of the files found in the temp folder",
+    "duplicate_files": "Replays skipped because they have already been archived with the same content",
+    "archives": "Archives created",
+    "archived_files": "Files added to the archives",
+    "archive_bytes_in": "Uncompressed size of the archives",
+    "archive_bytes_out": "Compressed size of the archives",
+    "compression_ratio": "Compressed size / uncompressed size",
+    "uploaded_bytes": "Bytes uploaded",
+    "upload_bytes_per_second": "Average upload throughput",
+    "destination_uploaded_bytes": "Bytes uploaded, per destination (main destination and mirrors)",
+    "destination_upload_seconds": "Time spent uploading, per destination",
+    "destination_errors": "Failed uploads (after retries), per destination",
+    "destination_verify_seconds": "Time spent verifying uploads, per destination",
+    "verified_files": "Uploaded files checked against the remote, per method (hash algorithm, ranges, blocks or size)",
+    "deleted_files": "Files deleted from the temp folder",
+    "cleanup_kept_files": "Archived files that changed or disappeared before cleanup",
+    "api_calls": "online.net API calls, per endpoint",
+    "api_errors": "Failed online.net API calls, per endpoint",
+    "api_retries": "Retried online.net API calls, per endpoint",
+    "api_duration_seconds": "Time spent in online.net API calls, per endpoint",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.finished: Optional[float] = None
+        self.success = False
+        self.error: Optional[str] = None
+        self.values: Dict[str, Dict[Labels, float]] = {}
+        # Uploads to several destinations record their metrics from their own threads
+        self._lock = threading.Lock()
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self.values.setdefault(name, {})[_labels(labels)] = value
+
+    def add(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def get(self, name: str, default: float = 0, **labels: Any) -> float:
+        return self.values.get(name, {}).get(_labels(labels), default)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        # Stages that run more than once (eg: one upload per archive) add up
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add("stage_duration_seconds", time.monotonic() - start, stage=name)
+
+    def finish(self, success: bool, error: Optional[str] = None) -> None:
+        self.finished = time.monotonic()
+        self.success = success
+        self.error = error
+        self.set("run_timestamp_seconds", int(self.started))
+        self.set("run_duration_seconds", self.finished - self._start)
+        self.set("run_success", int(success))
+        # Derived values, so they don't have to be computed in PromQL
+        bytes_in = self.get("archive_bytes_in")
+        if bytes_in:
+            self.set("compression_ratio", self.get("archive_bytes_out") / bytes_in)
+        upload_time = self.get("stage_duration_seconds", stage="upload")
+        if upload_time:
+            self.set("upload_bytes_per_second", self.get("uploaded_bytes") / upload_time)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name in sorted(self.values):
+            full_name = f"{PREFIX}_{name}"
+            if name in HELP:
+                lines.append(f"# HELP {full_name} {HELP[name]}")
+            lines.append(f"# TYPE {full_name} gauge")
+            for labels, value in sorted(self.values[name].items()):
+                label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                series = f"{full_name}{{{label_str}}}" if label_str else full_name
+                lines.append(f"{series} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_record(self) -> Dict[str, Any]:
+        values = {}
+        for name, series in self.values.items():
+            for labels, value in series.items():
+                key = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+                values[key] = value
+        return {
+            "time": int(self.started),
+            "success": self.success,
+            "error": self.error,
+            "values": dict(sorted(values.items())),
+        }
+
+    def write_textfile(self, path: str) -> None:
+        # The textfile collector could read a half written file, so write it atomically
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def append_record(self, path: str) -> None:
+        with open(path, "a") as f:
+            f.write(json.dumps(self.to_record()) + "\n")
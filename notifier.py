@@ -0,0 +1,167 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Union
+
+# A message's data can be computed when it's actually sent, so a queued status update
+# always carries the latest text. Returning None skips the message.
+MessageData = Union[Dict[str, Any], Callable[[], Optional[Dict[str, Any]]]]
+
+
+class _Message:
+    __slots__ = ("method", "data", "callback")
+
+    def __init__(self, method: str, data: MessageData, callback: Optional[Callable[[Any], Any]]):
+        self.method = method
+        self.data = data
+        self.callback = callback
+
+
+class TelegramNotifier:
+    # Sends Telegram bot API calls from a background thread, so a slow or unreachable
+    # api.telegram.org never stalls a backup. send() never blocks: when the queue is full
+    # the message is dropped (and counted). Messages sent with the same key while an
+    # earlier one is still queued replace it (eg: several edits of the same status message).
+
+    # Telegram allows about one message per second in the same chat
+    CHAT_INTERVAL = 1.0
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        token: str,
+        *,
+        api_base: str = "https://api.telegram.org",
+        timeout: float = 10,
+        queue_size: int = 100,
+        max_retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 60
+    ):
+        self.token = token
+        self.api_base = api_base.rstrip("/")
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.failed = 0
+
+        self._queue: "OrderedDict[Hashable, _Message]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._closed = False
+        self._next_send: Dict[Any, float] = {}
+        # Imported here, so it's loaded only if Telegram is enabled
+        import requests
+        self._session = requests.Session()
+        self._network_errors = (requests.ConnectionError, requests.Timeout)
+        self._thread = threading.Thread(target=self._run, name="telegram-notifier", daemon=True)
+        self._thread.start()
+
+    def send(
+        self,
+        method: str,
+        data: MessageData,
+        *,
+        key: Optional[Hashable] = None,
+        callback: Optional[Callable[[Any], Any]] = None
+    ) -> bool:
+        # Queues an api call. callback, if any, is called from the notifier thread with the
+        # "result" of the response. Returns False if the message has been dropped.
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if key is not None and key in self._queue:
+                self._queue[key] = _Message(method, data, callback)
+                self.coalesced += 1
+                return True
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+                return False
+            self._queue[key if key is not None else object()] = _Message(method, data, callback)
+            self._cond.notify_all()
+            return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # Waits until everything that's been queued so far has been sent (or given up on)
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        # Sends what's left in the queue and stops the thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        flushed = not self._thread.is_alive()
+        if flushed:
+            self._session.close()
+        return flushed
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                _, message = self._queue.popitem(last=False)
+                self._busy = True
+            try:
+                self._deliver(message)
+            except Exception:
+                # This is the only thread sending notifications, whatever happens it must keep running
+                self.failed += 1
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _deliver(self, message: _Message) -> None:
+        data = message.data() if callable(message.data) else message.data
+        if data is None:
+            return
+        chat_id = data.get("chat_id")
+        url = "{}/bot{}/{}".format(self.api_base, self.token, message.method)
+        attempt = 0
+        while True:
+            delay = self._next_send.get(chat_id, 0) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_send[chat_id] = time.monotonic() + self.CHAT_INTERVAL
+            retry_after = None
+            try:
+                r = self._session.post(url, data=data, timeout=self.timeout)
+                if r.status_code not in self.RETRY_STATUS_CODES:
+                    break
+                if r.status_code == 429:
+                    try:
+                        retry_after = float(r.json()["parameters"]["retry_after"])
+                    except (ValueError, KeyError, TypeError):
+                        pass
+            except self._network_errors:
+                r = None
+            if attempt >= self.max_retries:
+                break
+            if retry_after is None:
+                # Exponential backoff with jitter
+                retry_after = random.uniform(0.5, 1) * min(self.max_backoff, self.backoff * (2 ** attempt))
+            time.sleep(retry_after)
+            attempt += 1
+
+        if r is None or r.status_code != 200:
+            self.failed += 1
+            return
+        if message.callback is not None:
+            try:
+                result = r.json()
+            except ValueError:
+                result = None
+            # If it raises, the message counts as failed
+            message.callback(result.get("result") if isinstance(result, dict) else None)
+        self.sent += 1
@@ -1,25 +1,43 @@
+import contextlib
 import html
+import io
 import os
-import tarfile
 import time
 import traceback
-import gc
 import ftplib
-import time
+import json
+import shutil
 import sys
+import tempfile
+from typing import Any, Collection, Dict, List, Optional
 
-import iso8601
-
+import archive
+import c14_index
+import dedup
+import destinations
+import dictionaries
+import ftp
+import metrics
+import scanner
+import sharding
+import streaming
 import utils
+import verify
 from utils import printc
-from config import Config
+from config import Config, get_config
+from destinations import Destination
 from online import OnlineApiClient, OnlineApiError
+from online.cache import ResponseCache
 from exceptions import CriticalError
 
 VERSION = "2.1.0"
 
+# Written once the archive has been created locally and removed once it's been uploaded,
+# so an interrupted upload can be resumed by the next run
+PENDING_UPLOAD_FILE = "pending_upload.json"
+
 
-try:
+def print_banner():
     # Here's a cute birb (oiseau=birb in french)
     printc("""              ___
              (  ">
@@ -29,36 +47,585 @@ try:
           -/------""", utils.BColors.YELLOW)
     printc(" " * 7 + "oiseau @{}\n".format(VERSION), utils.BColors.YELLOW + utils.BColors.BOLD)
 
-    # Load config
-    config = Config()
 
-    # Always run API checks
-    # Check online.net api token
-    if config.is_c14:
-        client = OnlineApiClient(config["ONLINE_API_KEY"])
-        logged_in = client.auth_valid()
-        if not logged_in:
-            raise CriticalError("Could not log in, check your online.net API key")
+class BackupState:
+    # Things that can be reused across backup cycles when running as a daemon:
+    # the API client (and its login status) and the C14 archives list
+    def __init__(self, config: Config):
+        self.config = config
+        # Created by the first API check, so runs that don't need the API don't load requests
+        self.client: Optional[OnlineApiClient] = None
+        self.logged_in = False
+        self.archives = None
+        self.archives_time = 0.0
+        # Replaced at the start of every cycle
+        self.metrics = metrics.RunMetrics()
+
+    def api_checks(self, max_age: float = 0) -> None:
+        if not self.config.is_c14:
+            return
+        if self.client is None:
+            self.client = OnlineApiClient(
+                self.config["ONLINE_API_KEY"],
+                timeout=self.config["ONLINE_API_TIMEOUT"],
+                max_retries=self.config["ONLINE_API_RETRIES"],
+                cache=ResponseCache(self.config["ONLINE_API_CACHE_FILE"] or None)
+            )
+
+        # Check online.net api token
+        if not self.logged_in:
+            self.logged_in = bool(self.client.auth_valid())
+            if not self.logged_in:
+                raise CriticalError("Could not log in, check your online.net API key")
 
         # List all archives in all safes
-        archives = client.request("api/v1/storage/c14/archive")
+        if self.archives is None or time.time() - self.archives_time >= max_age:
+            self.refresh_archives(cached=True)
+
+    def refresh_archives(self, cached: bool = False) -> None:
+        archives = self.client.request("api/v1/storage/c14/archive", cached=cached)
         if not archives:
             raise CriticalError("No C14 archives found")
+        self.archives = archives
+        self.archives_time = time.time()
+
+    def invalidate(self) -> None:
+        # Something changed on C14's side (eg: unarchive requested), refetch everything next time
+        self.logged_in = False
+        self.archives = None
+        if self.client is not None:
+            self.client.cache.clear()
+
+    def ftp_login(self, session: ftplib.FTP, user: str, password: str) -> None:
+        try:
+            session.login(user, password)
+        except ftplib.error_perm:
+            # The cached credentials are probably stale (eg: the archive has been rearchived)
+            self.invalidate()
+            raise
+
+
+def threshold_reached(config: Config, total_size: int, file_count: int) -> bool:
+    return total_size >= config["BACKUP_MIN_SIZE"] or 0 < config["BACKUP_MIN_FILES"] <= file_count
+
+
+def upload_archive_c14(
+    state: BackupState,
+    ftp_credentials: ftp.FtpCredentials,
+    archive_path: str,
+    index_path: Optional[str] = None,
+    the_time: Optional[int] = None
+) -> None:
+    # Uploads an archive and its member index. The c14 index as well, if index_path is given.
+    config = state.config
+    archive_name = os.path.basename(archive_path)
+    archive_size = os.path.getsize(archive_path)
+    if 0 < config["FTP_PART_SIZE"] < archive_size:
+        # Very big archive, split it and upload the parts in parallel
+        printc(
+            f"* Uploading {archive_name} in parts of {config['FTP_PART_SIZE'] / 1024 / 1024:.0f} MB "
+            f"over {config['FTP_PARALLEL_UPLOADS']} connections",
+            utils.BColors.BLUE
+        )
+        ftp.upload_parts(
+            ftp_credentials,
+            archive_path,
+            archive_name,
+            config["FTP_PART_SIZE"],
+            workers=config["FTP_PARALLEL_UPLOADS"],
+            blocksize=config["FTP_BLOCK_SIZE"],
+            retries=config["FTP_UPLOAD_RETRIES"],
+            login=state.ftp_login
+        )
+    else:
+        # Upload .tar.gz, resuming it if a previous attempt failed
+        ftp.upload_with_retries(
+            ftp_credentials,
+            archive_path,
+            archive_name,
+            blocksize=config["FTP_BLOCK_SIZE"],
+            retries=config["FTP_UPLOAD_RETRIES"],
+            login=state.ftp_login
+        )
+
+    # Upload member index and c14 index
+    session = ftp.connect(ftp_credentials, state.ftp_login)
+    try:
+        member_index_path = archive.member_index_name(archive_path)
+        if os.path.isfile(member_index_path):
+            with open(member_index_path, "rb") as f:
+                session.storbinary(f"STOR {archive.member_index_name(archive_name)}", f)
+        if index_path is not None:
+            upload_index_c14(session, index_path, the_time)
+    finally:
+        session.quit()
+
+
+def upload_index_c14(session: ftplib.FTP, index_path: str, the_time: int) -> None:
+    with open(index_path, "rb") as f:
+        session.storbinary(f"STOR c14_index.txt", f)
+        f.seek(0)
+        session.storbinary(f"STOR {the_time}_c14_index.txt", f)
+    # Binary version of the index, for restore tools
+    session.storbinary("STOR c14_index.bin", io.BytesIO(c14_index.C14Index.load_text(index_path).to_bytes()))
+
+
+def upload_archive_rclone(remote: str, archive_path: str, progress: bool = True) -> None:
+    # rclone copy skips what's already on the remote
+    utils.rclone_copy(archive_path, remote, progress=progress)
+    if os.path.isfile(archive.member_index_name(archive_path)):
+        utils.rclone_copy(archive.member_index_name(archive_path), remote)
+
+
+def upload_index_rclone(remote: str, index_path: str) -> None:
+    # rclone copy keeps the file name, so upload copies with the right names from a temporary folder
+    with tempfile.TemporaryDirectory() as folder:
+        shutil.copyfile(index_path, os.path.join(folder, "c14_index.txt"))
+        c14_index.C14Index.load_text(index_path).save(os.path.join(folder, "c14_index.bin"))
+        utils.rclone_copy(os.path.join(folder, "c14_index.txt"), remote)
+        utils.rclone_copy(os.path.join(folder, "c14_index.bin"), remote)
+
+
+def upload_bytes(
+    state: BackupState,
+    destination: Destination,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    name: str,
+    data: bytes
+) -> None:
+    # Small files that only exist in memory (member indexes, manifests)
+    if destination.is_c14:
+        session = ftp.connect(ftp_credentials, state.ftp_login)
+        try:
+            session.storbinary(f"STOR {name}", io.BytesIO(data))
+        finally:
+            session.quit()
+    else:
+        utils.rclone_rcat(io.BytesIO(data), f"{destination.remote}/{name}")
+
+
+def cleanup_temp(config: Config, manifest: scanner.Manifest, run_metrics: metrics.RunMetrics) -> None:
+    printc(f"* Emptying the temp folder as well", utils.BColors.BLUE)
+    # Delete only the files in the manifest, so we avoid deleting unsynced files if new files are synced while taking the backup.
+    # Files that have been re-synced since the snapshot are kept as well, they'll go in the next archive.
+    with run_metrics.stage("delete"):
+        result = scanner.remove_unchanged(
+            manifest,
+            workers=config["CLEANUP_WORKERS"],
+            batch_size=config["CLEANUP_BATCH_SIZE"]
+        )
+    run_metrics.add("deleted_files", result.deleted)
+    run_metrics.add("cleanup_kept_files", result.changed + result.missing)
+    printc(
+        f"* Deleted {result.deleted} files in {result.elapsed:.2f} s ({result.rate:.0f} files/s)",
+        utils.BColors.BLUE
+    )
+    if result.changed or result.missing:
+        printc(
+            f"* {result.changed} files changed since the archive was created and have been kept, "
+            f"{result.missing} files were already gone",
+            utils.BColors.YELLOW
+        )
+
+
+def save_pending_upload(shards: List[sharding.Shard], index_path: str, the_time: int) -> None:
+    with open(PENDING_UPLOAD_FILE, "w") as f:
+        json.dump({
+            "archives": [
+                {"id": x.archive_id, "name": x.name, "manifest": manifest_name(x.name)} for x in shards
+            ],
+            "index": index_path,
+            "time": the_time
+        }, f)
+
+
+def load_pending_upload() -> Optional[dict]:
+    if not os.path.isfile(PENDING_UPLOAD_FILE):
+        return None
+    with open(PENDING_UPLOAD_FILE, "r") as f:
+        pending = json.load(f)
+    if "archive" in pending:
+        # Single archive, written by older versions
+        archive_id = int(pending["archive"].split("_replays_")[1].split(".")[0])
+        pending["archives"] = [{"id": archive_id, "name": pending["archive"], "manifest": pending["manifest"]}]
+    for x in pending["archives"]:
+        if not os.path.isfile(x["name"]) and not os.path.isfile(x["manifest"]):
+            raise CriticalError(
+                f"There's a pending upload for {x['name']}, but neither the file nor its manifest exist. "
+                f"Delete {PENDING_UPLOAD_FILE} to start from scratch."
+            )
+    return pending
+
+
+def resume_pending_upload(state: BackupState, pending: dict, ftp_credentials: Optional[ftp.FtpCredentials]) -> bool:
+    config = state.config
+    names = ", ".join(x["name"] for x in pending["archives"])
+    printc(f"* Resuming the upload of {names} from a previous run", utils.BColors.YELLOW)
+    shards = [
+        sharding.Shard(x["id"], x["name"], scanner.Manifest.load(x["manifest"], "temp"))
+        for x in pending["archives"]
+    ]
+    # Archives are renamed to their final name only once complete, the ones that don't exist
+    # were not built yet. Their files are still in the temp folder, so build them now.
+    missing = [x for x in shards if not os.path.isfile(x.name)]
+    if missing:
+        printc(f"* Building {len(missing)} archives that were not created yet", utils.BColors.YELLOW)
+    built = sharding.build_shards(missing, config, config["ARCHIVE_SHARD_WORKERS"]) if missing else iter(())
+    failed = set()
+    for shard in shards:
+        if os.path.isfile(shard.name):
+            failed.update(upload_archive(state, ftp_credentials, shard.name))
+    for result in built:
+        record_archive_metrics(state.metrics, result)
+        failed.update(upload_archive(state, ftp_credentials, result.path, result.digests))
+    upload_index(state, ftp_credentials, pending["index"], pending["time"], skip=failed)
+    record_archived(config, [x.manifest for x in shards])
+    for shard in shards:
+        cleanup_temp(config, shard.manifest, state.metrics)
+    os.remove(PENDING_UPLOAD_FILE)
+    delete_manifests([x["manifest"] for x in pending["archives"]])
+    delete_local_copies(config, [x.name for x in shards], [pending["index"]])
+    utils.printc("* All done!", utils.BColors.GREEN)
+    utils.telegram_notify(f"The upload of {names} has been resumed and completed")
+    return True
+
+
+def record_archived(config: Config, manifests: List[scanner.Manifest]) -> None:
+    # Remember the content of what's been archived, so it's not archived again
+    if not config["DEDUP_STORE"]:
+        return
+    store = dedup.DedupStore(config["DEDUP_STORE"])
+    count = sum(store.add_manifest(x) for x in manifests)
+    store.save()
+    printc(f"* Added {count} replays to the dedup store", utils.BColors.BLUE)
+
+
+def record_archive_metrics(run_metrics: metrics.RunMetrics, result: sharding.ShardResult) -> None:
+    # Archives are built in worker processes, what they took is the sum of their build times
+    run_metrics.add("stage_duration_seconds", result.elapsed, stage="compress")
+    run_metrics.add("archives")
+    run_metrics.add("archived_files", result.files)
+    run_metrics.add("archive_bytes_in", result.bytes_in)
+    run_metrics.add("archive_bytes_out", result.bytes_out)
+
+
+def api_stats_snapshot(state: BackupState) -> dict:
+    if state.client is None:
+        return {}
+    return {k: (v.calls, v.errors, v.retries, v.total_time) for k, v in state.client.stats.items()}
+
+
+def record_api_metrics(state: BackupState, before: dict) -> None:
+    # The client's stats are kept across daemon cycles, record what changed during this one
+    if state.client is None:
+        return
+    for endpoint, stats in state.client.stats.items():
+        calls, errors, retries, total_time = before.get(endpoint, (0, 0, 0, 0.0))
+        if stats.calls == calls:
+            continue
+        state.metrics.set("api_calls", stats.calls - calls, endpoint=endpoint)
+        state.metrics.set("api_errors", stats.errors - errors, endpoint=endpoint)
+        state.metrics.set("api_retries", stats.retries - retries, endpoint=endpoint)
+        state.metrics.set("api_duration_seconds", stats.total_time - total_time, endpoint=endpoint)
+
+
+def manifest_name(archive_name: str) -> str:
+    return f"{archive_name.split('.', 1)[0]}.manifest"
+
+
+def delete_manifests(paths: List[str]) -> None:
+    # The manifests of the archives are only needed to resume their upload. Once the pending
+    # upload is done, they go whether the local copies of the archives are kept or not.
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def verify_uploads(
+    state: BackupState,
+    destination: Destination,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    checks: List[Dict[str, Any]]
+) -> None:
+    # Each check is the keyword arguments of verify.verify_upload for a file that's just been uploaded
+    config = state.config
+    if not config["VERIFY_UPLOADS"]:
+        return
+    # Destinations are verified in parallel, only the main one counts in the stage time (like uploads)
+    is_main = destination == destinations.get_destinations(config)[0]
+    start = time.monotonic()
+    try:
+        with state.metrics.stage("verify") if is_main else contextlib.nullcontext():
+            source = verify.remote_source(config, ftp_credentials, state.ftp_login, destination.remote)
+            try:
+                for check in checks:
+                    result = verify.verify_upload(
+                        source, **check, samples=config["VERIFY_SAMPLES"], sample_size=config["VERIFY_SAMPLE_SIZE"]
+                    )
+                    state.metrics.add("verified_files", method=result.method)
+                    printc(f"* {result.name} verified on {destination.name} ({result.method})", utils.BColors.BLUE)
+            finally:
+                source.close()
+    finally:
+        state.metrics.add("destination_verify_seconds", time.monotonic() - start, destination=destination.name)
+
 
-    # Continue only if temp folder is big enough
-    total_size = sum(os.path.getsize(os.path.join("temp", f)) for f in os.listdir("temp/") if os.path.isfile(os.path.join("temp", f)))
-    if total_size < 500 * 1024 * 1024:
-        printc(f"* Temp folder is too small ({total_size / 1024 / 1024} MB). Aborting.", utils.BColors.YELLOW)
-        exit(0)
+def upload_dictionary(
+    state: BackupState,
+    destination: Destination,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    dict_id: int
+) -> None:
+    # Archives compressed with a zstd dictionary can't be read without it, so it's uploaded
+    # before them. It never changes once trained, if it's already there it's not uploaded again.
+    if not dict_id:
+        return
+    path = dictionaries.dictionary_path(state.config, dict_id)
+    if not os.path.isfile(path):
+        raise CriticalError(f"zstd dictionary {dict_id} is not in {state.config['ZSTD_DICT_FOLDER']}")
+    name = dictionaries.dictionary_name(dict_id)
+    size = os.path.getsize(path)
+    source = verify.remote_source(state.config, ftp_credentials, state.ftp_login, destination.remote)
+    try:
+        if source.size(name) == size:
+            return
+    finally:
+        source.close()
+    with open(path, "rb") as f:
+        upload_bytes(state, destination, ftp_credentials, name, f.read())
+    printc(f"* zstd dictionary {dict_id} uploaded to {destination.name}", utils.BColors.BLUE)
+    verify_uploads(state, destination, ftp_credentials, [{"name": name, "size": size, "local_path": path}])
 
-    # Filter only desired C14 buckets by name and sort them by creation date (most recent first)
-    if config.is_c14:
+
+def verify_archive(
+    state: BackupState,
+    destination: Destination,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    archive_path: str,
+    digests: Optional[Dict[str, str]] = None
+) -> None:
+    archive_name = os.path.basename(archive_path)
+    size = os.path.getsize(archive_path)
+    if destination.is_c14 and 0 < state.config["FTP_PART_SIZE"] < size:
+        # Uploaded in parts, there's no remote file with the whole archive
+        checks = [
+            {"name": x.name, "size": x.size, "local_path": archive_path, "offset": x.offset}
+            for x in ftp.split_parts(archive_name, size, state.config["FTP_PART_SIZE"])
+        ]
+    else:
+        checks = [{"name": archive_name, "size": size, "local_path": archive_path, "digests": digests}]
+    member_index_path = archive.member_index_name(archive_path)
+    if os.path.isfile(member_index_path):
+        checks.append({
+            "name": os.path.basename(member_index_path),
+            "size": os.path.getsize(member_index_path),
+            "local_path": member_index_path
+        })
+    verify_uploads(state, destination, ftp_credentials, checks)
+
+
+def record_destination_metrics(
+    state: BackupState,
+    results: List[destinations.FanOutResult],
+    size: int
+) -> None:
+    for result in results:
+        name = result.destination.name
+        if result.error is None:
+            state.metrics.add("destination_uploaded_bytes", size, destination=name)
+            state.metrics.add("destination_upload_seconds", result.elapsed, destination=name)
+        else:
+            state.metrics.add("destination_errors", destination=name)
+
+
+def upload_archive(
+    state: BackupState,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    archive_path: str,
+    digests: Optional[Dict[str, str]] = None
+) -> List[Destination]:
+    # Uploads and verifies an archive, on all destinations at the same time. digests are the
+    # archive's hashes, if they were computed while it was written. Returns the (optional)
+    # destinations that don't have the archive.
+    config = state.config
+    size = os.path.getsize(archive_path)
+    if os.path.isfile(archive.member_index_name(archive_path)):
+        size += os.path.getsize(archive.member_index_name(archive_path))
+    all_destinations = destinations.get_destinations(config)
+    main = all_destinations[0]
+    dict_id = dictionaries.archive_dictionary(archive_path)
+
+    def upload_to(destination: Destination) -> None:
+        upload_dictionary(state, destination, ftp_credentials, dict_id)
+        # The main destination is what the upload metrics have always been about
+        with state.metrics.stage("upload") if destination is main else contextlib.nullcontext():
+            if destination.is_c14:
+                upload_archive_c14(state, ftp_credentials, archive_path)
+            else:
+                # Progress lines of uploads running at the same time would be mixed up
+                upload_archive_rclone(destination.remote, archive_path, progress=destination is main)
+        verify_archive(state, destination, ftp_credentials, archive_path, digests)
+
+    results = destinations.fan_out(all_destinations, upload_to)
+    record_destination_metrics(state, results, size)
+    succeeded = destinations.check_results(results, os.path.basename(archive_path))
+    state.metrics.add("uploaded_bytes", size)
+    return [x for x in all_destinations if x not in succeeded]
+
+
+def upload_index(
+    state: BackupState,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    index_path: str,
+    the_time: int,
+    skip: Collection[Destination] = ()
+) -> None:
+    # c14_index.txt is what makes new archives visible. The main destination gets it last, once
+    # every required mirror has acknowledged its copy. Destinations in skip (optional mirrors that
+    # missed an archive) don't get this run's index. That only holds until the next run: the index
+    # is the main destination's, so the next one they get lists the archives they missed as well.
+    main, *mirrors = destinations.get_destinations(state.config)
+
+    def upload_to(destination: Destination) -> None:
+        # A bad c14_index.txt is replaced, never deleted: it's the only remote copy of the index
+        for attempt in range(2):
+            with state.metrics.stage("upload") if destination is main else contextlib.nullcontext():
+                if destination.is_c14:
+                    session = ftp.connect(ftp_credentials, state.ftp_login)
+                    try:
+                        upload_index_c14(session, index_path, the_time)
+                    finally:
+                        session.quit()
+                else:
+                    upload_index_rclone(destination.remote, index_path)
+            try:
+                verify_uploads(state, destination, ftp_credentials, [{
+                    "name": "c14_index.txt",
+                    "size": os.path.getsize(index_path),
+                    "local_path": index_path,
+                    "delete": False
+                }])
+                return
+            except verify.VerificationError as e:
+                if attempt:
+                    raise
+                printc(f"# {e.message}. Uploading it to {destination.name} again", utils.BColors.YELLOW)
+
+    mirrors = [x for x in mirrors if x not in skip]
+    if mirrors:
+        destinations.check_results(destinations.fan_out(mirrors, upload_to), "c14_index.txt")
+    upload_to(main)
+
+
+def delete_local_copies(config: Config, archive_names: List[str], index_paths: List[str]) -> bool:
+    # Once they've been verified on the remote, the local copies of the archives
+    # and of the index are not needed anymore. Returns True if they've been deleted.
+    if not config["DELETE_VERIFIED_ARCHIVES"] or not config["VERIFY_UPLOADS"]:
+        return False
+    for path in archive_names + [archive.member_index_name(x) for x in archive_names] + index_paths:
+        if os.path.isfile(path):
+            os.remove(path)
+    return True
+
+
+class Pipeline:
+    # A backup cycle, one method per stage. Each stage leaves what the next ones need on the
+    # pipeline, so stages can be run (and tested) on their own. run() chains them the way a cycle does.
+    def __init__(self, state: BackupState, manifest: Optional[scanner.Manifest] = None, metadata_max_age: float = 0):
+        self.state = state
+        self.config = state.config
+        self.metrics = state.metrics
+        self.manifest = manifest
+        self.metadata_max_age = metadata_max_age
+        self.pending: Optional[dict] = None
+        self.ftp_credentials: Optional[ftp.FtpCredentials] = None
+        self.index: Optional[c14_index.C14Index] = None
+        self.the_time = 0
+        self.shards: List[sharding.Shard] = []
+
+    def run(self) -> bool:
+        # Returns True if a new archive has been uploaded
+        # If the previous run could not finish uploading its archive, do that first
+        self.pending = load_pending_upload()
+        if self.pending is None and not self.scan():
+            return False
+        if not self.connect():
+            return False
+        if self.pending is not None:
+            return resume_pending_upload(self.state, self.pending, self.ftp_credentials)
+        self.prepare_dictionary()
+        self.download_index()
+        self.plan_archives()
+        if self.config["STREAM_UPLOAD"]:
+            self.stream_archive()
+        else:
+            self.build_and_upload()
+        self.finish()
+        return True
+
+    def scan(self) -> bool:
+        # Continue only if temp folder is big enough. Returns False if there's nothing to archive.
+        # The manifest is built with a single scandir pass and reused for everything else.
+        # With deduplication, replays are hashed on a thread pool while the folder is being scanned.
+        config = self.config
+        store = dedup.DedupStore(config["DEDUP_STORE"]) if config["DEDUP_STORE"] else None
+        if self.manifest is None:
+            with self.metrics.stage("scan"):
+                if store is not None:
+                    self.manifest = dedup.scan("temp", store, workers=config["DEDUP_WORKERS"])
+                else:
+                    self.manifest = scanner.Manifest.scan("temp")
+        manifest = self.manifest
+        total_size = manifest.total_size
+        self.metrics.set("scanned_files", manifest.file_count)
+        self.metrics.set("scanned_bytes", total_size)
+        if not threshold_reached(config, total_size, manifest.file_count):
+            printc(
+                f"* Temp folder is too small ({total_size / 1024 / 1024} MB, {manifest.file_count} files). Aborting.",
+                utils.BColors.YELLOW
+            )
+            return False
+        if store is None:
+            return True
+
+        if not manifest.digest_size:
+            # Manifests from the daemon are not hashed yet
+            with self.metrics.stage("dedup"):
+                dedup.hash_manifest(manifest, store, workers=config["DEDUP_WORKERS"])
+        duplicates = manifest.duplicate_count
+        self.metrics.set("duplicate_files", duplicates)
+        if duplicates:
+            printc(
+                f"* {duplicates} replays have already been archived with the same content, skipping them",
+                utils.BColors.YELLOW
+            )
+        if duplicates == manifest.replay_count and not manifest.others:
+            printc("* Nothing new to archive", utils.BColors.YELLOW)
+            cleanup_temp(config, manifest, self.metrics)
+            return False
+        return True
+
+    def connect(self) -> bool:
+        # API checks and, with C14, the FTP credentials of the sync archive's temporary bucket.
+        # Returns False if the bucket is not available yet.
+        with self.metrics.stage("api"):
+            self.state.api_checks(max_age=self.metadata_max_age)
+        if not self.config.is_c14:
+            return True
+        self.ftp_credentials = self._c14_ftp_credentials()
+        return self.ftp_credentials is not None
+
+    def _sync_archives(self) -> List[dict]:
+        # The dates of the C14 archives are only parsed here, no need to import iso8601 otherwise
+        import iso8601
+
+        # Filter only desired C14 buckets by name and sort them by creation date (most recent first)
         sync_archives = sorted(
             [
                 {
                     **x,
                     "unix_creation_date": int(time.mktime(iso8601.parse_date(x["creation_date"]).timetuple()))
-                } for x in archives if x["name"].lower() == config["C14_SYNC_NAME"]
+                } for x in self.state.archives if x["name"].lower() == self.config["C14_SYNC_NAME"]
             ],
             key=lambda x: x["unix_creation_date"],
             reverse=True
@@ -73,7 +640,21 @@ try:
                 "Found sync archive(s), but not all of them are 'active'. "
                 "There's probably an (un)archive operation in progress. Retry later"
             )
+        return sync_archives
+
+    def _temp_bucket(self, sync_archive: dict) -> Optional[dict]:
+        try:
+            return self.state.client.request("{}/bucket".format(sync_archive["$ref"]))
+        except OnlineApiError as e:
+            if e.request.status_code != 404:
+                # Other error. 404 if there's no temporary space open
+                raise e
+        return None
 
+    def _c14_ftp_credentials(self) -> Optional[ftp.FtpCredentials]:
+        config = self.config
+        client = self.state.client
+        sync_archives = self._sync_archives()
 
         # Delete old sync archives if needed
         if len(sync_archives) > 1:
@@ -107,13 +688,13 @@ try:
         sync_archive = sync_archives[0]
 
         # Get temporary bucket from sync archive
-        temp_bucket = None
-        try:
-            temp_bucket = client.request("{}/bucket".format(sync_archive["$ref"]))
-        except OnlineApiError as e:
-            if e.request.status_code != 404:
-                # Other error. 404 if there's no temporary space open
-                raise e
+        temp_bucket = self._temp_bucket(sync_archive)
+        if temp_bucket is None:
+            # The archives list may come from the API cache or from a previous daemon cycle,
+            # get the current one before unarchiving something that may have been replaced
+            self.state.refresh_archives()
+            sync_archive = self._sync_archives()[0]
+            temp_bucket = self._temp_bucket(sync_archive)
 
         if temp_bucket is None:
             # This archive is archived!
@@ -166,7 +747,8 @@ try:
                 utils.telegram_notify(m, prefix=utils.TelegramPrefixes.NORMAL)
 
                 # Exit because we don't have a temporary bucket yet
-                sys.exit()
+                self.state.invalidate()
+                return None
             except OnlineApiError as e:
                 if e.request.status_code == 409:
                     # Operation already requested
@@ -200,137 +782,325 @@ try:
         if any(x is None for x in (ftp_user, ftp_host, ftp_port, ftp_password)):
             raise CriticalError("Could not determine ftp credentials")
         printc("* Found FTP credentials", utils.BColors.BLUE)
+        return ftp.FtpCredentials(ftp_host, ftp_port, ftp_user, ftp_password)
 
-    # Download tar gz index
-    printc("* Retreiving tar gz index", utils.BColors.BLUE)
-    if os.path.isfile("/tmp/c14_index.txt"):
-        os.remove("/tmp/c14_index.txt")
-    if config.is_c14:        
-        try:
-            session = ftplib.FTP()
-            session.connect(ftp_host, ftp_port)
-            session.login(ftp_user, ftp_password)
-            with open(f"/tmp/c14_index.txt", "wb") as f:
-                session.retrbinary(f"RETR c14_index.txt", f.write)
-        finally:
-            session.quit()
-    else:
-        # rclone copy 1580469306_replays_575.tar.gz gdrive:Bunker --progress
-        utils.rclone_copy(f"{config['RCLONE_REMOTE']}/c14_index.txt", "/tmp")
-        if not os.path.isfile("/tmp/c14_index.txt"):
+    def prepare_dictionary(self) -> None:
+        # Trains the zstd dictionary of the zstd-dict codec, if there's none or it's too old.
+        # Not when resuming an upload: the archives that are left must use the same dictionary.
+        if dictionaries.needs_dictionary(self.config):
+            with self.metrics.stage("dictionary"):
+                dictionaries.ensure(self.config)
+
+    def download_index(self) -> None:
+        config = self.config
+
+        # Download tar gz index
+        printc("* Retreiving tar gz index", utils.BColors.BLUE)
+        if os.path.isfile("/tmp/c14_index.txt"):
+            os.remove("/tmp/c14_index.txt")
+        with self.metrics.stage("index"):
+            if config.is_c14:
+                try:
+                    session = ftp.connect(self.ftp_credentials, self.state.ftp_login)
+                    with open(f"/tmp/c14_index.txt", "wb") as f:
+                        session.retrbinary(f"RETR c14_index.txt", f.write)
+                finally:
+                    session.quit()
+            else:
+                # rclone copy 1580469306_replays_575.tar.gz gdrive:Bunker --progress
+                utils.rclone_copy(f"{config['RCLONE_REMOTE']}/c14_index.txt", "/tmp")
+        if not config.is_c14 and not os.path.isfile("/tmp/c14_index.txt"):
             raise CriticalError("Cannot download c14_index with rclone. Local file not found.")
 
-    # Determine new archive id (last one in file)
-    old_archive_id = -1
-    with open("/tmp/c14_index.txt", "r") as f:
-        for line in f:
-            # Skip empty lines
-            if not line.strip():
-                continue
-            parts = line.split("\t")
-            old_archive_id = int(parts[0])
-
-    # Empty file
-    if old_archive_id < 0:
-        raise CriticalError("Could not determine the previous archive id from the tar gz index")
-
-    # Determine new archive and max replay id
-    new_archive_id = old_archive_id + 1
-    replay_ids = []
-
-    # Store all replay ids
-    for file in os.listdir("temp/"):
-        if not os.path.isfile(os.path.join("temp", file)) or not file.startswith("replay_") or not file.endswith(".osr"):
-            continue
-        replay_id = int(file[len("replay_"):-len(".osr")])
-        replay_ids.append(replay_id)
-    if not replay_ids:
-        raise CriticalError("No replays?")
-
-    # Get the max
-    max_replay_id = max(replay_ids)
-
-    # Update tmp c14 index with new archive id and max replay
-    with open("/tmp/c14_index.txt", "a") as f:
-        f.write(f"{new_archive_id}\t{max_replay_id}\n")
-    printc(f"* New archive id: {new_archive_id}, max replay id: {max_replay_id}", utils.BColors.BLUE)
-
-    # Hopefully the gc will take care of replay_ids
-    del replay_ids
-    gc.collect()
-
-    # Create .tar.gz with all replays
-    printc(f"* Creating tar gz file", utils.BColors.BLUE)
-    the_time = int(time.time())
-    tar_gz_name = f"{the_time}_replays_{new_archive_id}.tar.gz"
-    with tarfile.open(tar_gz_name, "w:gz") as tar:
-        for t_file in os.listdir("temp/"):
-            tar.add(os.path.join("temp", t_file), t_file)
-
-    # Upload
-    printc(f"* {tar_gz_name} created. Now uploading.", utils.BColors.BLUE)
-    if config.is_c14:
-        # C14
+        # Determine new archive id (last one in file)
         try:
-            session = ftplib.FTP()
-            session.connect(ftp_host, ftp_port)
-            session.login(ftp_user, ftp_password)
-
-            # Upload .tar.gz
-            with open(tar_gz_name, "rb") as f:
-                session.storbinary(f"STOR {tar_gz_name}", f)
-
-            # Upload c14 index
-            with open("/tmp/c14_index.txt", "rb") as f:
-                session.storbinary(f"STOR c14_index.txt", f)
-                session.storbinary(f"STOR {the_time}_c14_index.txt", f)
+            self.index = c14_index.C14Index.load_text("/tmp/c14_index.txt")
+        except ValueError as e:
+            raise CriticalError(f"Could not parse the tar gz index ({e})")
+
+        # Empty file
+        if self.index.last_archive_id is None:
+            raise CriticalError("Could not determine the previous archive id from the tar gz index")
+        if not self.index.sorted:
+            printc(
+                "* The max replay ids in the tar gz index are not increasing (older replays have been archived again), "
+                "replay lookups will be slower",
+                utils.BColors.YELLOW
+            )
+
+    def plan_archives(self) -> None:
+        config = self.config
+        manifest = self.manifest
+        index = self.index
+        if manifest.max_replay_id is None:
+            raise CriticalError("No replays?")
+
+        # Split the replays in contiguous id ranges, one archive each, with consecutive archive ids.
+        # Streaming uploads build a single archive.
+        self.the_time = int(time.time())
+        self.shards = shards = sharding.make_shards(
+            manifest,
+            config["ARCHIVE_SHARD_SIZE"] if not config["STREAM_UPLOAD"] else 0,
+            self.the_time,
+            index.last_archive_id + 1,
+            archive.get_codec(config["ARCHIVE_CODEC"]).extension
+        )
+
+        # Update tmp c14 index with the new archive ids and max replays
+        was_sorted = index.sorted
+        for shard in shards:
+            try:
+                index.append(shard.archive_id, shard.manifest.max_replay_id)
+            except ValueError as e:
+                raise CriticalError(f"Cannot update the tar gz index ({e})")
+            shard.manifest.save(manifest_name(shard.name))
+        if was_sorted and not index.sorted:
+            printc(
+                f"* Max replay id {manifest.max_replay_id} is lower than the previous archive's, "
+                "the tar gz index won't be sorted anymore",
+                utils.BColors.YELLOW
+            )
+        with open("/tmp/c14_index.txt", "a") as f:
+            for shard in shards:
+                f.write(f"{shard.archive_id}\t{shard.manifest.max_replay_id}\n")
+        printc(
+            f"* New archive ids: {shards[0].archive_id}-{shards[-1].archive_id}, max replay id: {manifest.max_replay_id}"
+            if len(shards) > 1 else f"* New archive id: {shards[0].archive_id}, max replay id: {manifest.max_replay_id}",
+            utils.BColors.BLUE
+        )
+
+    def stream_archive(self) -> None:
+        # Compress and upload at the same time, without writing the archive to disk first
+        config = self.config
+        tar_gz_name = self.shards[0].name
+        tar_members = self.shards[0].manifest.members()
+        # Lets restore.py fetch single replays without downloading the whole archive
+        member_index = archive.MemberIndex() if config["ARCHIVE_MEMBER_INDEX"] else None
+        printc(
+            f"* Creating {archive.get_codec(config['ARCHIVE_CODEC']).extension} file and streaming it",
+            utils.BColors.BLUE
+        )
+        spool_path = tar_gz_name if config["STREAM_SPOOL_ARCHIVE"] else None
+        algorithms = verify.DIGESTS if config["VERIFY_UPLOADS"] else ("sha256",)
+        all_destinations = destinations.get_destinations(config)
+        stream_start = time.monotonic()
+        session = ftp.connect(self.ftp_credentials, self.state.ftp_login) if config.is_c14 else None
+        try:
+            # One compressed stream, teed to every destination
+            uploads = {
+                x.name: (
+                    (lambda pipe: session.storbinary(f"STOR {tar_gz_name}", pipe, config["FTP_BLOCK_SIZE"]))
+                    if x.is_c14 else
+                    (lambda pipe, remote=x.remote: utils.rclone_rcat(pipe, f"{remote}/{tar_gz_name}"))
+                ) for x in all_destinations
+            }
+            stream_result = streaming.stream_archive(
+                tar_members,
+                config,
+                uploads,
+                optional=[x.name for x in all_destinations if not x.required],
+                spool_path=spool_path,
+                algorithms=algorithms,
+                member_index=member_index
+            )
         finally:
-            session.quit()
+            if session is not None:
+                session.quit()
+        # Compression and upload overlap, it all counts as upload time
+        self.metrics.add("stage_duration_seconds", time.monotonic() - stream_start, stage="upload")
+        self.metrics.add("archives")
+        self.metrics.add("archived_files", stream_result.members)
+        self.metrics.add("archive_bytes_in", stream_result.bytes_in)
+        self.metrics.add("archive_bytes_out", stream_result.size)
+        self.metrics.add("uploaded_bytes", stream_result.size)
+        results = [
+            destinations.FanOutResult(x, stream_result.uploads[x.name].error, stream_result.uploads[x.name].elapsed, 1)
+            for x in all_destinations
+        ]
+        record_destination_metrics(self.state, results, stream_result.size)
+        streamed = destinations.check_results(results, tar_gz_name)
+        printc(
+            f"* {tar_gz_name} uploaded ({stream_result.members} files, "
+            f"{stream_result.size / 1024 / 1024:.2f} MB, sha256 {stream_result.digests['sha256']})",
+            utils.BColors.BLUE
+        )
 
-        # TODO: Enable once we are sure online.net rearchive works
-        # printc(f"* Cleanup time! Deleting the tar gz file", utils.BColors.BLUE)
-        # os.remove(tar_gz_name)
-    else:
-        # rclone
-        utils.rclone_copy(tar_gz_name, config["RCLONE_REMOTE"], progress=True)
-        utils.rclone_copy("/tmp/c14_index.txt", config["RCLONE_REMOTE"])
+        # Without a spooled copy, the archive is checked by decompressing some of its blocks
+        checks = [{
+            "name": tar_gz_name,
+            "size": stream_result.size,
+            "local_path": spool_path,
+            "digests": stream_result.digests,
+            "index": member_index
+        }]
+        member_index_data = member_index.to_bytes() if member_index is not None else None
+        # Same as the one compressor_from_config used
+        dict_id = dictionaries.current(config)[0] if dictionaries.needs_dictionary(config) else 0
+        if member_index_data is not None:
+            checks.append({
+                "name": archive.member_index_name(tar_gz_name),
+                "size": len(member_index_data),
+                "digests": verify.data_digests(member_index_data, algorithms)
+            })
 
-    printc(f"* Emptying the temp folder as well", utils.BColors.BLUE)
-    # TODO: Delete only files in the replay ids array, so we avoid deleting unsynced files if new files are synced while taking the backup
-    for file in os.listdir("temp/"):
-        os.remove(os.path.join("temp", file))
+        def finish_upload(destination: Destination) -> None:
+            # The archive can't be streamed again, but the member index can be uploaded again
+            upload_dictionary(self.state, destination, self.ftp_credentials, dict_id)
+            if member_index_data is not None:
+                upload_bytes(
+                    self.state,
+                    destination,
+                    self.ftp_credentials,
+                    archive.member_index_name(tar_gz_name),
+                    member_index_data
+                )
+            verify_uploads(self.state, destination, self.ftp_credentials, checks)
 
-    printc(f"* Deleting temp tar gz index", utils.BColors.BLUE)
-    os.rename("/tmp/c14_index.txt", f"{the_time}_c14_index.txt")
-    # TODO: Remove line above and uncomment the line below once we are sure onlime.net rearchive works
-    # os.remove("/tmp/c14_index.txt")
+        succeeded = destinations.check_results(destinations.fan_out(streamed, finish_upload), tar_gz_name)
+        upload_index(
+            self.state,
+            self.ftp_credentials,
+            "/tmp/c14_index.txt",
+            self.the_time,
+            skip=[x for x in all_destinations if x not in succeeded]
+        )
 
-    # Finally done
-    utils.printc("* All done!", utils.BColors.GREEN)
-    utils.telegram_notify(f"A new chunked backup has been made and uploaded to C14 ({tar_gz_name})")
-    # TODO: Remove once we are sure online.net rearchive works
-    utils.telegram_notify(
-        "The .tar.gz and index file have not been deleted from local disk as a precaution in case online.net's rearchive does not work.",
-        prefix=utils.TelegramPrefixes.ALERT
-    )
-except CriticalError as e:
-    printc("# {}".format(e.message), utils.BColors.RED + utils.BColors.BOLD)
-    utils.telegram_notify(
-        "<b>Critical error during backup.</b>\n\n<code>{}</code>".format(e.message),
-        prefix=utils.TelegramPrefixes.ERROR
-    )
-    exit(-1)
-except OnlineApiError as e:
-    printc("# Online API Error", utils.BColors.RED)
-    printc("{}: {}".format(e.request.status_code, e.request.text), utils.BColors.RED)
-    utils.telegram_notify(
-        "<b>Online API Error during backup:</b>\n\n<code>{}: {}</code>".format(e.request.status_code, html.escape(e.request.text)),
-        prefix=utils.TelegramPrefixes.ERROR
-    )
-except Exception as e:
-    printc("# Unknown error while backing up ({})".format(str(e)), utils.BColors.RED)
-    tb = traceback.format_exc()
-    utils.telegram_notify(
-        "<b>Unhandled exception during backup.</b>\n\n<code>{}</code>".format(html.escape(tb)),
-        prefix=utils.TelegramPrefixes.ERROR
-    )
+    def build_and_upload(self) -> None:
+        config = self.config
+        # Remember what we're uploading, in case the upload gets interrupted
+        shutil.copyfile("/tmp/c14_index.txt", f"{self.the_time}_c14_index.txt")
+        save_pending_upload(self.shards, f"{self.the_time}_c14_index.txt", self.the_time)
+
+        # Each archive is uploaded as soon as it's ready, while the next ones are still being built
+        printc(
+            f"* Creating {len(self.shards)} {archive.get_codec(config['ARCHIVE_CODEC']).extension} file(s)",
+            utils.BColors.BLUE
+        )
+        failed = set()
+        for result in sharding.build_shards(self.shards, config, config["ARCHIVE_SHARD_WORKERS"]):
+            printc(
+                f"* {result.path} created ({result.files} files, compressed {result.bytes_in / 1024 / 1024:.2f} MB "
+                f"to {result.bytes_out / 1024 / 1024:.2f} MB in {result.elapsed:.1f} s). Now uploading.",
+                utils.BColors.BLUE
+            )
+            record_archive_metrics(self.metrics, result)
+            failed.update(upload_archive(self.state, self.ftp_credentials, result.path, result.digests))
+
+            # TODO: Enable once we are sure online.net rearchive works
+            # printc(f"* Cleanup time! Deleting the tar gz file", utils.BColors.BLUE)
+            # os.remove(result.path)
+        upload_index(self.state, self.ftp_credentials, "/tmp/c14_index.txt", self.the_time, skip=failed)
+
+    def finish(self) -> None:
+        config = self.config
+        state = self.state
+        record_archived(config, [self.manifest])
+        cleanup_temp(config, self.manifest, self.metrics)
+        if os.path.isfile(PENDING_UPLOAD_FILE):
+            os.remove(PENDING_UPLOAD_FILE)
+        delete_manifests([manifest_name(x.name) for x in self.shards])
+
+        printc(f"* Deleting temp tar gz index", utils.BColors.BLUE)
+        os.rename("/tmp/c14_index.txt", f"{self.the_time}_c14_index.txt")
+        # TODO: Remove line above and uncomment the line below once we are sure onlime.net rearchive works
+        # os.remove("/tmp/c14_index.txt")
+        # Everything has been checked on the remote by now
+        deleted = delete_local_copies(config, [x.name for x in self.shards], [f"{self.the_time}_c14_index.txt"])
+        if deleted:
+            printc("* Local copies of the archives deleted", utils.BColors.BLUE)
+
+        # Finally done
+        if config.is_c14:
+            printc(
+                f"* online.net API cache: {state.client.cache.hits} hits, {state.client.cache.misses} misses",
+                utils.BColors.BLUE
+            )
+            for endpoint, stats in sorted(state.client.stats.items()):
+                printc(
+                    f"* {endpoint}: {stats.calls} calls, {stats.retries} retries, "
+                    f"avg {stats.avg_time * 1000:.0f} ms, max {stats.max_time * 1000:.0f} ms",
+                    utils.BColors.BLUE
+                )
+        utils.printc("* All done!", utils.BColors.GREEN)
+        tar_gz_names = ", ".join(x.name for x in self.shards)
+        utils.telegram_notify(f"A new chunked backup has been made and uploaded to C14 ({tar_gz_names})")
+        # TODO: Remove once we are sure online.net rearchive works
+        if not deleted and (not config["STREAM_UPLOAD"] or config["STREAM_SPOOL_ARCHIVE"]):
+            utils.telegram_notify(
+                "The .tar.gz and index file have not been deleted from local disk as a precaution in case online.net's rearchive does not work.",
+                prefix=utils.TelegramPrefixes.ALERT
+            )
+
+
+def backup(state: BackupState, manifest: Optional[scanner.Manifest] = None, metadata_max_age: float = 0) -> bool:
+    # Runs a full backup cycle. Returns True if a new archive has been uploaded.
+    return Pipeline(state, manifest, metadata_max_age).run()
+
+
+def write_metrics(state: BackupState, api_before: dict, success: bool, error: Optional[str]) -> None:
+    config = state.config
+    record_api_metrics(state, api_before)
+    state.metrics.finish(success, error)
+    try:
+        if config["METRICS_TEXTFILE"]:
+            state.metrics.write_textfile(config["METRICS_TEXTFILE"])
+        if config["METRICS_JSON"]:
+            state.metrics.append_record(config["METRICS_JSON"])
+    except OSError as e:
+        printc(f"* Could not write the metrics ({e})", utils.BColors.YELLOW)
+
+
+def run_cycle(
+    state: BackupState,
+    manifest: Optional[scanner.Manifest] = None,
+    metadata_max_age: float = 0,
+    run_metrics: Optional[metrics.RunMetrics] = None
+) -> int:
+    # Runs a backup cycle, reporting errors. Returns the exit code.
+    # run_metrics can be passed to include what happened before the cycle (eg: the daemon's scan).
+    state.metrics = run_metrics if run_metrics is not None else metrics.RunMetrics()
+    api_before = api_stats_snapshot(state)
+    completed = False
+    error = None
+    try:
+        backup(state, manifest, metadata_max_age)
+        completed = True
+    except CriticalError as e:
+        error = e.message
+        state.invalidate()
+        printc("# {}".format(e.message), utils.BColors.RED + utils.BColors.BOLD)
+        utils.telegram_notify(
+            "<b>Critical error during backup.</b>\n\n<code>{}</code>".format(e.message),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+        return -1
+    except OnlineApiError as e:
+        error = f"Online API error ({e.request.status_code})"
+        state.invalidate()
+        printc("# Online API Error", utils.BColors.RED)
+        printc("{}: {}".format(e.request.status_code, e.request.text), utils.BColors.RED)
+        utils.telegram_notify(
+            "<b>Online API Error during backup:</b>\n\n<code>{}: {}</code>".format(e.request.status_code, html.escape(e.request.text)),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    except Exception as e:
+        error = str(e)
+        state.invalidate()
+        printc("# Unknown error while backing up ({})".format(str(e)), utils.BColors.RED)
+        tb = traceback.format_exc()
+        utils.telegram_notify(
+            "<b>Unhandled exception during backup.</b>\n\n<code>{}</code>".format(html.escape(tb)),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    finally:
+        write_metrics(state, api_before, completed, error)
+    return 0
+
+
+def main() -> int:
+    print_banner()
+    return run_cycle(BackupState(get_config()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,16 @@
-import requests
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, Union
+
+from online.cache import ResponseCache
+
+# requests takes longer to import than everything else oiseau needs, so it's imported
+# when a client is created (ie: only with the C14 backend)
+if TYPE_CHECKING:
+    import requests
 
 
 class OnlineApiError(Exception):
@@ -6,35 +18,149 @@ class OnlineApiError(Exception):
         self.request = request
 
 
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def __repr__(self):
+        return "<EndpointStats calls={} errors={} retries={} avg={:.3f}s max={:.3f}s>".format(
+            self.calls, self.errors, self.retries, self.avg_time, self.max_time
+        )
+
+
 class OnlineApiClient:
     API_BASE = "https://api.online.net"
 
-    def __init__(self, api_key):
+    # Methods that can be safely sent again if we don't know whether the first attempt went through
+    IDEMPOTENT_METHODS = {"get", "put", "delete", "head", "options"}
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    _ID_RE = re.compile(r"/(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)(?=/|$)", re.IGNORECASE)
+
+    def __init__(
+        self,
+        api_key,
+        *,
+        api_base: Optional[str] = None,
+        timeout: Union[float, Tuple[float, float]] = (10, 30),
+        max_retries: int = 4,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+        pool_size: int = 4,
+        cache: Optional[ResponseCache] = None
+    ):
         self.api_key = api_key
+        if api_base is not None:
+            self.API_BASE = api_base
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        # The cache file outlives the process, keep the responses we got with another API key apart
+        self._cache_prefix = hashlib.sha256(str(api_key).encode()).hexdigest()[:16]
+        self.stats: Dict[str, EndpointStats] = {}
+        self._stats_lock = threading.Lock()
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # A single session, so TCP+TLS connections are kept alive and reused between calls
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.auth_header)
+
+    def _endpoint(self, method: str, handler: str) -> str:
+        # Group calls to the same handler with different uuids together
+        return "{} /{}".format(method.upper(), self._ID_RE.sub("/{id}", handler.strip("/")))
+
+    def _record(self, endpoint: str, elapsed: float, error: bool, retries: int) -> None:
+        with self._stats_lock:
+            stats = self.stats.setdefault(endpoint, EndpointStats())
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.retries += retries
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+
+    def _retry_delay(self, attempt: int, response: Optional["requests.Response"] = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    return min(self.max_backoff, max(0.0, float(retry_after)))
+                except ValueError:
+                    pass
+        # Exponential backoff with jitter
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def request(self, handler, method="GET", data=None, json=None, cached=True):
+        # cached=False always asks the API (the response is still cached for next time)
+        import requests
 
-    def request(self, handler, method="GET", data=None, json=None):
         method = method.lower()
-        methods = {
-            "get": requests.get,
-            "post": requests.post,
-            "put": requests.put,
-            "patch": requests.patch,
-            "delete": requests.delete
-        }
-        r = methods[method](
-            url="{}/{}".format(self.API_BASE.rstrip("/"), handler.lstrip("/")),
-            headers=self.auth_header,
-            data=data,
-            json=json
-        )
-        if not 200 <= r.status_code <= 299:
+        idempotent = method in self.IDEMPOTENT_METHODS
+        endpoint = self._endpoint(method, handler)
+        url = "{}/{}".format(self.API_BASE.rstrip("/"), handler.lstrip("/"))
+        cache_key = "{}:{}".format(self._cache_prefix, handler.strip("/"))
+        cacheable = self.cache is not None and method == "get" and data is None and json is None
+        if cacheable and cached:
+            hit, value = self.cache.get(cache_key, endpoint)
+            if hit:
+                return value
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                r = self.session.request(method, url, data=data, json=json, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # If the connection could not be established, the request was not sent at all
+                can_retry = idempotent or isinstance(e, requests.ConnectTimeout)
+                if not can_retry or attempt >= self.max_retries:
+                    self._record(endpoint, time.monotonic() - start, True, attempt)
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            # 429 means that the request was not processed, so it's always safe to send it again
+            if (
+                r.status_code in self.RETRY_STATUS_CODES
+                and (idempotent or r.status_code == 429)
+                and attempt < self.max_retries
+            ):
+                time.sleep(self._retry_delay(attempt, r))
+                attempt += 1
+                continue
+            break
+
+        ok = 200 <= r.status_code <= 299
+        self._record(endpoint, time.monotonic() - start, not ok, attempt)
+        if self.cache is not None and (r.status_code in (401, 403, 404, 409) or (ok and method != "get")):
+            # Something changed (or we tried to change something), cached data may be stale
+            self.cache.clear()
+        if not ok:
             raise OnlineApiError(r)
 
         try:
-            return r.json()
+            value = r.json()
         except:
             # Some online.net api handlers return non-json data or nothing at all
-            return r.text
+            value = r.text
+        if cacheable:
+            self.cache.put(cache_key, endpoint, value)
+        return value
 
     @property
     def auth_header(self):
@@ -47,3 +173,6 @@ class OnlineApiClient:
             return self.request("api/v1/user")
         except OnlineApiError:
             return False
+
+    def close(self):
+        self.session.close()
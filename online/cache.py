@@ -0,0 +1,81 @@
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Optional, Pattern, Sequence, Tuple
+
+# (regex on the normalized endpoint, ttl in seconds). The first match wins, no match means "not cached".
+# The bucket is the cheap call that tells us whether the temporary space is still open,
+# so it's always validated against the API. Everything else changes only when an archive is
+# (un)archived, which either goes through us (any non-GET call clears the cache) or makes
+# the bucket/archive handlers return 404/409 (which clears the cache as well).
+DEFAULT_TTLS: Sequence[Tuple[str, float]] = (
+    (r"^GET /api/v1/user$", 3600),
+    (r"^GET /api/v1/storage/c14/archive$", 3600),
+    (r"^GET /.*/archive/\{id\}$", 3600),
+    (r"^GET /.*/archive/\{id\}/location$", 86400),
+    (r"^GET /.*/archive/\{id\}/bucket$", 0),
+)
+
+
+class ResponseCache:
+    # Small on-disk cache for online.net API responses. It may contain credentials,
+    # so the file is readable by its owner only.
+    def __init__(self, path: Optional[str], ttls: Sequence[Tuple[str, float]] = DEFAULT_TTLS):
+        self.path = path
+        self.ttls: Sequence[Tuple[Pattern, float]] = [(re.compile(k), v) for k, v in ttls]
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._load()
+
+    def ttl_for(self, endpoint: str) -> float:
+        for pattern, ttl in self.ttls:
+            if pattern.search(endpoint):
+                return ttl
+        return 0
+
+    def get(self, key: str, endpoint: str) -> Tuple[bool, Any]:
+        if self.ttl_for(endpoint) <= 0:
+            return False, None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key: str, endpoint: str, value: Any) -> None:
+        ttl = self.ttl_for(endpoint)
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.time() + ttl, value)
+        self._save()
+
+    def clear(self) -> None:
+        if self._entries:
+            self.invalidations += 1
+            self._entries.clear()
+            self._save()
+
+    def _load(self) -> None:
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            now = time.time()
+            self._entries = {k: (v[0], v[1]) for k, v in data.items() if v[0] >= now}
+        except (ValueError, TypeError, IndexError, KeyError, AttributeError, OSError):
+            # Corrupted cache, start from scratch
+            self._entries = {}
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
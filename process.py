@@ -0,0 +1,144 @@
+import os
+import selectors
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+
+class ProcessCancelled(Exception):
+    pass
+
+
+class ProcessResult(NamedTuple):
+    returncode: int
+    elapsed: float
+    # Last lines written to stderr, for error messages
+    stderr_tail: List[str]
+
+
+class _LineSplitter:
+    # Splits a byte stream in lines. Progress bars end lines with \r, so that counts as a line end too.
+    def __init__(self, callback: Optional[Callable[[str], Any]], tail: Optional[deque]):
+        self.callback = callback
+        self.tail = tail
+        self.buffer = b""
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data.replace(b"\r", b"\n")
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            self._emit(line)
+
+    def close(self) -> None:
+        if self.buffer:
+            self._emit(self.buffer)
+            self.buffer = b""
+
+    def _emit(self, line: bytes) -> None:
+        if not line:
+            return
+        text = line.decode("utf-8", errors="replace")
+        if self.tail is not None:
+            self.tail.append(text)
+        if self.callback is not None:
+            self.callback(text)
+
+
+def _terminate(process: subprocess.Popen, grace: float = 5) -> None:
+    process.terminate()
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_process(
+    args: Sequence[str],
+    *,
+    stdin=None,
+    on_stdout: Optional[Callable[[str], Any]] = None,
+    on_stderr: Optional[Callable[[str], Any]] = None,
+    timeout: Optional[float] = None,
+    cancel: Optional[threading.Event] = None,
+    chunk_size: int = 1024 * 1024,
+    tail: int = 20
+) -> ProcessResult:
+    # Runs args (no shell involved) and calls on_stdout/on_stderr with every line of output.
+    # Both pipes are drained at the same time, so a chatty process can't fill one of them and hang.
+    # If stdin is a file-like object, it's copied to the process' stdin from a separate thread.
+    # The process is terminated if it's still running after timeout seconds
+    # (raises subprocess.TimeoutExpired) or when cancel is set (raises ProcessCancelled).
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    process = subprocess.Popen(
+        list(args),
+        stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    feeder = None
+    feeder_error: List[BaseException] = []
+    if stdin is not None:
+        def _feed():
+            try:
+                while True:
+                    chunk = stdin.read(chunk_size)
+                    if not chunk:
+                        break
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                # The process exited, its exit code will tell us why
+                pass
+            except BaseException as e:
+                feeder_error.append(e)
+                process.terminate()
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        feeder = threading.Thread(target=_feed, name="process-stdin", daemon=True)
+        feeder.start()
+
+    stderr_tail: deque = deque(maxlen=tail)
+    splitters = {
+        process.stdout.fileno(): _LineSplitter(on_stdout, None),
+        process.stderr.fileno(): _LineSplitter(on_stderr, stderr_tail),
+    }
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        selector.register(process.stderr, selectors.EVENT_READ)
+        try:
+            while selector.get_map():
+                if cancel is not None and cancel.is_set():
+                    raise ProcessCancelled(f"{args[0]} has been cancelled")
+                wait = 0.5
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        raise subprocess.TimeoutExpired(list(args), timeout)
+                    wait = min(wait, deadline - time.monotonic())
+                for key, _ in selector.select(max(0.0, wait)):
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        splitters[key.fd].feed(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        splitters[key.fd].close()
+        except BaseException:
+            _terminate(process)
+            raise
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+
+    returncode = process.wait()
+    if feeder is not None:
+        # The process is gone, so the feeder stops at its next write at the latest
+        feeder.join()
+    if feeder_error:
+        raise feeder_error[0]
+    return ProcessResult(returncode, time.monotonic() - start, list(stderr_tail))
@@ -0,0 +1,134 @@
+import json
+import re
+import subprocess
+import threading
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from exceptions import CriticalError
+from process import run_process
+
+# "remote:path", as opposed to local paths. Single letters are Windows drives.
+_REMOTE_RE = re.compile(r"^([\w.\-]{2,}|:[\w]+)((?:,[^:]*)?):")
+
+
+class RcloneStats(NamedTuple):
+    bytes: int
+    total_bytes: int
+    # bytes/s
+    speed: float
+    # seconds, None if rclone doesn't know yet
+    eta: Optional[float]
+    transfers: int
+    total_transfers: int
+    errors: int
+    elapsed: float
+
+    @property
+    def percent(self) -> Optional[float]:
+        return self.bytes / self.total_bytes * 100 if self.total_bytes else None
+
+
+def parse_stats(line: str) -> Optional[RcloneStats]:
+    # With --use-json-log, rclone logs its periodic stats as json objects with a "stats" key
+    if not line.startswith("{"):
+        return None
+    try:
+        record = json.loads(line)
+        stats = record["stats"]
+        return RcloneStats(
+            bytes=int(stats.get("bytes", 0)),
+            total_bytes=int(stats.get("totalBytes", 0)),
+            speed=float(stats.get("speed", 0)),
+            eta=float(stats["eta"]) if stats.get("eta") is not None else None,
+            transfers=int(stats.get("transfers", 0)),
+            total_transfers=int(stats.get("totalTransfers", 0)),
+            errors=int(stats.get("errors", 0)),
+            elapsed=float(stats.get("elapsedTime", 0)),
+        )
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def with_backend_options(path: str, **options: Any) -> str:
+    # Overrides options of the remote's backend with rclone's connection string syntax
+    # ("remote,chunk_size=64M:path"), so we don't need to know which backend it is to set them.
+    # Local paths are returned as they are.
+    options = {k: v for k, v in options.items() if v not in (None, "")}
+    match = _REMOTE_RE.match(path)
+    if not options or match is None:
+        return path
+    extra = "".join(f",{k}={v}" for k, v in options.items())
+    return f"{match.group(1)}{match.group(2)}{extra}:{path[match.end():]}"
+
+
+def rclone_args(
+    command: str,
+    *paths: str,
+    transfers: int = 0,
+    chunk_size: str = "",
+    stats_interval: float = 5
+) -> List[str]:
+    args = [
+        "rclone", command,
+        "--use-json-log",
+        "--stats", f"{stats_interval:g}s",
+        "--stats-log-level", "NOTICE",
+    ]
+    if transfers > 0:
+        args += ["--transfers", str(transfers)]
+    # The chunk size only matters where we write
+    *sources, dest = paths
+    return args + sources + [with_backend_options(dest, chunk_size=chunk_size)]
+
+
+def run(
+    command: str,
+    *paths: str,
+    stdin=None,
+    transfers: int = 0,
+    chunk_size: str = "",
+    on_stats: Optional[Callable[[RcloneStats], Any]] = None,
+    on_log: Optional[Callable[[str, str], Any]] = None,
+    timeout: Optional[float] = None,
+    cancel: Optional[threading.Event] = None
+) -> Optional[RcloneStats]:
+    # Runs an rclone command, calling on_stats with every stats update and on_log(level, message)
+    # with everything else rclone logs. Returns the last stats update.
+    last_stats: List[RcloneStats] = []
+
+    def _on_stderr(line: str) -> None:
+        stats = parse_stats(line)
+        if stats is not None:
+            last_stats[:] = [stats]
+            if on_stats is not None:
+                on_stats(stats)
+            return
+        if on_log is None:
+            return
+        try:
+            record = json.loads(line)
+            on_log(record.get("level", "info"), record.get("msg", line).strip())
+        except (ValueError, AttributeError):
+            on_log("info", line)
+
+    args = rclone_args(command, *paths, transfers=transfers, chunk_size=chunk_size)
+    try:
+        result = run_process(
+            args,
+            stdin=stdin,
+            on_stdout=(lambda line: on_log("info", line)) if on_log is not None else None,
+            on_stderr=_on_stderr,
+            timeout=timeout,
+            cancel=cancel
+        )
+    except subprocess.TimeoutExpired:
+        raise CriticalError(f"rclone {command} did not complete in {timeout:g} seconds")
+    if result.returncode != 0:
+        message = f"rclone {command} failed with exit code {result.returncode}"
+        if result.stderr_tail:
+            try:
+                message += f": {json.loads(result.stderr_tail[-1])['msg'].strip()}"
+            except (ValueError, KeyError, TypeError, AttributeError):
+                message += f": {result.stderr_tail[-1]}"
+        raise CriticalError(message)
+    return last_stats[0] if last_stats else None
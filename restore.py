@@ -0,0 +1,378 @@
+import argparse
+import ftplib
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import archive
+import c14_index
+import dictionaries
+import ftp
+import scanner
+from exceptions import CriticalError
+
+
+class Source:
+    # Somewhere archives can be read from
+    def list(self) -> List[str]:
+        raise NotImplementedError()
+
+    def read(self, name: str) -> bytes:
+        raise NotImplementedError()
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        raise NotImplementedError()
+
+    def size(self, name: str) -> Optional[int]:
+        # None if the file does not exist
+        raise NotImplementedError()
+
+    def digests(self, name: str, algorithms: Iterable[str]) -> Dict[str, str]:
+        # Hashes of the file computed (or stored) by the remote, for the algorithms it supports.
+        # Used to check uploads without downloading them.
+        return {}
+
+    def delete(self, name: str) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class LocalSource(Source):
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def list(self) -> List[str]:
+        return os.listdir(self.folder)
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.folder, name), "rb") as f:
+            return f.read()
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        with open(os.path.join(self.folder, name), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def size(self, name: str) -> Optional[int]:
+        try:
+            return os.path.getsize(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            return None
+
+    def digests(self, name: str, algorithms: Iterable[str]) -> Dict[str, str]:
+        hashes = {x: hashlib.new(x) for x in algorithms}
+        with open(os.path.join(self.folder, name), "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                for h in hashes.values():
+                    h.update(data)
+        return {k: v.hexdigest() for k, v in hashes.items()}
+
+    def delete(self, name: str) -> None:
+        os.remove(os.path.join(self.folder, name))
+
+
+class FtpSource(Source):
+    # HASH (draft-bryan-ftpext-hash) and the older X* commands, by hashlib name
+    HASH_NAMES = {"md5": "MD5", "sha1": "SHA-1", "sha256": "SHA-256"}
+    X_COMMANDS = {"md5": "XMD5", "sha1": "XSHA1", "sha256": "XSHA256"}
+
+    def __init__(self, credentials: ftp.FtpCredentials, login: Optional[Callable[[ftplib.FTP, str, str], Any]] = None):
+        self.session = ftp.connect(credentials, login)
+        self._features: Optional[List[str]] = None
+
+    def list(self) -> List[str]:
+        return self.session.nlst()
+
+    def read(self, name: str) -> bytes:
+        data = bytearray()
+        self.session.retrbinary(f"RETR {name}", data.extend)
+        return bytes(data)
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        # Start the transfer at offset with REST and close the data connection
+        # as soon as we have what we need
+        self.session.voidcmd("TYPE I")
+        data = bytearray()
+        with self.session.transfercmd(f"RETR {name}", rest=offset) as conn:
+            while len(data) < length:
+                chunk = conn.recv(min(1024 * 1024, length - len(data)))
+                if not chunk:
+                    break
+                data += chunk
+        try:
+            # 226 if the transfer was complete, 426/451 if we closed it early
+            self.session.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            pass
+        return bytes(data)
+
+    def size(self, name: str) -> Optional[int]:
+        return ftp.remote_size(self.session, name)
+
+    def features(self) -> List[str]:
+        if self._features is None:
+            try:
+                response = self.session.sendcmd("FEAT")
+            except ftplib.error_perm:
+                response = ""
+            # "211-Features:", one " FEATURE args" line each, "211 End"
+            self._features = [x.strip() for x in response.splitlines()[1:-1]]
+        return self._features
+
+    def digests(self, name: str, algorithms: Iterable[str]) -> Dict[str, str]:
+        # The server reads the whole file, but nothing goes over the network
+        features = self.features()
+        hash_feature = next((x for x in features if x.upper().startswith("HASH ")), None)
+        supported = [x.rstrip("*").upper() for x in hash_feature[5:].split(";")] if hash_feature else []
+        result = {}
+        for algorithm in algorithms:
+            try:
+                if self.HASH_NAMES.get(algorithm) in supported:
+                    self.session.sendcmd(f"OPTS HASH {self.HASH_NAMES[algorithm]}")
+                    # "213 SHA-256 0-49 169cd22282da7f147cb491e559e9dd filename"
+                    result[algorithm] = self.session.sendcmd(f"HASH {name}").split(" ", 4)[3].lower()
+                elif self.X_COMMANDS.get(algorithm) in features:
+                    # "250 169cd22282da7f147cb491e559e9dd"
+                    result[algorithm] = self.session.sendcmd(f"{self.X_COMMANDS[algorithm]} {name}").split()[1].lower()
+            except (ftplib.error_perm, IndexError):
+                continue
+        return result
+
+    def delete(self, name: str) -> None:
+        self.session.delete(name)
+
+    def close(self) -> None:
+        self.session.quit()
+
+
+class RcloneSource(Source):
+    def __init__(self, remote: str):
+        self.remote = remote.rstrip("/")
+
+    def _run(self, *args: str, quiet: bool = False) -> bytes:
+        return subprocess.run(
+            ["rclone", *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if quiet else None, check=True
+        ).stdout
+
+    def _stat(self, name: str) -> Optional[dict]:
+        # rclone lsjson lists a single file if given its path. The hashes are the ones
+        # the backend has (eg: md5 for S3 and Drive, sha1 for B2), most don't need a download.
+        try:
+            # Fails if the file doesn't exist, that's not worth an error message
+            entries = json.loads(self._run("lsjson", "--hash", "--files-only", f"{self.remote}/{name}", quiet=True))
+        except subprocess.CalledProcessError:
+            return None
+        return entries[0] if entries else None
+
+    def list(self) -> List[str]:
+        return self._run("lsf", self.remote).decode("utf-8").splitlines()
+
+    def read(self, name: str) -> bytes:
+        return self._run("cat", f"{self.remote}/{name}")
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        return self._run("cat", "--offset", str(offset), "--count", str(length), f"{self.remote}/{name}")
+
+    def size(self, name: str) -> Optional[int]:
+        entry = self._stat(name)
+        return entry["Size"] if entry is not None else None
+
+    def digests(self, name: str, algorithms: Iterable[str]) -> Dict[str, str]:
+        entry = self._stat(name)
+        hashes = (entry.get("Hashes") or {}) if entry is not None else {}
+        return {x: hashes[x].lower() for x in algorithms if hashes.get(x)}
+
+    def delete(self, name: str) -> None:
+        self._run("deletefile", f"{self.remote}/{name}")
+
+
+class SplitSource(Source):
+    # Archives uploaded in parts (FTP_PART_SIZE) only exist as {name}.partNNNN files, listed
+    # in order in {name}.parts.json. This shows them as a single file on top of another source,
+    # reading ranges from the parts they overlap. Other files are passed through.
+    PART_RE = re.compile(r"\.part\d+$")
+    MANIFEST_SUFFIX = ftp.parts_manifest_name("")
+
+    def __init__(self, source: Source):
+        self.source = source
+        # name -> parts manifest (None until it's been read), for the split archives we know of
+        self._split: Dict[str, Optional[dict]] = {}
+        # Names we know are not split
+        self._whole = set()
+
+    def list(self) -> List[str]:
+        names = []
+        for x in self.source.list():
+            if x.endswith(self.MANIFEST_SUFFIX):
+                name = x[:-len(self.MANIFEST_SUFFIX)]
+                self._split.setdefault(name, None)
+                names.append(name)
+            elif not self.PART_RE.search(x):
+                self._whole.add(x)
+                names.append(x)
+        return names
+
+    def _manifest(self, name: str) -> Optional[dict]:
+        # The parts manifest of name, None if it's not split
+        if name in self._whole:
+            return None
+        if self._split.get(name) is None:
+            if name not in self._split and self.source.size(ftp.parts_manifest_name(name)) is None:
+                self._whole.add(name)
+                return None
+            self._split[name] = json.loads(self.source.read(ftp.parts_manifest_name(name)))
+        return self._split[name]
+
+    def read(self, name: str) -> bytes:
+        manifest = self._manifest(name)
+        if manifest is None:
+            return self.source.read(name)
+        return self.read_range(name, 0, manifest["size"])
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        manifest = self._manifest(name)
+        if manifest is None:
+            return self.source.read_range(name, offset, length)
+        data = bytearray()
+        end = offset + length
+        for part in manifest["parts"]:
+            part_end = part["offset"] + part["size"]
+            if part_end <= offset or part["offset"] >= end:
+                continue
+            start = max(offset, part["offset"])
+            data += self.source.read_range(part["name"], start - part["offset"], min(end, part_end) - start)
+        return bytes(data)
+
+    def size(self, name: str) -> Optional[int]:
+        manifest = self._manifest(name)
+        return self.source.size(name) if manifest is None else manifest["size"]
+
+    def digests(self, name: str, algorithms: Iterable[str]) -> Dict[str, str]:
+        # There's no remote file to hash
+        return {} if self._manifest(name) is not None else self.source.digests(name, algorithms)
+
+    def delete(self, name: str) -> None:
+        manifest = self._manifest(name)
+        if manifest is None:
+            self.source.delete(name)
+            return
+        for part in manifest["parts"]:
+            self.source.delete(part["name"])
+        self.source.delete(ftp.parts_manifest_name(name))
+        del self._split[name]
+
+    def close(self) -> None:
+        self.source.close()
+
+
+def load_dictionary(source: Source, index: archive.MemberIndex) -> None:
+    # Archives compressed with a zstd dictionary can't be read without it, it's next to them
+    if not index.dictionary:
+        return
+    # KeyError if it's not there, ValueError if it's not the right one. Read errors are left alone.
+    codec = archive.get_codec(index.codec)
+    if index.dictionary in codec.dictionaries:
+        return
+    name = dictionaries.dictionary_name(index.dictionary)
+    if source.size(name) is None:
+        raise KeyError(f"{name} is not on the remote")
+    try:
+        dict_id = codec.add_dictionary(source.read(name))
+    except CriticalError as e:
+        raise ValueError(f"{name}: {e.message}")
+    if dict_id != index.dictionary:
+        raise ValueError(f"{name} is not dictionary {index.dictionary}")
+
+
+def restore_member(source: Source, archive_name: str, member_name: str) -> bytes:
+    # Fetches only the compressed blocks that contain member_name
+    index = archive.MemberIndex.from_bytes(source.read(archive.member_index_name(archive_name)))
+    load_dictionary(source, index)
+    found = index.find(member_name)
+    if found is None:
+        raise KeyError(f"{member_name} is not in {archive_name}")
+    offset, size = found
+    first, last, start, end = index.compressed_range(offset, size)
+    compressed = source.read_range(archive_name, start, end - start)
+    if len(compressed) != end - start:
+        raise IOError(f"Short read from {archive_name} ({len(compressed)}/{end - start} bytes)")
+    return index.extract(offset, size, compressed, first, last)
+
+
+def find_archive(source: Source, archive_id: int) -> Optional[str]:
+    # Archives are called {time}_replays_{id}.tar.{gz,xz,zst}, if there's more than one
+    # (eg: the upload has been retried), use the most recent one
+    pattern = re.compile(r"^(\d+)_replays_{}\.tar\.\w+$".format(archive_id))
+    matches = [x for x in source.list() if pattern.match(os.path.basename(x))]
+    return max(matches, key=lambda x: int(pattern.match(os.path.basename(x)).group(1))) if matches else None
+
+
+def restore_replay(source: Source, replay_id: int) -> bytes:
+    index_data = source.read("c14_index.bin")
+    index = c14_index.C14Index.from_bytes(index_data)
+    candidates = index.candidates(replay_id)
+    if not candidates:
+        raise KeyError(f"Replay {replay_id} has not been archived yet")
+    # More than one if older replays have been archived again (unsorted index)
+    for i, archive_id in enumerate(candidates):
+        last = i == len(candidates) - 1
+        archive_name = find_archive(source, archive_id)
+        if archive_name is None:
+            if last:
+                raise KeyError(f"Archive {archive_id} not found")
+            continue
+        try:
+            return restore_member(source, archive_name, scanner.replay_file_name(replay_id))
+        except KeyError:
+            if last:
+                raise
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Restore single files from oiseau archives")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--local", metavar="FOLDER", help="read archives from a local folder")
+    group.add_argument("--rclone", metavar="REMOTE", help="read archives from an rclone remote")
+    group.add_argument("--ftp", metavar="HOST:PORT", help="read archives from an FTP server (eg: C14)")
+    parser.add_argument("--ftp-user", default="")
+    parser.add_argument("--ftp-password", default="")
+    what = parser.add_mutually_exclusive_group(required=True)
+    what.add_argument("--replay", type=int, help="replay id (uses c14_index.bin to find the archive)")
+    what.add_argument("--member", nargs=2, metavar=("ARCHIVE", "NAME"), help="archive name and member name")
+    parser.add_argument("-o", "--output", default=None, help="output file (default: the member name)")
+    args = parser.parse_args(argv)
+
+    if args.local is not None:
+        source = LocalSource(args.local)
+    elif args.rclone is not None:
+        source = RcloneSource(args.rclone)
+    else:
+        host, port = args.ftp.rsplit(":", 1)
+        source = FtpSource(ftp.FtpCredentials(host, int(port), args.ftp_user, args.ftp_password))
+    source = SplitSource(source)
+    try:
+        if args.replay is not None:
+            data = restore_replay(source, args.replay)
+            output = args.output or scanner.replay_file_name(args.replay)
+        else:
+            data = restore_member(source, *args.member)
+            output = args.output or os.path.basename(args.member[1])
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    finally:
+        source.close()
+    with open(output, "wb") as f:
+        f.write(data)
+    print(f"{output} ({len(data)} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from archive import TarMember
+
+REPLAY_PREFIX = "replay_"
+REPLAY_SUFFIX = ".osr"
+
+_MAGIC = b"OISM"
+_VERSION = 2
+# magic, version, digest size, replays, other files
+_HEADER = struct.Struct("<4sBBxxQQ")
+
+# Replay flags
+DUPLICATE = 1
+
+
+class OtherFile(NamedTuple):
+    name: str
+    size: int
+    mtime: float
+
+
+def replay_file_name(replay_id: int) -> str:
+    return f"{REPLAY_PREFIX}{replay_id}{REPLAY_SUFFIX}"
+
+
+def parse_replay_id(name: str) -> Optional[int]:
+    if not name.startswith(REPLAY_PREFIX) or not name.endswith(REPLAY_SUFFIX):
+        return None
+    digits = name[len(REPLAY_PREFIX):-len(REPLAY_SUFFIX)]
+    try:
+        replay_id = int(digits)
+    except ValueError:
+        return None
+    # The manifest only keeps the id and rebuilds the name from it, so names that
+    # don't round trip (replay_007.osr, replay_-5.osr, replay_+5.osr) aren't replays
+    if replay_id < 0 or str(replay_id) != digits:
+        return None
+    return replay_id
+
+
+class IdStats:
+    # Streaming reducer over the replay ids seen while scanning, O(1) memory.
+    # File names are unique, so the ids are too and the number of missing ids
+    # between min and max can be derived from the count.
+    def __init__(self):
+        self.count = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    def add(self, replay_id: int) -> None:
+        self.count += 1
+        if self.min is None or replay_id < self.min:
+            self.min = replay_id
+        if self.max is None or replay_id > self.max:
+            self.max = replay_id
+
+    def update(self, replay_ids: Iterable[int]) -> None:
+        for replay_id in replay_ids:
+            self.add(replay_id)
+
+    @property
+    def gaps(self) -> int:
+        return self.max - self.min + 1 - self.count if self.count else 0
+
+    def __repr__(self):
+        return f"<IdStats count={self.count} min={self.min} max={self.max} gaps={self.gaps}>"
+
+
+class ReplayIdSet:
+    # Compact, immutable set of replay ids. Dense ids (a range at most 64 times the number
+    # of ids) are stored as a bitmap relative to the smallest id, 1 bit per id in the range.
+    # Sparse ones are stored as a sorted array and searched with bisect, 8 bytes per id.
+    # Either way it's at most 8 bytes per id, against ~100 for a python set of ints.
+    def __init__(self, replay_ids: Sequence[int], stats: Optional[IdStats] = None):
+        if stats is None:
+            stats = IdStats()
+            stats.update(replay_ids)
+        self.stats = stats
+        self._bitmap: Optional[bytearray] = None
+        self._sorted: Optional[array] = None
+        if not stats.count:
+            self._sorted = array("Q")
+        elif stats.max - stats.min < stats.count * 64:
+            self._bitmap = bytearray((stats.max - stats.min) // 8 + 1)
+            for replay_id in replay_ids:
+                i = replay_id - stats.min
+                self._bitmap[i >> 3] |= 1 << (i & 7)
+        else:
+            self._sorted = array("Q", sorted(replay_ids))
+
+    def __len__(self) -> int:
+        return self.stats.count
+
+    def __contains__(self, replay_id: int) -> bool:
+        if self._bitmap is not None:
+            i = replay_id - self.stats.min
+            return 0 <= i < len(self._bitmap) * 8 and bool(self._bitmap[i >> 3] & (1 << (i & 7)))
+        i = bisect_left(self._sorted, replay_id)
+        return i < len(self._sorted) and self._sorted[i] == replay_id
+
+    @property
+    def nbytes(self) -> int:
+        if self._bitmap is not None:
+            return len(self._bitmap)
+        return len(self._sorted) * self._sorted.itemsize
+
+
+class Manifest:
+    # Snapshot of a folder, built with a single scandir pass. Replays are stored in
+    # parallel arrays (id, size, mtime, flags: 25 bytes per file) instead of python objects,
+    # any other regular file is kept in a (small) list. If the replays have been hashed
+    # (see dedup.py), digests holds digest_size bytes per replay.
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.ids = array("Q")
+        self.sizes = array("Q")
+        self.mtimes = array("d")
+        self.flags = array("B")
+        self.digest_size = 0
+        self.digests = bytearray()
+        self.others: List[OtherFile] = []
+        self.total_size = 0
+        self.id_stats = IdStats()
+
+    @classmethod
+    def scan(cls, folder: str, on_replay: Optional[Callable[[int, str], Any]] = None) -> "Manifest":
+        # on_replay(i, path) is called for every replay as soon as it's found
+        manifest = cls(folder)
+        with os.scandir(folder) as it:
+            for entry in it:
+                # is_file() uses d_type, stat() is cached by the DirEntry
+                # so we get away with one syscall per file
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if manifest.add(entry.name, st.st_size, st.st_mtime) and on_replay is not None:
+                    on_replay(len(manifest.ids) - 1, entry.path)
+        return manifest
+
+    def add(self, name: str, size: int, mtime: float, flags: int = 0, digest: Optional[bytes] = None) -> bool:
+        # Returns whether the file is a replay
+        replay_id = parse_replay_id(name)
+        self.total_size += size
+        if replay_id is None:
+            self.others.append(OtherFile(name, size, mtime))
+            return False
+        self.ids.append(replay_id)
+        self.id_stats.add(replay_id)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.flags.append(flags)
+        if digest is not None:
+            self.digests += digest
+        return True
+
+    def digest(self, i: int) -> Optional[bytes]:
+        if not self.digest_size:
+            return None
+        return bytes(self.digests[i * self.digest_size:(i + 1) * self.digest_size])
+
+    @property
+    def duplicate_count(self) -> int:
+        return self.flags.count(DUPLICATE)
+
+    @property
+    def replay_count(self) -> int:
+        return len(self.ids)
+
+    @property
+    def file_count(self) -> int:
+        return len(self.ids) + len(self.others)
+
+    @property
+    def max_replay_id(self) -> Optional[int]:
+        return self.id_stats.max
+
+    def id_set(self) -> ReplayIdSet:
+        return ReplayIdSet(self.ids, self.id_stats)
+
+    def __len__(self) -> int:
+        return self.file_count
+
+    def entry(self, i: int) -> Tuple[str, int, float]:
+        # (name, size, mtime) of the i-th file, replays first
+        if i < len(self.ids):
+            return replay_file_name(self.ids[i]), self.sizes[i], self.mtimes[i]
+        other = self.others[i - len(self.ids)]
+        return other.name, other.size, other.mtime
+
+    def names(self) -> Iterator[str]:
+        for replay_id in self.ids:
+            yield replay_file_name(replay_id)
+        for other in self.others:
+            yield other.name
+
+    def paths(self) -> Iterator[str]:
+        for name in self.names():
+            yield os.path.join(self.folder, name)
+
+    def members(self) -> Iterator[TarMember]:
+        # Stat results from the scan are reused, tarfile does not stat the files again.
+        # Replays that are already archived with the same content are skipped.
+        for replay_id, size, mtime, flags in zip(self.ids, self.sizes, self.mtimes, self.flags):
+            if flags & DUPLICATE:
+                continue
+            name = replay_file_name(replay_id)
+            yield TarMember(os.path.join(self.folder, name), name, size, mtime)
+        for other in self.others:
+            yield TarMember(os.path.join(self.folder, other.name), other.name, other.size, other.mtime)
+
+    def save(self, path: str) -> None:
+        # Binary format: header, then the raw arrays (and digests), then the other files as
+        # "name\tsize\tmtime" utf-8 lines
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.digest_size, len(self.ids), len(self.others)))
+            self.ids.tofile(f)
+            self.sizes.tofile(f)
+            self.mtimes.tofile(f)
+            self.flags.tofile(f)
+            f.write(self.digests)
+            for other in self.others:
+                f.write(f"{other.name}\t{other.size}\t{other.mtime!r}\n".encode("utf-8"))
+
+    @classmethod
+    def load(cls, path: str, folder: str) -> "Manifest":
+        manifest = cls(folder)
+        with open(path, "rb") as f:
+            magic, version, digest_size, replays, others = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or version not in (1, _VERSION):
+                raise ValueError(f"{path} is not a valid manifest file")
+            manifest.ids.fromfile(f, replays)
+            manifest.sizes.fromfile(f, replays)
+            manifest.mtimes.fromfile(f, replays)
+            if version >= 2:
+                manifest.flags.fromfile(f, replays)
+                manifest.digest_size = digest_size
+                manifest.digests = bytearray(f.read(digest_size * replays))
+            else:
+                manifest.flags = array("B", bytes(replays))
+            for _ in range(others):
+                name, size, mtime = f.readline().decode("utf-8").rstrip("\n").split("\t")
+                manifest.others.append(OtherFile(name, int(size), float(mtime)))
+        manifest.id_stats.update(manifest.ids)
+        manifest.total_size = sum(manifest.sizes) + sum(x.size for x in manifest.others)
+        return manifest
+
+
+class CleanupResult(NamedTuple):
+    deleted: int
+    changed: int
+    missing: int
+    elapsed: float
+
+    @property
+    def rate(self) -> float:
+        return self.deleted / self.elapsed if self.elapsed else 0.0
+
+
+def _remove_unchanged_batch(manifest: Manifest, start: int, end: int) -> Tuple[int, int, int]:
+    deleted = changed = missing = 0
+    for i in range(start, end):
+        name, size, mtime = manifest.entry(i)
+        path = os.path.join(manifest.folder, name)
+        try:
+            # Same as the scan's DirEntry.stat(), which follows symlinks
+            st = os.stat(path)
+        except FileNotFoundError:
+            missing += 1
+            continue
+        if st.st_size != size or st.st_mtime != mtime:
+            # Re-synced after the snapshot, what's in the archive is not what's on disk
+            changed += 1
+            continue
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            missing += 1
+    return deleted, changed, missing
+
+
+def remove_unchanged(manifest: Manifest, *, workers: int = 8, batch_size: int = 1000) -> CleanupResult:
+    # Deletes the files in the manifest, skipping the ones whose size or mtime changed since
+    # the snapshot. Files that are not in the manifest are never touched. unlink is latency bound
+    # on network/overlay filesystems, so batches are deleted on a thread pool.
+    start_time = time.monotonic()
+    deleted = changed = missing = 0
+    workers = max(1, workers)
+    batch_size = max(1, batch_size)
+    with ThreadPoolExecutor(workers) as executor:
+        # Keep a bounded number of batches in flight instead of submitting millions of files at once
+        pending = []
+        for start in range(0, len(manifest), batch_size):
+            pending.append(executor.submit(_remove_unchanged_batch, manifest, start, min(start + batch_size, len(manifest))))
+            if len(pending) >= workers * 2:
+                d, c, m = pending.pop(0).result()
+                deleted, changed, missing = deleted + d, changed + c, missing + m
+        for future in pending:
+            d, c, m = future.result()
+            deleted, changed, missing = deleted + d, changed + c, missing + m
+    return CleanupResult(deleted, changed, missing, time.monotonic() - start_time)
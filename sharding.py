@@ -0,0 +1,143 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import archive
+import dictionaries
+import scanner
+import streaming
+import verify
+
+
+class Shard(NamedTuple):
+    archive_id: int
+    name: str
+    manifest: scanner.Manifest
+
+
+class ShardResult(NamedTuple):
+    archive_id: int
+    path: str
+    files: int
+    bytes_in: int
+    bytes_out: int
+    elapsed: float
+    # Of the compressed archive, computed while it was written
+    digests: Dict[str, str]
+
+
+def split_manifest(manifest: scanner.Manifest, shard_size: int) -> List[scanner.Manifest]:
+    # Splits manifest in contiguous replay id ranges of about shard_size bytes each
+    # (a shard is closed as soon as it reaches shard_size). Files that are not replays go in
+    # the last shard. The sort order is a transient list of one int per replay.
+    order = sorted(range(manifest.replay_count), key=manifest.ids.__getitem__)
+    shards: List[scanner.Manifest] = []
+    current = None
+    current_size = 0
+    for i in order:
+        if current is None or current_size >= shard_size:
+            current = scanner.Manifest(manifest.folder)
+            current.digest_size = manifest.digest_size
+            current_size = 0
+            shards.append(current)
+        current.add(
+            scanner.replay_file_name(manifest.ids[i]),
+            manifest.sizes[i],
+            manifest.mtimes[i],
+            manifest.flags[i],
+            manifest.digest(i)
+        )
+        if not manifest.flags[i] & scanner.DUPLICATE:
+            current_size += manifest.sizes[i]
+    if not shards:
+        shards.append(scanner.Manifest(manifest.folder))
+    for other in manifest.others:
+        shards[-1].add(other.name, other.size, other.mtime)
+    return shards
+
+
+def build_archive(
+    archive_id: int,
+    manifest: scanner.Manifest,
+    path: str,
+    *,
+    codec: str,
+    level: int,
+    workers: int,
+    block_size: int,
+    member_index: bool,
+    digests: Sequence[str] = (),
+    dictionary: Optional[bytes] = None
+) -> ShardResult:
+    # Writes manifest's files to the archive at path (and its member index next to it).
+    # The archive gets its final name only once it's complete. Top-level so it can run in a worker process.
+    start = time.monotonic()
+    index = archive.MemberIndex() if member_index else None
+    with open(f"{path}.tmp", "wb") as f:
+        tee = streaming.HashingTee([f], digests)
+        compressor = archive.ParallelCompressor(
+            tee, codec=codec, level=level, workers=workers, block_size=block_size, dictionary=dictionary
+        )
+        files = archive.write_tar(compressor, manifest.members(), index)
+    if index is not None:
+        index.save(archive.member_index_name(path))
+    os.replace(f"{path}.tmp", path)
+    return ShardResult(
+        archive_id, path, files, compressor.bytes_in, compressor.bytes_out, time.monotonic() - start, tee.digests
+    )
+
+
+def build_shards(shards: List[Shard], config, workers: int = 0) -> Iterator[ShardResult]:
+    # Builds the archives of all shards, one per worker process, and yields them as soon as
+    # they are ready (not necessarily in order), so they can be uploaded while the others
+    # are still being compressed. A single shard is built in this process, with a parallel compressor.
+    options = {
+        "codec": config["ARCHIVE_CODEC"],
+        "level": config["ARCHIVE_LEVEL"],
+        "block_size": config["ARCHIVE_BLOCK_SIZE"],
+        "member_index": config["ARCHIVE_MEMBER_INDEX"],
+        "digests": verify.DIGESTS if config["VERIFY_UPLOADS"] else (),
+        "dictionary": dictionaries.load(config),
+    }
+    if len(shards) == 1:
+        shard = shards[0]
+        yield build_archive(shard.archive_id, shard.manifest, shard.name, workers=config["ARCHIVE_WORKERS"], **options)
+        return
+
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    with ProcessPoolExecutor(min(workers, len(shards))) as executor:
+        pending: Dict[Future, Shard] = {}
+        remaining = list(reversed(shards))
+        try:
+            while remaining or pending:
+                # Submit lazily, one shard per worker, so finished archives are yielded
+                # (and uploaded) in roughly id order
+                while remaining and len(pending) < workers:
+                    shard = remaining.pop()
+                    future = executor.submit(
+                        build_archive, shard.archive_id, shard.manifest, shard.name, workers=1, **options
+                    )
+                    pending[future] = shard
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda x: pending[x].archive_id):
+                    del pending[future]
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def make_shards(
+    manifest: scanner.Manifest,
+    shard_size: int,
+    the_time: int,
+    first_archive_id: int,
+    extension: str
+) -> List[Shard]:
+    # Consecutive archive ids, in replay id order
+    manifests = split_manifest(manifest, shard_size) if shard_size > 0 else [manifest]
+    return [
+        Shard(first_archive_id + i, f"{the_time}_replays_{first_archive_id + i}.{extension}", m)
+        for i, m in enumerate(manifests)
+    ]
@@ -0,0 +1,250 @@
+import hashlib
+import threading
+import time
+from typing import Any, Callable, Collection, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+import archive
+
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+
+T = TypeVar("T")
+
+
+class StreamAborted(Exception):
+    pass
+
+
+class BoundedPipe:
+    # In-memory pipe between a producer thread (write) and a consumer thread (read).
+    # At most max_size bytes are buffered: a fast producer blocks until the consumer
+    # catches up, so memory usage does not depend on the archive size.
+    def __init__(self, max_size: int = DEFAULT_BUFFER_SIZE):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self._buffer = bytearray()
+        self._eof = False
+        self._error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+
+    def writable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        written = 0
+        with self._cond:
+            while written < len(view):
+                while len(self._buffer) >= self.max_size and self._error is None:
+                    self._cond.wait()
+                if self._error is not None:
+                    raise StreamAborted() from self._error
+                if self._eof:
+                    raise ValueError("write to closed BoundedPipe")
+                n = min(len(view) - written, self.max_size - len(self._buffer))
+                self._buffer += view[written:written + n]
+                written += n
+                self._cond.notify_all()
+        return written
+
+    def read(self, size: int = -1) -> bytes:
+        with self._cond:
+            while not self._buffer and not self._eof and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise StreamAborted() from self._error
+            if size is None or size < 0:
+                size = len(self._buffer)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._cond.notify_all()
+            return data
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        # Producer side: signals EOF to the consumer once the buffer is drained
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def abort(self, error: BaseException) -> None:
+        # Either side: wakes up the other one, which will raise StreamAborted
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+
+class HashingTee:
+    # Writes everything to all sinks, while computing digest(s) and size in flight
+    def __init__(self, sinks: Sequence[Any], algorithms: Iterable[str] = ("sha256",)):
+        self.sinks = list(sinks)
+        self.hashes = {x: hashlib.new(x) for x in algorithms}
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        for h in self.hashes.values():
+            h.update(data)
+        for sink in self.sinks:
+            sink.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        for sink in self.sinks:
+            sink.flush()
+
+    @property
+    def digests(self) -> Dict[str, str]:
+        return {k: v.hexdigest() for k, v in self.hashes.items()}
+
+
+class UploaderThread(threading.Thread):
+    def __init__(self, upload: Callable[[BoundedPipe], Any], pipe: BoundedPipe, name: str = "oiseau-uploader"):
+        super(UploaderThread, self).__init__(name=name, daemon=True)
+        self.upload = upload
+        self.pipe = pipe
+        self.error: Optional[BaseException] = None
+        self.elapsed = 0.0
+
+    def run(self) -> None:
+        start = time.monotonic()
+        try:
+            self.upload(self.pipe)
+            # The uploader must consume the whole stream. If it returns early,
+            # unblock the producer instead of letting it wait forever.
+            if self.pipe.read(1):
+                raise StreamAborted("Uploader returned before the end of the stream")
+        except BaseException as e:
+            self.error = e
+            self.pipe.abort(e)
+        finally:
+            self.elapsed = time.monotonic() - start
+
+
+class _BestEffortSink:
+    # Stops feeding a pipe whose uploader failed, instead of stopping the whole stream
+    def __init__(self, pipe: BoundedPipe):
+        self.pipe = pipe
+
+    def write(self, data) -> int:
+        try:
+            self.pipe.write(data)
+        except StreamAborted:
+            pass
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class UploadResult(NamedTuple):
+    # Only optional uploads can have an error here, the others raise it
+    error: Optional[BaseException]
+    elapsed: float
+
+
+class StreamResult(NamedTuple):
+    size: int
+    digests: Dict[str, str]
+    bytes_in: int
+    members: int
+    uploads: Dict[str, UploadResult]
+
+
+def _first_error(uploaders: Dict[str, UploaderThread], optional: Collection[str]) -> Optional[BaseException]:
+    # The error of a required upload that failed by itself, not because we aborted it
+    for name, uploader in uploaders.items():
+        if name not in optional and uploader.error is not None and not isinstance(uploader.error, StreamAborted):
+            return uploader.error
+    for name, uploader in uploaders.items():
+        if name not in optional and uploader.error is not None:
+            return uploader.error
+    return None
+
+
+def stream_output(
+    produce: Callable[[HashingTee], T],
+    uploads: Dict[str, Callable[[BoundedPipe], Any]],
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+    *,
+    optional: Collection[str] = (),
+    spool_path: Optional[str] = None,
+    algorithms: Iterable[str] = ("sha256",)
+) -> Tuple[T, HashingTee, Dict[str, UploadResult]]:
+    # Everything produce(tee) writes is fed to each of the uploads(pipe), each one running in
+    # a separate thread and reading its own pipe until EOF, so producing and uploading overlap.
+    # The stream goes as fast as the slowest upload. If an upload fails, all of them are
+    # aborted, so no destination gets a truncated file, unless it's one of the optional
+    # uploads: those are just left behind, and their errors are returned.
+    # If spool_path is set, a local copy of the output is written there as well.
+    uploaders = {
+        name: UploaderThread(upload, BoundedPipe(buffer_size), f"oiseau-uploader-{name}")
+        for name, upload in uploads.items()
+    }
+    sinks: List[Any] = [
+        _BestEffortSink(x.pipe) if name in optional else x.pipe for name, x in uploaders.items()
+    ]
+    spool = open(spool_path, "wb") if spool_path is not None else None
+    if spool is not None:
+        sinks.append(spool)
+    tee = HashingTee(sinks, algorithms)
+    for uploader in uploaders.values():
+        uploader.start()
+    try:
+        result = produce(tee)
+        for uploader in uploaders.values():
+            uploader.pipe.close()
+    except BaseException as e:
+        for uploader in uploaders.values():
+            uploader.pipe.abort(e)
+        for uploader in uploaders.values():
+            uploader.join()
+        # If an uploader failed, its exception is more interesting than ours
+        error = _first_error(uploaders, optional) if isinstance(e, StreamAborted) else None
+        if error is not None:
+            raise error
+        raise
+    finally:
+        if spool is not None:
+            spool.close()
+    for uploader in uploaders.values():
+        uploader.join()
+    error = _first_error(uploaders, optional)
+    if error is not None:
+        raise error
+    return result, tee, {name: UploadResult(x.error, x.elapsed) for name, x in uploaders.items()}
+
+
+def stream_archive(
+    members: Iterable[archive.TarMember],
+    config,
+    uploads: Dict[str, Callable[[BoundedPipe], Any]],
+    *,
+    optional: Collection[str] = (),
+    spool_path: Optional[str] = None,
+    algorithms: Iterable[str] = ("sha256",),
+    member_index: Optional[archive.MemberIndex] = None
+) -> StreamResult:
+    # Builds the archive and uploads it at the same time (see stream_output)
+    def produce(tee: HashingTee) -> Tuple[archive.ParallelCompressor, int]:
+        compressor = archive.compressor_from_config(tee, config)
+        return compressor, archive.write_tar(compressor, members, member_index)
+
+    (compressor, count), tee, results = stream_output(
+        produce,
+        uploads,
+        config["STREAM_BUFFER_SIZE"],
+        optional=optional,
+        spool_path=spool_path,
+        algorithms=algorithms
+    )
+    return StreamResult(size=tee.size, digests=tee.digests, bytes_in=compressor.bytes_in, members=count, uploads=results)
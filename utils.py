@@ -1,15 +1,12 @@
+import atexit
 import html
-import subprocess
-from typing import Callable, Any
+import threading
+from typing import Callable, Any, Dict, Optional
 
-import requests
-
-from config import Config
+import rclone
+from config import Config, get_config
 from exceptions import CriticalError
-
-def rclone_copy_cmd(source_file: str, dest_file: str, *, progress: bool = False) -> str:
-    return f"""rclone copy "{source_file}" "{dest_file}" {'--progress' if progress else ''}"""
-
+from notifier import TelegramNotifier
 
 def rsync_upload_cmd(source, dest, port, key_location="~/.ssh/id_rsa.pub"):
     return """rsync -e "ssh -p {port} -oStrictHostKeyChecking=no -i {key}" -azvP "{source}" "{dest}" """.format(
@@ -29,26 +26,6 @@ def scp_download_cmd(source, port, local_file, key_location="~/.ssh/id_rsa.pub")
     )
 
 
-def call_process(command: str) -> int:
-    process = subprocess.Popen(
-        command,
-        shell=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-
-    # Print rsync output to console
-    while True:
-        output_line = process.stdout.readline().decode("utf-8")
-        if not output_line:
-            break
-        print(output_line)
-
-    # Wait for the process to exit and return the exit code
-    return process.wait()
-
-
 class BColors:
     HEADER = '\033[95m'
     BLUE = '\033[94m'
@@ -61,7 +38,8 @@ class BColors:
 
 
 def printc(s, c):
-    print("{}{}{}".format(c, s, BColors.ENDC))
+    # A single write, so lines printed by upload threads don't get mixed up
+    print("{}{}{}\n".format(c, s, BColors.ENDC), end="", flush=True)
 
 
 class TelegramPrefixes:
@@ -77,56 +55,96 @@ def warn(message, telegram=True):
         telegram_notify("<b>Warning</b>\n\n<code>{}</code>".format(html.escape(message)), prefix=TelegramPrefixes.ALERT)
 
 
-def telegram_api_call(method, data, token=None):
-    if not Config()["TELEGRAM_TOKEN"]:
-        return
-    if token is None:
-        token = Config()["TELEGRAM_TOKEN"]
-    return requests.post("https://api.telegram.org/bot{}/{}".format(token, method), data=data)
+_notifiers: Dict[str, TelegramNotifier] = {}
+_notifiers_lock = threading.Lock()
 
 
-def telegram_notify(message, chat_id=None, parse_mode="html", prefix=TelegramPrefixes.NORMAL):
+def telegram_notifier(token=None) -> Optional[TelegramNotifier]:
+    # One background notifier per bot token, flushed when the process exits
+    config = get_config()
+    if token is None:
+        token = config["TELEGRAM_TOKEN"]
+    if not token:
+        return None
+    with _notifiers_lock:
+        if token not in _notifiers:
+            _notifiers[token] = TelegramNotifier(
+                token,
+                api_base=config["TELEGRAM_API_BASE"],
+                timeout=config["TELEGRAM_TIMEOUT"],
+                queue_size=config["TELEGRAM_QUEUE_SIZE"]
+            )
+        return _notifiers[token]
+
+
+@atexit.register
+def close_telegram_notifiers(timeout=None) -> None:
+    with _notifiers_lock:
+        notifiers = list(_notifiers.values())
+        _notifiers.clear()
+    if notifiers and timeout is None:
+        timeout = get_config()["TELEGRAM_TIMEOUT"] * 3
+    for notifier in notifiers:
+        if not notifier.close(timeout):
+            printc("* Some Telegram notifications could not be sent", BColors.YELLOW)
+
+
+def telegram_api_call(method, data, token=None, *, key=None, callback=None):
+    # Does not wait for the api call, see notifier.TelegramNotifier
+    notifier = telegram_notifier(token)
+    if notifier is None:
+        return False
+    return notifier.send(method, data, key=key, callback=callback)
+
+
+def telegram_notify(message, chat_id=None, parse_mode="html", prefix=TelegramPrefixes.NORMAL, callback=None):
     if chat_id is None:
-        chat_id = Config()["TELEGRAM_CHAT_ID"]
+        chat_id = get_config()["TELEGRAM_CHAT_ID"]
     return telegram_api_call("sendMessage", {
         "chat_id": chat_id,
         "text": "{} {}".format(prefix, message),
         "parse_mode": parse_mode
-    })
+    }, callback=callback)
 
 
 class TelegramStatusMessage:
     def __init__(self, latest_sync):
         self.done_what = {k: False for k in ("replays", "avatars", "screenshots", "profile_backgrounds", "database")}
         self.latest_sync = latest_sync
-        telegram_response = telegram_notify(self.telegram_message, prefix="")
         self.telegram_message_id = None
-        if telegram_response is not None and telegram_response.status_code == 200:
-            json_response = telegram_response.json()
-            if json_response.get("ok", False):
-                self.telegram_message_id = json_response.get("result", {}).get("message_id", None)
+        telegram_notify(self.telegram_message, prefix="", callback=self._set_message_id)
+
+    def _set_message_id(self, result):
+        if isinstance(result, dict):
+            self.telegram_message_id = result.get("message_id", None)
 
     @property
     def done(self):
-        return all(not Config()["SYNC_{}".format(k.upper())] or v for k, v in self.done_what.items())
+        return all(not get_config()["SYNC_{}".format(k.upper())] or v for k, v in self.done_what.items())
 
     @property
     def telegram_message(self):
         return (TelegramPrefixes.NORMAL if not self.done else TelegramPrefixes.SUCCESS) + \
                "<b>C14 backup {}</b>\n\n".format("done!" if self.done else "in progress") + "\n".join(
-            ("✅" if x else "🕐" if not x and Config()["SYNC_{}".format(ck.upper())] else "❌") +
+            ("✅" if x else "🕐" if not x and get_config()["SYNC_{}".format(ck.upper())] else "❌") +
             " " +
             ck.replace("_", " ").capitalize() for ck, x in self.done_what.items()
         ) + "\n\nLatest sync: <code>{}</code>".format(self.latest_sync if not None else "Never")
 
+    def _edit_data(self):
+        if self.telegram_message_id is None:
+            return None
+        return {
+            "chat_id": get_config()["TELEGRAM_CHAT_ID"],
+            "message_id": self.telegram_message_id,
+            "text": self.telegram_message,
+            "parse_mode": "html"
+        }
+
     def update_telegram_message(self):
-        if self.telegram_message_id is not None:
-            telegram_api_call("editMessageText", {
-                "chat_id": Config()["TELEGRAM_CHAT_ID"],
-                "message_id": self.telegram_message_id,
-                "text": self.telegram_message,
-                "parse_mode": "html"
-            })
+        # The message is built when the edit is sent (after the sendMessage call that gives us its id),
+        # and edits that pile up while the notifier is busy are merged into the latest one
+        telegram_api_call("editMessageText", self._edit_data, key=("status", id(self)))
 
 
 def sync_done(what=None, status_message=None):
@@ -143,5 +161,45 @@ def must_success(f: Callable[[], int], success: Callable[[int], bool] = lambda x
         raise CriticalError(f"Error: got {r}")
     return r
 
-def rclone_copy(source: str, dest: str, *, progress: bool = False) -> Any:
-    return must_success(lambda: call_process(rclone_copy_cmd(source, dest, progress=progress)))
+def _rclone_log(level: str, message: str) -> None:
+    if level in ("warning", "error", "critical"):
+        printc(f"* rclone: {message}", BColors.RED if level != "warning" else BColors.YELLOW)
+
+
+def _rclone_progress(stats: rclone.RcloneStats) -> None:
+    percent = f"{stats.percent:.1f}%" if stats.percent is not None else "?"
+    eta = f"{stats.eta:.0f} s" if stats.eta is not None else "?"
+    printc(
+        f"* {percent} ({stats.bytes / 1024 / 1024:.2f}/{stats.total_bytes / 1024 / 1024:.2f} MB), "
+        f"{stats.speed / 1024 / 1024:.2f} MB/s, ETA {eta}",
+        BColors.BLUE
+    )
+
+
+def _rclone_options(config: Config) -> Dict[str, Any]:
+    return {
+        "transfers": config["RCLONE_TRANSFERS"],
+        "chunk_size": config["RCLONE_CHUNK_SIZE"],
+        "timeout": config["RCLONE_TIMEOUT"] or None,
+    }
+
+
+def rclone_copy(source: str, dest: str, *, progress: bool = False, cancel=None) -> Optional[rclone.RcloneStats]:
+    return rclone.run(
+        "copy", source, dest,
+        on_stats=_rclone_progress if progress else None,
+        on_log=_rclone_log,
+        cancel=cancel,
+        **_rclone_options(get_config())
+    )
+
+
+def rclone_rcat(fileobj, dest_file: str, *, cancel=None) -> Optional[rclone.RcloneStats]:
+    # Streams fileobj to dest_file on the rclone remote, without a local copy
+    return rclone.run(
+        "rcat", dest_file,
+        stdin=fileobj,
+        on_log=_rclone_log,
+        cancel=cancel,
+        **_rclone_options(get_config())
+    )
@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import archive
+import ftp
+import restore
+import utils
+from config import Config, get_config
+from exceptions import CriticalError
+from utils import printc
+
+# Checks that what's on C14 or on the rclone remote is what we uploaded, without downloading it.
+#
+# Archives are hashed while they're written. After an upload, the size of the remote file is
+# compared with the local one and, if the remote can hash files (FTP HASH or X* commands,
+# rclone backends that store hashes), the hashes are compared as well. Otherwise a few ranges of
+# the remote file are compared with the local copy or, if there's no local copy, a few blocks are
+# decompressed using the member index. A remote file that doesn't match is deleted, so the next
+# attempt uploads it from scratch.
+#
+# The scrubber does the same to archives uploaded in the past: it picks the ones that have not
+# been checked for the longest time and decompresses some of their blocks.
+
+# Computed while archives are written, the remote may support only some of them
+DIGESTS = ("md5", "sha1", "sha256")
+
+DEFAULT_SAMPLE_SIZE = 1024 * 1024
+
+
+class VerificationError(CriticalError):
+    pass
+
+
+class Verification(NamedTuple):
+    name: str
+    size: int
+    # Hash algorithm, "ranges" (compared with the local copy), "blocks" (decompressed) or "size"
+    method: str
+
+
+def remote_source(
+    config: Config,
+    ftp_credentials: Optional[ftp.FtpCredentials],
+    login=None,
+    remote: Optional[str] = None
+) -> restore.Source:
+    # The main destination, or the mirror whose rclone remote is given
+    if remote is not None:
+        return restore.RcloneSource(remote)
+    if config.is_c14:
+        return restore.FtpSource(ftp_credentials, login)
+    return restore.RcloneSource(config["RCLONE_REMOTE"])
+
+
+def file_digests(path: str, algorithms: Iterable[str], offset: int = 0, length: Optional[int] = None) -> Dict[str, str]:
+    hashes = {x: hashlib.new(x) for x in algorithms}
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = os.path.getsize(path) - offset if length is None else length
+        while remaining > 0:
+            data = f.read(min(DEFAULT_SAMPLE_SIZE, remaining))
+            if not data:
+                break
+            for h in hashes.values():
+                h.update(data)
+            remaining -= len(data)
+    return {k: v.hexdigest() for k, v in hashes.items()}
+
+
+def data_digests(data: bytes, algorithms: Iterable[str] = DIGESTS) -> Dict[str, str]:
+    return {x: hashlib.new(x, data).hexdigest() for x in algorithms}
+
+
+def sample_offsets(size: int, samples: int, sample_size: int, rng: random.Random) -> List[int]:
+    # The first and the last range, plus random ones
+    if size <= sample_size * samples:
+        return list(range(0, size, sample_size))
+    offsets = {0, size - sample_size}
+    while len(offsets) < samples:
+        offsets.add(rng.randrange(size - sample_size))
+    return sorted(offsets)
+
+
+def check_blocks(
+    source: restore.Source,
+    name: str,
+    index: archive.MemberIndex,
+    samples: int,
+    rng: Optional[random.Random] = None
+) -> int:
+    # Downloads and decompresses some blocks of the archive (always the last one, it's where
+    # truncated uploads show up). Decompression checks the codec's own checksums, the size of
+    # the result is checked against the index. Returns the number of compressed bytes read.
+    rng = rng or random.Random()
+    blocks = len(index.block_positions)
+    if not blocks:
+        return 0
+    chosen = {blocks - 1}
+    chosen.update(rng.sample(range(blocks), min(samples, blocks)))
+    codec = archive.get_codec(index.codec)
+    try:
+        restore.load_dictionary(source, index)
+    except (KeyError, ValueError) as e:
+        # Missing or wrong dictionary. Network errors are not the archive's fault, they're raised as they are.
+        raise VerificationError(f"{name}: cannot load its zstd dictionary ({e.args[0]})")
+    read = 0
+    for i in sorted(chosen):
+        start = index.block_positions[i]
+        end = index.block_positions[i + 1] if i + 1 < blocks else index.bytes_out
+        expected = (index.block_offsets[i + 1] if i + 1 < blocks else index.bytes_in) - index.block_offsets[i]
+        compressed = source.read_range(name, start, end - start)
+        read += len(compressed)
+        if len(compressed) != end - start:
+            raise VerificationError(f"{name}: short read of block {i} ({len(compressed)}/{end - start} bytes)")
+        try:
+            data = codec.decompress(compressed)
+        except Exception as e:
+            raise VerificationError(f"{name}: block {i} is corrupted ({e})")
+        if len(data) != expected:
+            raise VerificationError(f"{name}: block {i} decompressed to {len(data)} bytes, expected {expected}")
+    return read
+
+
+def _verify(
+    source: restore.Source,
+    name: str,
+    size: int,
+    remote_size: int,
+    local_path: Optional[str],
+    offset: int,
+    digests: Optional[Dict[str, str]],
+    index: Optional[archive.MemberIndex],
+    samples: int,
+    sample_size: int
+) -> Verification:
+    if remote_size != size:
+        raise VerificationError(f"{name} is {remote_size} bytes on the remote, {size} bytes locally")
+
+    # Strongest hash first
+    remote_digests = source.digests(name, reversed(DIGESTS))
+    for algorithm in reversed(DIGESTS):
+        if algorithm not in remote_digests:
+            continue
+        expected = (digests or {}).get(algorithm)
+        if expected is None and local_path is not None:
+            expected = file_digests(local_path, (algorithm,), offset, size)[algorithm]
+        if expected is None:
+            continue
+        if remote_digests[algorithm] != expected:
+            raise VerificationError(f"{name}: {algorithm} mismatch ({remote_digests[algorithm]} != {expected})")
+        return Verification(name, size, algorithm)
+
+    rng = random.Random()
+    if local_path is not None:
+        with open(local_path, "rb") as f:
+            for x in sample_offsets(size, samples, sample_size, rng):
+                f.seek(offset + x)
+                length = min(sample_size, size - x)
+                if source.read_range(name, x, length) != f.read(length):
+                    raise VerificationError(f"{name}: bytes {x}-{x + length} differ from the local copy")
+        return Verification(name, size, "ranges")
+    if index is not None:
+        check_blocks(source, name, index, samples, rng)
+        return Verification(name, size, "blocks")
+    return Verification(name, size, "size")
+
+
+def verify_upload(
+    source: restore.Source,
+    name: str,
+    size: int,
+    *,
+    local_path: Optional[str] = None,
+    offset: int = 0,
+    digests: Optional[Dict[str, str]] = None,
+    index: Optional[archive.MemberIndex] = None,
+    samples: int = 8,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    delete: bool = True
+) -> Verification:
+    # Checks that name on the remote is the size bytes at offset of local_path (or the file
+    # whose digests are given, if there's no local copy). If it's not, VerificationError is raised
+    # and, with delete, the remote file is deleted (so it's not resumed on top of bad data).
+    remote_size = source.size(name)
+    if remote_size is None:
+        raise VerificationError(f"{name} is not on the remote")
+    try:
+        return _verify(source, name, size, remote_size, local_path, offset, digests, index, samples, sample_size)
+    except VerificationError as e:
+        if not delete:
+            raise
+        try:
+            source.delete(name)
+        except Exception as delete_error:
+            raise VerificationError(f"{e.message}. Could not delete the remote copy ({delete_error})")
+        raise VerificationError(f"{e.message}. The remote copy has been deleted")
+
+
+class ScrubResult(NamedTuple):
+    name: str
+    bytes_read: int
+    error: Optional[str]
+
+
+def scrub(
+    source: restore.Source,
+    *,
+    archives: int,
+    samples: int,
+    state_file: str = "",
+    rng: Optional[random.Random] = None
+) -> List[ScrubResult]:
+    # Checks the archives (the ones with a member index) that have not been checked for the
+    # longest time, remembering when each archive has been checked in state_file
+    state: Dict[str, float] = {}
+    if state_file and os.path.isfile(state_file):
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    # Archives uploaded in parts are checked as a whole
+    source = restore.SplitSource(source)
+    names = set(source.list())
+    candidates = [x for x in names if archive.member_index_name(x) in names]
+    # Never checked first, oldest archives first (names start with the upload time)
+    candidates.sort(key=lambda x: (state.get(x, 0), x))
+    results = []
+    for name in candidates[:archives]:
+        read = 0
+        try:
+            index = archive.MemberIndex.from_bytes(source.read(archive.member_index_name(name)))
+            remote_size = source.size(name)
+            if remote_size != index.bytes_out:
+                raise VerificationError(f"{name} is {remote_size} bytes on the remote, the index says {index.bytes_out}")
+            read = check_blocks(source, name, index, samples, rng)
+            results.append(ScrubResult(name, read, None))
+        except Exception as e:
+            results.append(ScrubResult(name, read, e.message if isinstance(e, CriticalError) else f"{name}: {e}"))
+        state[name] = time.time()
+    if state_file:
+        # Forget archives that are not there anymore
+        state = {k: v for k, v in state.items() if k in names}
+        with open(f"{state_file}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{state_file}.tmp", state_file)
+    return results
+
+
+def scrub_remote(state, archives: int, samples: int) -> bool:
+    # Scrubs the configured remote. Returns True if all the checked archives are fine.
+    # oiseau imports this module
+    import oiseau
+
+    config = state.config
+    pipeline = oiseau.Pipeline(state)
+    if not pipeline.connect():
+        printc("* The C14 bucket is not available, not scrubbing", utils.BColors.YELLOW)
+        return True
+    source = remote_source(config, pipeline.ftp_credentials, state.ftp_login)
+    try:
+        results = scrub(source, archives=archives, samples=samples, state_file=config["SCRUB_STATE_FILE"])
+    finally:
+        source.close()
+    bad = [x for x in results if x.error is not None]
+    for result in results:
+        if result.error is None:
+            printc(f"* Scrubbed {result.name} ({result.bytes_read / 1024 / 1024:.2f} MB read)", utils.BColors.BLUE)
+        else:
+            printc(f"# {result.error}", utils.BColors.RED)
+    if bad:
+        utils.telegram_notify(
+            "<b>Scrubbing found damaged archives.</b>\n\n" + "\n".join(
+                f"<code>{html.escape(x.error)}</code>" for x in bad
+            ),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    return not bad
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Check archives on the remote without downloading them")
+    config = get_config()
+    parser.add_argument("--archives", type=int, default=config["SCRUB_ARCHIVES"], help="number of archives to check")
+    parser.add_argument("--samples", type=int, default=config["VERIFY_SAMPLES"], help="blocks checked per archive")
+    args = parser.parse_args(argv)
+
+    import oiseau
+
+    oiseau.print_banner()
+    state = oiseau.BackupState(config)
+    try:
+        return 0 if scrub_remote(state, args.archives, args.samples) else 1
+    except CriticalError as e:
+        printc("# {}".format(e.message), utils.BColors.RED + utils.BColors.BOLD)
+    except Exception as e:
+        printc("# Unknown error while scrubbing ({})".format(str(e)), utils.BColors.RED)
+        utils.telegram_notify(
+            "<b>Unhandled exception while scrubbing.</b>\n\n<code>{}</code>".format(html.escape(traceback.format_exc())),
+            prefix=utils.TelegramPrefixes.ERROR
+        )
+    return -1
+
+
+if __name__ == "__main__":
+    sys.exit(main())